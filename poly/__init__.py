@@ -1,10 +1,23 @@
 from sys import stdout
+import os
+import re
 import time
-import process
-from process import PolyProcess, ProtocolError, Timeout
-from console import ConsoleThread
-import accessors
-import console
+import atexit
+import threading
+import weakref
+from collections import deque
+from . import process
+from .process import (PolyProcess, ProtocolError, Timeout, debug, DEBUG_WARN,
+                      DEBUG_FINE)
+from .console import ConsoleThread
+from . import accessors
+from .cache import CompileCache, LRUCache
+from .scheduler import CompileScheduler
+from .index import PositionIndex, SymbolIndex, token_ranges
+from . import store
+from . import trace
+from .metrics import Metrics
+from . import incremental as _incremental
 import gc
 
 """A library for accessing Poly/ML's IDE integration
@@ -17,26 +30,90 @@ The main class is Poly, which should be instantiated using global_instance().
 
 The accessors module has methods for generating signatures and structs from
 datatypes which are indepent from Poly (and hence from Poly/ML).
+
+CompileScheduler can be used to compile files as they are edited, so that
+each file's newest code is compiled as soon as possible.
+
+The aio module has AsyncPoly, a version of Poly for asyncio programs (it
+needs Python 3.5 or later).
 """
 
 poly_global = None
 
-def global_instance(poly_bin='/usr/local/bin/poly'):
+# the number of query results each Poly keeps
+QUERY_CACHE_SIZE = 1024
+
+# the number of messages read from each compilation result by default; any
+# more are counted, but skipped
+MAX_MESSAGES = 100
+
+# how long to wait before restarting Poly/ML when it has crashed more than
+# once in a row, in seconds; this doubles with each crash, up to
+# RESTART_MAX_DELAY.  The first crash is restarted from straight away.
+RESTART_DELAY = 0.5
+RESTART_MAX_DELAY = 30
+
+# a process that ran for longer than this (in seconds) before crashing
+# resets the count of crashes in a row
+RESTART_RESET = 60
+
+# marks a query result that is not in the cache (None is a valid result)
+_MISSING = object()
+
+# how many requests to send to Poly/ML at once when building an index
+INDEX_BATCH_SIZE = 256
+
+def global_instance(poly_bin='/usr/local/bin/poly', processes=1, spare=False,
+                    compile_cache=None, incremental=False, index=False,
+                    persistent_index=False, max_messages=MAX_MESSAGES):
     """Get the global instance of the Poly class
 
     poly_bin -- the path to the Poly/ML binary
+    processes -- (optional) how many Poly/ML processes to use; if this is
+                 more than 1, the instance will be a PolyPool
+    spare -- (optional) whether to keep a spare Poly/ML process running
+             (see Poly)
+    compile_cache -- (optional) a CompileCache for compilation results
+    incremental -- (optional) whether to only compile the changed parts of
+                   files (see Poly)
+    index -- (optional) whether to index files in the background after
+             they compile (see Poly)
+    persistent_index -- (optional) whether to keep the indexes on disk, for
+                        later sessions (see Poly)
+    max_messages -- (optional) the most messages to read from a compilation
+                    result (see Poly)
 
     If there is no global instance already, one will be created.
-    poly_bin is only used in this case, not when the instance
-    already exists.
+    The arguments are only used in this case, not when the
+    instance already exists.
 
-    Returns a Poly object.
+    Returns a Poly (or PolyPool) object.
     """
     global poly_global
     if poly_global == None:
-        poly_global = Poly(poly_bin)
+        if processes > 1:
+            poly_global = PolyPool(poly_bin, processes, spare, compile_cache,
+                                   incremental, index, persistent_index,
+                                   max_messages)
+        else:
+            poly_global = Poly(poly_bin, spare, compile_cache, incremental,
+                               index, persistent_index, max_messages)
     return poly_global
 
+def polysave_for(path):
+    """Get the saved state for a file, if it has one.
+
+    PolyML.Project saves the state needed to compile foo.ML in
+    .polysave/foo.ML.save, next to the file.
+
+    Returns the path of the saved state, or None if it does not exist.
+    """
+    polysave = os.path.join(os.path.dirname(path), '.polysave',
+                            os.path.basename(path) + '.save')
+    if os.path.exists(polysave):
+        return polysave
+    return None
+
 def kill_global_instance():
     """Discards the global instance of the Poly class
 
@@ -50,6 +127,13 @@ def kill_global_instance():
         poly_global = None
     gc.collect()
 
+_whitespace_rexp = re.compile(r"\s+")
+
+def _clean_text(text):
+    """Replaces each run of whitespace in a string with a single space,
+    and removes any at the start or end."""
+    return _whitespace_rexp.sub(' ', text.strip())
+
 class PolyLocation:
     """A location (range) in a file.
 
@@ -159,12 +243,37 @@ class PolyException(PolyMessage):
         self.location = location
 
 class PolyErrorMessage(PolyMessage):
-    """A message detailing an error (or warning) from Poly/ML"""
+    """A message detailing an error (or warning) from Poly/ML
+
+    raw_text -- the text as Poly/ML sent it
+
+    Poly/ML puts newlines into its messages.  The text attribute has them
+    (and any other excess whitespace) taken out, but only when it is first
+    used, as most of a long list of messages is never shown.
+    """
 
     def __init__(self, message_code, file_name, line, start_pos, end_pos, text):
         self.message_code = message_code
         self.location = PolyLocation(file_name, line, start_pos, end_pos)
-        self.text = text
+        self.raw_text = text
+
+    def __getattr__(self, name):
+        # only called when the attribute is not set
+        if name == 'text':
+            self.text = _clean_text(self.raw_text)
+            return self.text
+        raise AttributeError(name)
+
+class MessageList(list):
+    """The list of PolyMessages from a compilation
+
+    suppressed -- how many more messages there were than were read (see
+                  Poly.max_messages)
+    """
+
+    def __init__(self, messages=[], suppressed=0):
+        list.__init__(self, messages)
+        self.suppressed = suppressed
 
 class Poly:
     """The core class for interacting with a Poly/ML instance.
@@ -174,29 +283,303 @@ class Poly:
     process -- the Poly/ML process (lazily created)
     compile_in_progress -- whether there is currently an async compilation
                            happening
+    spare -- whether to keep a spare Poly/ML process running, which
+             replaces self.process straight away if it dies or is restarted
+    compile_cache -- a CompileCache to answer repeated compilations of the
+                     same code from, or None
+    incremental -- whether to only compile the part of a file after the
+                   first top-level declaration that changed since it was
+                   last compiled
+    index -- whether to build a PositionIndex of each file in the background
+             after it compiles successfully, to answer queries from
+    persistent_index -- whether to save indexes in the .polysave directory
+                        next to each file, so that load_stored_index() can
+                        use them in later sessions
+    symbols -- a SymbolIndex of the declarations found by indexing files
+    metrics -- a Metrics of the requests sent to the Poly/ML processes;
+               see stats()
+    output_subscribers -- the OutputSubscriptions that the output of the
+                          code being compiled is passed on to; see
+                          subscribe_output()
+    max_messages -- the most error messages to read from a compilation
+                    result, or None for no limit; the rest are only
+                    counted, in the suppressed attribute of the MessageList
+
+    If Poly/ML exits unexpectedly, the requests waiting for it fail with a
+    ProtocolError straight away, a compile() in progress calls its handler
+    with the result code None and a message saying what happened, and a
+    new process is started (after a delay, if it keeps crashing; see
+    RESTART_DELAY).  The reasons for restarts are kept in the metrics.
+
+    In incremental mode, the environment after the unchanged declarations
+    at the start of a file is saved as a checkpoint (a child saved state),
+    and later compilations load it instead of compiling those declarations
+    again.  Positions in messages and nodes are always offsets into the
+    whole of the ML code passed to compile or compile_sync.
     """
 
-    def __init__(self, poly_bin='poly'):
+    def __init__(self, poly_bin='poly', spare=False, compile_cache=None,
+                 incremental=False, index=False, persistent_index=False,
+                 max_messages=MAX_MESSAGES):
         self.poly_bin = poly_bin
         self.process = None
         self.compile_in_progress = False
+        self.spare = spare
+        self.compile_cache = compile_cache
+        self.incremental = incremental
+        self.index = index
+        self.persistent_index = persistent_index
+        self.max_messages = max_messages
+        self._stores = {}
+        self._checkpoints = None
+        # for each file: the prefix keys of the last compilation, how many
+        # declarations at the start were unchanged, and how many of those
+        # are in the checkpoint it used
+        self._increments = {}
+        # prefix keys of checkpoints that could not be made or loaded
+        self._bad_prefixes = set()
+        # where the code Poly/ML compiled for each file starts in the file,
+        # and what the whole file was, when only part of it was compiled
+        self._tree_offsets = {}
+        self._partial_compiles = {}
+        # whether nothing has been added to Poly/ML's environment since it
+        # started
+        self._clean_env = True
+        # whether the compilation in progress saves the root checkpoint
+        self._saving_root = False
+        self._spare_process = None
         self._parse_trees = {}
-
-        # for _clean_text()
-        import re
-        self._clean_rexp = re.compile(r"\s+")
+        # the cache key of the compilation that produced each parse tree
+        self._tree_keys = {}
+        # compilations answered from the cache that have not been sent to
+        # Poly/ML, so have no parse tree yet
+        self._lazy_compiles = {}
+        # answers to O, T and I requests, by parse tree and range
+        self._queries = LRUCache(QUERY_CACHE_SIZE)
+        # finished PositionIndexes, by parse tree id
+        self._indexes = {}
+        # the made-up parse tree ids of indexes for files that Poly/ML does
+        # not have a parse tree for (see load_stored_index())
+        self._stored_trees = {}
+        self.symbols = SymbolIndex()
+        self.metrics = Metrics()
+        self.output_subscribers = []
+        self._loaded_state = None
+        # what _loaded_state will be if the compilation being sent runs its
+        # prelude
+        self._next_loaded_state = None
+        self._starts = 0
+        self._spare_starts = 0
+        self._start_latencies = deque([], 100)
+        # held while the process is replaced
+        self._start_lock = threading.RLock()
+        # how many times in a row Poly/ML has crashed
+        self._crashes = 0
+        # for the compilation in progress: the request id compile() returned,
+        # the id of the request Poly/ML is working on (a partial compilation
+        # that fails is sent again in full, as a new request), and whether
+        # it has been cancelled
+        self._compile_rids = None
+        self._compile_lock = threading.Lock()
 
     def has_built(self, path):
-        """Return whether a file has been compiled."""
-        return (path in self._parse_trees.keys())
+        """Return whether a file has been compiled (or has an index from
+        load_stored_index())."""
+        return (path in self._parse_trees.keys() or
+                path in self._lazy_compiles.keys() or
+                path in self._stored_trees.keys())
 
     def ensure_poly_running(self):
-        """Starts the Poly/ML process if it is not already running."""
+        """Starts the Poly/ML process if it is not already running.
+
+        If there is a spare process, it is used instead of starting a new
+        one, and a new spare is started.
+        """
+        self._start_lock.acquire()
+        try:
+            self._ensure_poly_running()
+        finally:
+            self._start_lock.release()
+
+    def _ensure_poly_running(self):
         if self.process == None or not self.process.is_alive():
+            needed = time.time()
             # reset state, in case poly just died
             self.compile_in_progress = False
+            self._keep_indexes()
             self._parse_trees = {}
-            self.process = PolyProcess(self.poly_bin)
+            self._tree_keys = {}
+            self._queries.clear()
+            self._tree_offsets = {}
+            self._partial_compiles = {}
+            self._loaded_state = None
+            self._clean_env = True
+            self._saving_root = False
+            spare = self._spare_process
+            self._spare_process = None
+            if self.process != None:
+                self.metrics.restarted(self.process.exit_reason or
+                                       'Poly/ML was not running')
+            if spare != None and spare.is_alive():
+                self.process = spare
+                self._spare_starts += 1
+            else:
+                self.process = self._new_process()
+            self._starts += 1
+
+            process = self.process
+            def record_latency():
+                self._start_latencies.append(
+                    max(0.0, process.listener.ready_time - needed))
+            process.when_ready(record_latency)
+
+        if self.spare and (self._spare_process == None or
+                           not self._spare_process.is_alive()):
+            self._spare_process = self._new_process()
+
+    def _new_process(self):
+        process = PolyProcess(self.poly_bin, metrics=self.metrics)
+        process.listener.output_subscribers = self.output_subscribers
+        # a weak reference, so that the process does not keep this alive
+        ref = weakref.ref(self)
+        def exited(process):
+            poly = ref()
+            if poly != None:
+                poly._process_exited(process)
+        process.when_exited(exited)
+        return process
+
+    def _process_exited(self, process):
+        """Restarts Poly/ML after a process has exited (unless it was
+        killed on purpose)"""
+        if process.killed:
+            return
+        self._start_lock.acquire()
+        try:
+            if process is self.process:
+                self.compile_in_progress = False
+            elif process is self._spare_process:
+                self._spare_process = None
+            else:
+                return
+            if not process.is_ready():
+                # it never started properly, so would probably fail again;
+                # the next request will try
+                return
+            if time.time() - process.spawn_time > RESTART_RESET:
+                self._crashes = 0
+            self._crashes += 1
+            delay = 0
+            if self._crashes > 1:
+                delay = min(RESTART_MAX_DELAY,
+                            RESTART_DELAY * 2 ** (self._crashes - 2))
+        finally:
+            self._start_lock.release()
+        debug('{0}; restarting it in {1}s'.format(process.exit_reason, delay),
+              DEBUG_WARN)
+        timer = threading.Timer(delay, self._replace_crashed, [process])
+        timer.daemon = True
+        timer.start()
+
+    def _replace_crashed(self, process):
+        """Replaces a process that crashed, unless that has been done since
+        (eg: by a request that needed Poly/ML)"""
+        self._start_lock.acquire()
+        try:
+            if process is self.process or (self.spare and
+                                           self._spare_process == None):
+                self._ensure_poly_running()
+        finally:
+            self._start_lock.release()
+
+    def start(self):
+        """Starts Poly/ML (and the spare process, if enabled) now.
+
+        Poly/ML takes a while to start, so calling this early (eg: when an
+        editor plugin is loaded) saves waiting for it on the first compile.
+        This does not wait for Poly/ML to be ready.
+        """
+        self.ensure_poly_running()
+
+    def restart(self):
+        """Replaces the Poly/ML process with a fresh one.
+
+        With a spare process, this happens without waiting for Poly/ML to
+        start up.
+        """
+        self._start_lock.acquire()
+        try:
+            if self.process != None:
+                self.metrics.restarted('restart requested')
+                if self.process.is_alive():
+                    self.process.kill()
+            self.process = None
+            self._ensure_poly_running()
+        finally:
+            self._start_lock.release()
+
+    def subscribe_output(self, fn=None, interval=None, limit=None):
+        """Passes on what the code being compiled prints, as it is printed.
+
+        fn -- (optional) a function to call with each piece of output and
+              the number of bytes dropped before it (see
+              poly.process.OutputSubscription)
+        interval -- (optional) the shortest time between calls to fn, in
+                    seconds
+        limit -- (optional) the most output to keep for fn, in bytes
+
+        The output of every Poly/ML process this Poly starts is passed on.
+
+        Returns the poly.process.OutputSubscription; without fn, call its
+        take() method to get the output.
+        """
+        subscription = process.OutputSubscription(fn, interval, limit)
+        self.output_subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe_output(self, subscription):
+        """Stops passing on output to a subscription."""
+        if subscription in self.output_subscribers:
+            self.output_subscribers.remove(subscription)
+        subscription.close()
+
+    def startup_timings(self):
+        """Returns timings for starting Poly/ML processes.
+
+        The result is a dict with the following entries:
+        starts -- how many times a Poly/ML process has been (re)started
+        spare_starts -- how many of those used the spare process
+        latencies -- for recent starts, how long (in seconds) from when the
+                     process was needed until it had completed its handshake;
+                     this is 0 for spare processes that were already ready
+        last_latency -- the latest entry in latencies, or None
+        """
+        latencies = list(self._start_latencies)
+        return {
+            'starts': self._starts,
+            'spare_starts': self._spare_starts,
+            'latencies': latencies,
+            'last_latency': latencies[-1] if latencies else None,
+        }
+
+    def query_stats(self):
+        """Returns a dict with the size, entries, hits and misses of the
+        cache of node, type and declaration queries."""
+        return self._queries.stats()
+
+    def stats(self):
+        """Returns the request metrics (see poly.metrics.Metrics.stats),
+        with the query cache statistics as 'queries' (see query_stats) and,
+        if Poly/ML is running, the amount of other output it has written as
+        'output' (see poly.process.PolyProcess.output_stats).
+
+        poly.metrics.format_stats() describes the result for users.
+        """
+        stats = self.metrics.stats()
+        stats['queries'] = self.query_stats()
+        if self.process != None:
+            stats['output'] = self.process.output_stats()
+        return stats
 
     def node_for_position(self, path, position):
         """Get the PolyNode at a given position.
@@ -209,29 +592,99 @@ class Poly:
         position -- a zero-indexed offset in the ml code last passed to
                     compile or compile_sync for path
 
-        returns a PolyNode object, or None
+        returns a PolyNode object, or None (also when the file's index is
+        from an earlier session, and does not cover the position)
         raises poly.process.Timeout if the request to Poly/ML times out
         raises poly.process.ProtocolError if communication with Poly/ML failed
         """
-        if path in self._parse_trees.keys():
-            node = PolyNode()
-            node.file_name = path
-            p = self.process.sync_request('O',
-                [self._parse_trees[path], position, position])
-            p.popcode('O')
-            p.pop() # ignire RID
-            p.popcode(',')
-            node.parse_tree = p.pop()
-            p.popcode(',')
-            node.start = p.popint()
-            p.popcode(',')
-            node.end = p.popint()
-            while p.popcode().code == ',':
-                node.commands.append(p.popstr())
-            return node
+        nodes = self.nodes_for_positions(path, [position])
+        if nodes == None:
+            return None
+        return nodes[0]
+
+    def nodes_for_positions(self, path, positions, timeout=2):
+        """Get the PolyNodes at several positions in a file.
+
+        Like node_for_position, but all the requests are sent to Poly/ML
+        at once, rather than waiting for each response in turn.
+
+        path -- the path of the file, as passed to compile or compile_sync
+        positions -- a list of zero-indexed offsets into the ml code
+        timeout -- (optional) the maximum time to wait for all the
+                   responses, in seconds (default: 2)
+
+        Returns a list of PolyNode objects, in the same order as positions,
+        or None if the file has not been compiled (or Poly/ML's parse tree
+        of it is out of date, and cannot be rebuilt while another
+        compilation is running).  If the file's index is
+        from an earlier session, the entries for positions it does not
+        cover (eg: whitespace and comments) are None, as Poly/ML has no
+        parse tree to ask.
+        raises poly.process.Timeout if the requests to Poly/ML time out
+        raises poly.process.ProtocolError if communication with Poly/ML failed
+        """
+        if not self._ensure_parse_tree(path, positions):
+            return None
+        tree = self._parse_trees.get(path, self._stored_trees.get(path))
+        if tree != None:
+            offset = self._tree_offsets.get(path, 0)
+            return self._query(
+                [('O', tree, pos) for pos in positions],
+                [('O', [tree, pos - offset, pos - offset]) for pos in positions],
+                lambda p: self._read_node_response(p, path),
+                timeout)
         else:
             return None
 
+    def _ensure_parse_tree(self, path, positions=[]):
+        """Makes sure Poly/ML has a parse tree for a file
+
+        If the last compilation of the file was answered from the compile
+        cache, it is sent to Poly/ML now, so that it can be queried.  So is
+        the whole file, if only part of it was compiled and any of positions
+        are before that part.
+
+        Returns False if that could not be done because another compilation
+        is running, so the parse tree Poly/ML has is for older code (and
+        must not be queried), and otherwise True.
+        """
+        lazy = self._lazy_compiles.get(path)
+        offset = self._tree_offsets.get(path, 0)
+        if lazy == None and [pos for pos in positions if pos < offset]:
+            lazy = self._partial_compiles.get(path)
+        if lazy == None:
+            return True
+        if self.compile_in_progress:
+            debug('Not querying the old parse tree of {0} while another '
+                  'compilation is running'.format(path))
+            return False
+        prelude, source, saved_state = lazy
+        debug('Compiling {0} to get its parse tree'.format(path))
+        key = self._cache_key(path, prelude, source, saved_state)
+        result_code, messages = self._compile_sync(path, prelude, source, 10,
+                                                   saved_state, key, False)
+        return result_code != None
+
+    def _read_node_response(self, p, path):
+        """Parses the response packet for an O request
+
+        Returns a PolyNode object.
+        """
+        node = PolyNode()
+        node.file_name = path
+        p.popcode('O')
+        p.pop() # ignire RID
+        p.popcode(',')
+        node.parse_tree = p.pop()
+        offset = self._tree_offsets.get(path, 0)
+        p.popcode(',')
+        node.start = p.popint() + offset
+        p.popcode(',')
+        node.end = p.popint() + offset
+        while p.popcode().code == ',':
+            node.commands.append(p.popstr())
+        return node
+
     def type_for_node(self, node):
         """Get the type of a PolyNode
 
@@ -246,15 +699,266 @@ class Poly:
         raises poly.process.Timeout if the request to Poly/ML times out
         raises poly.process.ProtocolError if communication with Poly/ML failed
         """
-        if node and 'T' in node.commands:
-            p = self.process.sync_request('T',
-                [node.parse_tree, node.start, node.end])
-            p.popcode('T')
-            for i in range(7): p.pop() # ignore info about the ident.
-            if p.popcode().code == ',':
-                return p.popstr().strip()
-            else:
+        return self.types_for_nodes([node])[0]
+
+    def types_for_nodes(self, nodes, timeout=2):
+        """Get the types of several PolyNodes.
+
+        Like type_for_node, but all the requests are sent to Poly/ML at
+        once, rather than waiting for each response in turn.
+
+        nodes -- a list of PolyNodes (entries may be None)
+        timeout -- (optional) the maximum time to wait for all the
+                   responses, in seconds (default: 2)
+
+        Returns a list of types (strings, or None), in the same order as
+        nodes.
+        raises poly.process.Timeout if the requests to Poly/ML time out
+        raises poly.process.ProtocolError if communication with Poly/ML failed
+        """
+        typed = [n for n in nodes if n and 'T' in n.commands]
+        results = self._query(
+            [('T', n.parse_tree, n.start, n.end) for n in typed],
+            [('T', self._node_args(n)) for n in typed],
+            self._read_type_response, timeout)
+        types = {}
+        for n, t in zip(typed, results):
+            types[id(n)] = t
+        return [types.get(id(n)) for n in nodes]
+
+    def _query(self, keys, requests, read_response, timeout):
+        """Sends requests to Poly/ML, unless their answers are indexed or
+        cached
+
+        keys -- the query cache key for each request; the parse tree id
+                must be its second element
+        requests -- a list of (code, args) pairs, as for batch_request()
+        read_response -- a function that parses a response packet
+
+        Returns a list of the parsed responses, in the same order as
+        requests.
+        """
+        results = []
+        for key in keys:
+            index = self._indexes.get(key[1])
+            result = _MISSING
+            if index != None:
+                result = index.get(key, _MISSING)
+            if result is _MISSING:
+                result = self._queries.get(key, _MISSING)
+            results.append(result)
+        missing = []
+        for i in range(len(results)):
+            if results[i] is _MISSING:
+                if keys[i][1] in self._stored_trees.values():
+                    # not a real parse tree, so Poly/ML can't answer
+                    results[i] = None
+                else:
+                    missing.append(i)
+        if missing:
+            packets = self.process.batch_request(
+                [requests[i] for i in missing], timeout)
+            for i, p in zip(missing, packets):
+                results[i] = read_response(p)
+                self._queries.put(keys[i], results[i])
+        return results
+
+    def _forget_queries(self, *parse_trees):
+        """Drops the cached query answers (and indexes) for parse trees"""
+        for parse_tree in parse_trees:
+            self._indexes.pop(parse_tree, None)
+        for key, value in self._queries.items():
+            if key[1] in parse_trees:
+                self._queries.pop(key)
+
+    def _start_index(self, file, source, offset):
+        """Starts indexing the parse tree for a file in the background"""
+        args = (self.process, file, self._parse_trees.get(file), source, offset)
+        thread = threading.Thread(target=self._build_index, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _build_index(self, process, file, tree, source, offset):
+        """Builds a PositionIndex for a parse tree
+
+        Asks Poly/ML for the node at every token in source (from offset),
+        then for the types and declarations of those nodes.  Gives up if
+        the file is compiled again or Poly/ML restarts in the meantime.
+        """
+        def batches(requests):
+            for i in range(0, len(requests), INDEX_BATCH_SIZE):
+                if (self.process is not process or
+                        self._parse_trees.get(file) != tree):
+                    raise ProtocolError('parse tree replaced')
+                batch = requests[i:i+INDEX_BATCH_SIZE]
+                for packet in process.batch_request(batch, 10):
+                    yield packet
+
+        start_time = time.time()
+        index = PositionIndex(file, tree)
+        tokens = token_ranges(source, offset)
+        try:
+            requests = [('O', [tree, s - offset, s - offset]) for s, e in tokens]
+            for (s, e), p in zip(tokens, batches(requests)):
+                index.add_node(s, e, self._read_node_response(p, file))
+
+            nodes = index.nodes()
+            typed = [n for n in nodes if 'T' in n.commands]
+            requests = [('T', self._node_args(n)) for n in typed]
+            for n, p in zip(typed, batches(requests)):
+                index.add_type(n, self._read_type_response(p))
+
+            declared = [n for n in nodes if 'I' in n.commands]
+            requests = [('I', self._node_args(n) + ['I']) for n in declared]
+            symbols = []
+            for n, p in zip(declared, batches(requests)):
+                location = self._read_declaration_response(p)
+                index.add_declaration(n, location)
+                name = source[n.start:n.end].strip()
+                if location != None and name:
+                    symbols.append((name, location))
+        except (ProtocolError, Timeout) as e:
+            debug('Gave up indexing {0}: {1}'.format(file, e))
+            return
+
+        if self.process is process and self._parse_trees.get(file) == tree:
+            self._indexes[tree] = index
+            self.symbols.update(file, symbols)
+            index_store = self._store_for(file)
+            if index_store != None:
+                index_store.put(file, store.content_hash(source),
+                                self._index_data(index, symbols))
+            debug('Indexed {0} nodes of {1} in {2:.2f}s'.format(
+                len(nodes), file, time.time() - start_time))
+
+    def _store_for(self, path):
+        """Returns the IndexStore for a file, or None if indexes are not
+        being kept on disk"""
+        if (not self.persistent_index or not store.available() or
+                not os.path.isabs(path)):
+            return None
+        store_path = store.store_path_for(path)
+        if not store_path in self._stores:
+            self._stores[store_path] = store.IndexStore(store_path)
+        return self._stores[store_path]
+
+    def _index_data(self, index, symbols):
+        """Converts an index, and the symbols found with it, to plain data
+        for an IndexStore (which keeps it as JSON)"""
+        def location_data(l):
+            if l == None:
+                return None
+            return (l.file_name, l.line, l.start, l.end,
+                    isinstance(l, PolyNode))
+        return {
+            'tokens': [(s, e, n.start, n.end, n.commands)
+                       for s, e, n in index.tokens()],
+            'types': [(start, end, type)
+                      for (start, end), type in index.types().items()],
+            'declarations': [(k, location_data(l))
+                             for k, l in index.declarations().items()],
+            'symbols': [(name, location_data(l)) for name, l in symbols],
+        }
+
+    def _index_from_data(self, path, tree, data):
+        """Rebuilds an index, and its symbols, from _index_data() output
+
+        tree -- the parse tree id to give the index and its nodes
+        """
+        def location(d):
+            if d == None:
                 return None
+            file_name, line, start, end, is_node = d
+            if is_node and file_name == path:
+                return PolyNode(file_name, start, end, tree)
+            return PolyLocation(file_name, line, start, end)
+        index = PositionIndex(path, tree)
+        nodes = {}
+        for s, e, start, end, commands in data['tokens']:
+            node = nodes.get((start, end))
+            if node == None:
+                node = PolyNode(path, start, end, tree, commands)
+                nodes[(start, end)] = node
+            index.add_node(s, e, node)
+        for start, end, type in data['types']:
+            index.add_type(nodes[(start, end)], type)
+        for (start, end), d in data['declarations']:
+            index.add_declaration(nodes[(start, end)], location(d))
+        symbols = [(name, location(d)) for name, d in data['symbols']]
+        return index, symbols
+
+    def load_stored_index(self, path, source):
+        """Loads the index of a file saved in an earlier session.
+
+        The index is only loaded if it was made from the same source.
+        Afterwards, has_built(path) is true, and queries about the file are
+        answered from the index (or return None, for positions it does not
+        cover) until it is compiled again.
+
+        path -- the path of the file
+        source -- the ML code in the file
+
+        Returns whether the file can now be queried.
+        """
+        if path in self._parse_trees.keys() or path in self._stored_trees.keys():
+            return True
+        index_store = self._store_for(path)
+        if index_store == None:
+            return False
+        data = index_store.get(path, store.content_hash(source))
+        if data == None:
+            return False
+        try:
+            symbols = self._add_stored_index(path, data)
+        except (KeyError, TypeError, ValueError):
+            # a damaged entry is the same as none
+            debug('Ignored the damaged stored index of {0}'.format(path))
+            return False
+        self.symbols.update(path, symbols)
+        debug('Loaded the stored index of {0}'.format(path))
+        return True
+
+    def _add_stored_index(self, path, data):
+        """Adds an index for a file Poly/ML has no parse tree for
+
+        Returns the symbols stored with the index.
+        """
+        tree = 'stored:' + path # never a Poly/ML parse tree id
+        index, symbols = self._index_from_data(path, tree, data)
+        self._indexes[tree] = index
+        self._stored_trees[path] = tree
+        return symbols
+
+    def _keep_indexes(self):
+        """Keeps the indexes of the files Poly/ML had parse trees for, when
+        it is about to be replaced
+
+        The indexes are still right for the code that was compiled, even
+        though their parse tree ids are not.
+        """
+        for path, tree in list(self._parse_trees.items()):
+            index = self._indexes.pop(tree, None)
+            if index != None:
+                self._add_stored_index(path, self._index_data(index, []))
+                self._tree_offsets.pop(path, None)
+        for tree in list(self._indexes.keys()):
+            if not tree in self._stored_trees.values():
+                del self._indexes[tree]
+
+    def _node_args(self, node):
+        """Returns the parse tree and range of a node, as Poly/ML knows them"""
+        offset = self._tree_offsets.get(node.file_name, 0)
+        return [node.parse_tree, node.start - offset, node.end - offset]
+
+    def _read_type_response(self, p):
+        """Parses the response packet for a T request
+
+        Returns a string giving the type, or None.
+        """
+        p.popcode('T')
+        for i in range(7): p.pop() # ignore info about the ident.
+        if p.popcode().code == ',':
+            return p.popstr().strip()
         else:
             return None
 
@@ -271,39 +975,81 @@ class Poly:
         This may be a PolyNode.
 
         Due to a shortcoming of Poly/ML, the location filename will not
-        include the path to the file (FIXME: need some way to specify
-        the search path?)
+        include the path to the file, unless a file with that name has
+        been indexed (FIXME: need some way to specify the search path?)
 
         raises poly.process.Timeout if the request to Poly/ML times out
         raises poly.process.ProtocolError if communication with Poly/ML failed
         """
-        if node and 'I' in node.commands:
-            p = self.process.sync_request('I',
-                [node.parse_tree, node.start, node.end, 'I'])
-
-            p.popcode('I')
-            for i in range(7): p.pop() # ignore info about the ident.
-            if p.popcode().code == ',':
-                file_name = p.popstr()
-                p.popcode(',')
-                line = p.popint()
-                p.popcode(',')
-                start = p.popint()
-                p.popcode(',')
-                end = p.popint()
-
-                if file_name in self._parse_trees.keys():
-                    if line:
-                        print('Got line number ({0}) for self-compiled file!'.format(line))
-                        return PolyLocation(file_name, line, start, end)
-                    else:
-                        return PolyNode(file_name, start, end, self._parse_trees[file_name])
-                else:
-                    return PolyLocation(file_name, line, start, end)
+        return self.declarations_for_nodes([node])[0]
+
+    def declarations_for_nodes(self, nodes, timeout=2):
+        """Get the declarations of several PolyNodes.
+
+        Like declaration_for_node, but all the requests are sent to Poly/ML
+        at once, rather than waiting for each response in turn.
+
+        nodes -- a list of PolyNodes (entries may be None)
+        timeout -- (optional) the maximum time to wait for all the
+                   responses, in seconds (default: 2)
+
+        Returns a list of PolyLocations (or None), in the same order as
+        nodes.
+        raises poly.process.Timeout if the requests to Poly/ML time out
+        raises poly.process.ProtocolError if communication with Poly/ML failed
+        """
+        declared = [n for n in nodes if n and 'I' in n.commands]
+        results = self._query(
+            [('I', n.parse_tree, n.start, n.end) for n in declared],
+            [('I', self._node_args(n) + ['I']) for n in declared],
+            self._read_declaration_response, timeout)
+        locations = {}
+        for n, l in zip(declared, results):
+            # Poly/ML only gives the file name for other files
+            locations[id(n)] = self.symbols.resolve(l)
+        return [locations.get(id(n)) for n in nodes]
+
+    def find_declarations(self, name):
+        """Find where an identifier is declared, in any indexed file.
+
+        This does not need the file the identifier is used in to have been
+        compiled in the current Poly/ML process, but only knows about the
+        declarations used in files indexed since the Poly object was
+        created (see the index option).
+
+        name -- the identifier, possibly qualified (eg: "List.map")
+
+        Returns a list of PolyLocations (which may be empty).
+        """
+        return self.symbols.lookup(name)
+
+    def _read_declaration_response(self, p):
+        """Parses the response packet for an I request
+
+        Returns a PolyLocation (possibly a PolyNode), or None.
+        """
+        p.popcode('I')
+        for i in range(7): p.pop() # ignore info about the ident.
+        if p.popcode().code == ',':
+            file_name = p.popstr()
+            p.popcode(',')
+            line = p.popint()
+            p.popcode(',')
+            start = p.popint()
+            p.popcode(',')
+            end = p.popint()
 
-                return dnode
+            if file_name in self._parse_trees.keys():
+                if line:
+                    debug('Got line number ({0}) for self-compiled file!'.format(line),
+                          DEBUG_FINE)
+                    return PolyLocation(file_name, line, start, end)
+                else:
+                    offset = self._tree_offsets.get(file_name, 0)
+                    return PolyNode(file_name, start + offset, end + offset,
+                                    self._parse_trees[file_name])
             else:
-                return None
+                return PolyLocation(file_name, line, start, end)
         else:
             return None
 
@@ -316,7 +1062,7 @@ class Poly:
         Poly/ML puts newlines into its messages; this allows us to strip
         them out.
         """
-        return self._clean_rexp.sub(' ', text.strip())
+        return _clean_text(text)
 
     def _pop_d_message(self, p):
         """Reads a D message from a Packet
@@ -342,31 +1088,27 @@ class Poly:
         """Reads some output, possibly including markup, up to (and including)
         the next occurrence of closing_code (which should be lower case)
 
-        Returns the output, and the last found location
+        Returns the last found location, and the output, with its parts
+        separated by spaces
         """
-        text = ''
+        parts = []
         location = None
         if not p.nextiscode():
-            text = p.popstr()
+            parts.append(p.popstr())
         code = p.popcode().code
         while code != closing_code:
             if code == 'D':
                 p.pushcode('D')
                 location,t = self._pop_d_message(p)
-                if len(text):
-                    text += ' '
-                text += t
+                parts.append(t)
             else:
                 p.popuntilcode(';')
-                text += ' ' + p.popstr().strip()
+                parts.append(p.popstr().strip())
                 p.popcode(code.lower())
             if not p.nextiscode():
-                if len(text):
-                    text += ' '
-                n = p.popstr()
-                text += n
+                parts.append(p.popstr())
             code = p.popcode().code
-        return location,text
+        return location,' '.join([t for t in parts if t])
 
     def _pop_compile_result_header(self, p, file):
         """Reads an R response and returns the result code as a string
@@ -379,7 +1121,11 @@ class Poly:
         p.popcode('R')  # pop off leading p code
         p.pop() # ignore RID
         p.popcode(',')
+        old_tree = self._parse_trees.get(file, self._stored_trees.pop(file, None))
         self._parse_trees[file] = p.pop() # save parse tree ID
+        # the answers for the file are out of date, even if Poly/ML gave the
+        # new parse tree the same id (or one an earlier process used)
+        self._forget_queries(old_tree, self._parse_trees[file])
         p.popcode(',')
         result_code = p.popstr()
         p.popcode(',')
@@ -403,18 +1149,41 @@ class Poly:
         exp.text = self._clean_text(message)
         return exp
 
-    def _pop_compile_error_messages(self, p):
-        """Reads the error list from an R response
+    def _iter_compile_messages(self, p, result_code, messages):
+        """Reads the messages in an R response, one at a time
 
         p -- a poly.process.Packet containing a compilation result block,
-             that has already had _pop_compile_result_header called on it (and
-             _pop_compile_exception_message if the result was 'X')
-
-        Returns a list of PolyErrorMessage objects.
+             that has already had _pop_compile_result_header called on it
+        result_code -- the result code from the header
+        messages -- a MessageList to add the messages to
+
+        Yields each PolyMessage as soon as it has been read.  Once
+        self.max_messages error messages have been read, the rest are not
+        read, just counted in messages.suppressed; an exception message
+        (result code 'X') does not count towards the limit.
+
+        This is internal: callers see the messages as they are read through
+        compile_messages(), or by passing on_message to compile() or
+        compile_sync().
         """
-        messages = []
+        if result_code == 'L':
+            location,text = self._pop_output_until_code(p, 'r')
+            # this clearly counts as an error
+            messages.append(PolyMessage('E', text))
+            yield messages[-1]
+            return
+        if result_code == 'X':
+            messages.append(self._pop_compile_exception_message(p))
+            yield messages[-1]
+        limit = self.max_messages
+        read = 0
         p.pop_until_nonempty()
         while p.popcode().code == 'E':
+            if limit != None and read >= limit:
+                # this one, and the ones after it
+                messages.suppressed = 1 + p.countcode('E')
+                break
+            read += 1
             message_code = p.popstr()
             p.popcode(',')
             file_name = p.popstr()
@@ -432,95 +1201,767 @@ class Poly:
 
             p.popempty()  # empty string between escape codes
 
-            text = self._clean_text(text)
-            messages.append(PolyErrorMessage(message_code, file_name, line, start_pos, end_pos, text))
-        return messages
+            messages.append(PolyErrorMessage(message_code, file_name, line,
+                                             start_pos, end_pos, text))
+            yield messages[-1]
+
+    def _saved_state_fingerprint(self, saved_state):
+        """Returns the path and mtime of a saved state, or None"""
+        if saved_state == None:
+            return None
+        try:
+            return (saved_state, os.path.getmtime(saved_state))
+        except OSError:
+            return None
+
+    def _saved_state_prelude(self, saved_state):
+        """Returns the ML code to load a saved state, if it is needed
+
+        The saved state is only loaded if it is not already loaded into the
+        current Poly/ML process, or the file has changed since it was
+        loaded.  Must be called after ensure_poly_running().
+
+        saved_state -- the path of the saved state, or None
+
+        The saved state only counts as loaded once the compilation has
+        run its prelude (see _compile_finished()).
+        """
+        self._next_loaded_state = self._loaded_state
+        loaded = self._saved_state_fingerprint(saved_state)
+        if loaded == None:
+            return ''
+        if loaded == self._loaded_state:
+            debug('Saved state {0} is already loaded'.format(saved_state))
+            return ''
+        self._next_loaded_state = loaded
+        return (_incremental.load_state_code(saved_state) +
+                'PolyML.fullGC ();\n')
+
+    def _compile_args(self, file, prelude, source, saved_state):
+        """Returns the arguments for an R request
+
+        Must be called after ensure_poly_running().
+        """
+        prelude = self._saved_state_prelude(saved_state) + prelude
+        return [file, 0, len(prelude), len(source), prelude, source]
+
+    def _prepare_compile(self, file, prelude, source, saved_state, partial):
+        """Returns the arguments for an R request, and the offset in source
+        of the code they compile
+
+        partial -- whether to compile only the changed part of source, if
+                   there is a checkpoint (or one can be made) for the rest
+
+        Must be called after ensure_poly_running().
+        """
+        if not self.incremental:
+            return self._compile_args(file, prelude, source, saved_state), 0
+
+        if self._checkpoints == None:
+            self._checkpoints = _incremental.Checkpoints()
+            atexit.register(self._checkpoints.remove_directory)
+        # checkpoints are children of the saved state, or of the state of a
+        # fresh Poly/ML process, so that loading that state undoes them
+        base = saved_state
+        base_id = self._saved_state_fingerprint(saved_state)
+        if base == None:
+            base = self._checkpoints.root()
+            # the root checkpoint never changes once it has been saved, so
+            # the checkpoints made from it are the same whether it has been
+            # saved yet or not
+            base_id = self._checkpoints.root_path()
+        make_root = ''
+        root_path = self._checkpoints.root_path()
+        if (base == None and self._clean_env and
+                not root_path in self._bad_prefixes):
+            make_root = _incremental.save_checkpoint_code(root_path)
+        else:
+            self._clean_env = False
+        # the environment stays clean until the save is known to have worked
+        self._saving_root = make_root != ''
+
+        plan = None
+        if partial:
+            plan = self._plan_partial_compile(file, prelude, source, base,
+                                              base_id)
+        if plan == None:
+            prelude = make_root + self._saved_state_prelude(base) + prelude
+            return [file, 0, len(prelude), len(source), prelude, source], 0
+        prelude, source, offset = plan
+        return [file, 0, len(prelude), len(source), prelude, source], offset
+
+    def _plan_partial_compile(self, file, prelude, source, base, base_id):
+        """Works out how much of a file needs compiling
+
+        base -- the saved state that checkpoints for the file build on, or
+                None if it has not been saved yet
+        base_id -- what identifies that saved state in the checkpoint keys
+
+        Returns (prelude, source, offset) for compiling the part of the file
+        after its checkpoint, or None if the whole file should be compiled.
+        The file's declarations are noted either way, so that the next
+        compilation can tell which are unchanged.
+        """
+        declarations = _incremental.split_declarations(source)
+        keys = _incremental.prefix_keys(repr((file, prelude, base_id)),
+                                        declarations)
+        stable = 0
+        previous = self._increments.get(file)
+        if previous != None:
+            old_keys, old_stable = previous[0], previous[1]
+            if keys == old_keys:
+                stable = old_stable
+            else:
+                n = min(len(keys), len(old_keys))
+                while stable + 1 < n and keys[stable + 1] == old_keys[stable + 1]:
+                    stable += 1
+        # always compile at least the last declaration, so there is a
+        # parse tree
+        stable = min(stable, len(declarations) - 1)
+        self._increments[file] = (keys, stable, stable)
+        if base == None or stable <= 0:
+            return None
+
+        # the checkpoint after the unchanged declarations, or if the first
+        # change is before the checkpoint used last time, the latest one
+        # before it (rather than making another)
+        first = stable
+        if previous != None and stable < previous[2]:
+            first = 1
+        for used in range(stable, first - 1, -1):
+            if keys[used] in self._bad_prefixes:
+                continue
+            checkpoint = self._checkpoints.get(keys[used])
+            if checkpoint != None:
+                self._increments[file] = (keys, stable, used)
+                offset = declarations[used][0]
+                debug('Compiling {0} from offset {1}'.format(file, offset))
+                self._next_loaded_state = self._saved_state_fingerprint(
+                    checkpoint)
+                return (prelude + _incremental.load_state_code(checkpoint),
+                        source[offset:], offset)
+        if keys[stable] in self._bad_prefixes:
+            return None
+
+        # compile the unchanged declarations as part of the prelude, and
+        # save a checkpoint after them for next time
+        offset = declarations[stable][0]
+        debug('Making a checkpoint of {0} at offset {1}'.format(file, offset))
+        path = self._checkpoints.add(keys[stable])
+        prelude = (self._saved_state_prelude(base) + prelude +
+                   source[:offset] + '\n;\n' +
+                   _incremental.save_checkpoint_code(path))
+        self._next_loaded_state = None
+        return prelude, source[offset:], offset
+
+    def _root_save_failed(self):
+        """Whether the compilation that just finished was meant to save the
+        root checkpoint, and did not"""
+        return self._saving_root and self._checkpoints.root() == None
+
+    def _partial_compile_failed(self, file):
+        """Stops using the checkpoint for a file (or trying to save the root
+        checkpoint) after its prelude failed"""
+        self._loaded_state = None
+        if self._saving_root:
+            # the save comes first in the prelude, so nothing else ran
+            self._saving_root = False
+            self._bad_prefixes.add(self._checkpoints.root_path())
+            debug('Could not save the root checkpoint; compiling whole files',
+                  DEBUG_WARN)
+            return
+        keys, stable, used = self._increments.pop(file)
+        self._bad_prefixes.add(keys[used])
+        self._checkpoints.discard(keys[used])
+        debug('Checkpoint for {0} failed; compiling all of it'.format(file))
+
+    def _shift_message(self, file, message, offset):
+        """Moves a message location in part of a file to the whole file"""
+        location = message.location
+        if (location != None and location.file_name == file and
+                location.line == None):
+            location.start += offset
+            location.end += offset
+
+    def _cache_key(self, file, prelude, source, saved_state):
+        """Returns the compile cache key for a compilation, or None if
+        there is no compile cache"""
+        if self.compile_cache == None:
+            return None
+        return self.compile_cache.key(file, prelude, source,
+                                      self._saved_state_fingerprint(saved_state))
+
+    def _cached_result(self, file, prelude, source, saved_state):
+        """Looks up a compilation in the compile cache
 
-    def _read_compile_response(self, p, file):
+        Returns the cache key (or None if there is no cache) and the cached
+        result (or None).
+        """
+        key = self._cache_key(file, prelude, source, saved_state)
+        if key == None:
+            return None, None
+        result = self._result_from_data(self.compile_cache.get(key))
+        if result != None and self._tree_keys.get(file) != key:
+            # Poly/ML's parse tree is for different code
+            self._lazy_compiles[file] = (prelude, source, saved_state)
+        return key, result
+
+    def _result_data(self, result_code, messages):
+        """Converts the result of a compilation to plain data for the
+        compile cache (which may keep it as JSON)
+
+        Only the results of compilations that finished ('S' and 'F') are
+        cached, and their messages are all PolyErrorMessages.
+        """
+        return [result_code, messages.suppressed,
+                [[m.message_code, m.location.file_name, m.location.line,
+                  m.location.start, m.location.end, m.raw_text]
+                 for m in messages]]
+
+    def _result_from_data(self, data):
+        """Rebuilds a (result code, MessageList) pair from _result_data()
+        output, or returns None if there is none (or it is damaged)"""
+        if data == None:
+            return None
+        try:
+            result_code, suppressed, message_data = data
+            messages = MessageList([PolyErrorMessage(*m) for m in message_data],
+                                   suppressed)
+        except (TypeError, ValueError):
+            return None
+        return result_code, messages
+
+    def _compile_finished(self, file, key, result_code, messages, offset=0,
+                          compiled=None):
+        """Updates our state after a compilation
+
+        offset -- where the compiled code started in the file
+        compiled -- the (prelude, source, saved_state) of the whole file,
+                    used to compile all of it if only part was compiled,
+                    and to index it
+        """
+        if self._saving_root:
+            self._saving_root = False
+            self._clean_env = False
+            if self._checkpoints.root() == None:
+                debug('Could not save the root checkpoint', DEBUG_WARN)
+        if result_code in ('S', 'F', 'X'):
+            # the prelude ran, so loaded any saved state it was given
+            self._loaded_state = self._next_loaded_state
+        elif (result_code == 'L' or
+                self._next_loaded_state != self._loaded_state):
+            # the prelude failed (or was cancelled while it may have been
+            # loading a state), so we don't know what state it left
+            self._loaded_state = None
+        self._tree_offsets[file] = offset
+        if offset:
+            self._partial_compiles[file] = compiled
+        else:
+            self._partial_compiles.pop(file, None)
+        self._lazy_compiles.pop(file, None)
+        if self.index and result_code == 'S' and compiled != None:
+            self._start_index(file, compiled[1], offset)
+        if key != None:
+            self._tree_keys[file] = key
+            # other results can depend on more than the code
+            if result_code in ('S', 'F'):
+                self.compile_cache.put(key, self._result_data(result_code,
+                                                              messages))
+
+    def _read_compile_response(self, p, file, offset=0, on_message=None):
         """Parses the response packet for a compilation
 
         p -- a poly.process.Packet containing a compilation result block
         file -- the file name for the compilation
+        offset -- (optional) where the compiled code started in the file
+        on_message -- (optional) a function to call with each message as
+                      soon as it has been read
 
         Returns a pair of result code (a single-character string) and
-        a list of PolyMessage objects.
+        a MessageList.
         """
+        t = trace.start()
         result_code = self._pop_compile_result_header(p, file)
-        messages = []
-        if result_code == 'L':
-            location,text = self._pop_output_until_code(p, 'r')
-            # this clearly counts as an error
-            messages = [PolyMessage('E', text)]
-        else:
-            if result_code == 'X':
-                messages = [self._pop_compile_exception_message(p)]
-            messages += self._pop_compile_error_messages(p)
+        if result_code == 'L' and (offset or self._root_save_failed()):
+            # it will be compiled again (see _partial_compile_failed()), so
+            # this failure is not reported
+            on_message = None
+        messages = MessageList()
+        for message in self._iter_compile_messages(p, result_code, messages):
+            self._shift_message(file, message, offset)
+            if on_message != None:
+                on_message(message)
+        trace.end(t, 'parse', 'R', {'file': file, 'messages': len(messages),
+                                    'suppressed': messages.suppressed})
         return result_code, messages
 
-    def compile_sync(self, file, prelude, source, timeout=10):
+    def compile_sync(self, file, prelude, source, timeout=10, saved_state=None,
+                     on_message=None):
         """Sends ML code for compilation, and waits for the result
 
         file -- the file name for the compilation
         prelude -- ML code to set up the compilation state (eg:
-                   loading a saved state)
+                   changing directory)
         source -- the ML code to compile
         timeout -- (optional) how long to wait, in seconds (default: 10)
+        saved_state -- (optional) the path of a Poly/ML saved state to load
+                       before the prelude; see compile()
+        on_message -- (optional) a function to call with each message as
+                      soon as it has been read; see compile()
 
         Returns a pair of result code (a single-character string) and
-        a list of PolyMessage objects.  If the result code is 'X', the
-        first will be a PolyException and the remainder PolyErrorMessage
-        objects, otherwise they will all be PolyErrorMessage objects.
+        a MessageList of PolyMessage objects.  If the result code is 'X',
+        the first will be a PolyException and the remainder
+        PolyErrorMessage objects, otherwise they will all be
+        PolyErrorMessage objects.
+
+        If the code is in the compile cache, the cached result is returned
+        without sending anything to Poly/ML.
         """
-        if self.compile_in_progress:
-            return None,[]
+        key, result = self._cached_result(file, prelude, source, saved_state)
+        if result != None:
+            self._replay_messages(result[1], on_message)
+            return result
+        return self._compile_sync(file, prelude, source, timeout, saved_state,
+                                  key, True, on_message)
 
-        self.ensure_poly_running()
-        p = self.process.sync_request('R',
-                                      [file, 0, len(prelude), len(source), prelude, source],
-                                      timeout)
-        return self._read_compile_response(p, file)
+    def compile_messages(self, file, prelude, source, timeout=10,
+                         saved_state=None, result=None):
+        """Compiles ML code, and yields the messages as they are read
 
+        file -- the file name for the compilation
+        prelude -- ML code to set up the compilation state
+        source -- the ML code to compile
+        timeout -- (optional) how long to wait for the compilation to
+                   finish, in seconds (default: 10); None means wait
+                   indefinitely
+        saved_state -- (optional) the path of a Poly/ML saved state to load
+                       before the prelude; see compile()
+        result -- (optional) a list to add the result code and MessageList
+                  to, as compile_sync() returns them, once the compilation
+                  has finished
+
+        A generator: each PolyMessage is yielded as soon as it has been
+        read from Poly/ML's response (the same ones on_message is called
+        with; see compile()), so the first errors of a long response can be
+        shown before the rest has been read.  If the compilation could not
+        be run, the messages saying why are yielded once it has finished.
+
+        Raises poly.process.Timeout if the compilation has not finished
+        after timeout seconds.
+        """
+        ready = threading.Condition()
+        read = []
+        finished = []
+        def on_message(message):
+            ready.acquire()
+            read.append(message)
+            ready.notify()
+            ready.release()
+        def handler(result_code, messages):
+            ready.acquire()
+            finished.append((result_code, messages))
+            ready.notify()
+            ready.release()
+        if self.compile(file, prelude, source, handler, saved_state,
+                        on_message) == -1:
+            # another compilation is in progress (see compile_sync())
+            finished.append((None, MessageList()))
+        end = None
+        if timeout != None:
+            end = time.time() + timeout
+        yielded = 0
+        while True:
+            ready.acquire()
+            try:
+                while yielded == len(read) and not finished:
+                    if end == None:
+                        ready.wait()
+                    elif time.time() >= end:
+                        raise Timeout()
+                    else:
+                        ready.wait(end - time.time())
+                new = read[yielded:]
+                done = finished[:]
+            finally:
+                ready.release()
+            for message in new:
+                yield message
+            yielded += len(new)
+            if done and yielded == len(read):
+                break
+        result_code, messages = done[0]
+        if result_code == None:
+            for message in messages:
+                yield message
+        if result != None:
+            result.extend([result_code, messages])
+
+    def _replay_messages(self, messages, on_message):
+        """Passes cached messages to an on_message function, if there is
+        one"""
+        if on_message != None:
+            for message in messages:
+                on_message(message)
+
+    def _compile_sync(self, file, prelude, source, timeout, saved_state, key,
+                      partial, on_message=None):
+        if self.compile_in_progress:
+            return None,MessageList()
 
-    def compile(self, file, prelude, source, handler):
+        self.ensure_poly_running()
+        args, offset = self._prepare_compile(file, prelude, source,
+                                             saved_state, partial)
+        p = self.process.sync_request('R', args, timeout)
+        result_code,messages = self._read_compile_response(p, file, offset,
+                                                           on_message)
+        if result_code == 'L' and (offset or self._root_save_failed()):
+            self._partial_compile_failed(file)
+            return self._compile_sync(file, prelude, source, timeout,
+                                      saved_state, key, False, on_message)
+        self._compile_finished(file, key, result_code, messages, offset,
+                               (prelude, source, saved_state))
+        return result_code,messages
+
+
+    def compile(self, file, prelude, source, handler, saved_state=None,
+                on_message=None):
         """Sends ML code for compilation
 
         file -- the file name for the compilation
         prelude -- ML code to set up the compilation state (eg:
-                   loading a saved state)
+                   changing directory)
         source -- the ML code to compile
         handler -- a method to call when the compilation has finished
+        saved_state -- (optional) the path of a Poly/ML saved state to load
+                       before the prelude (see polysave_for())
+        on_message -- (optional) a function to call with each PolyMessage
+                      as soon as it has been read, before the handler is
+                      called
 
-        The handler will be passed two arguments: the result code (a
-        single-character string) and a list of PolyMessage objects.  If the
-        result code is 'X', the first will be a PolyException and the remainder
-        PolyErrorMessage objects, otherwise they will all be PolyErrorMessage
-        objects.
+        Loading a saved state (and the garbage collection that follows it)
+        is slow, so it is only done when the saved state is not already
+        loaded into the Poly/ML process, or has changed since it was.
 
-        Returns the request ID (an integer).
+        The handler will be passed two arguments: the result code (a
+        single-character string) and a MessageList of PolyMessage objects.
+        If the result code is 'X', the first will be a PolyException and the
+        remainder PolyErrorMessage objects, otherwise they will all be
+        PolyErrorMessage objects.  At most self.max_messages error messages
+        are read (not counting the exception); the suppressed attribute of
+        the list says how many more there were.
+
+        on_message (or compile_messages(), which yields the same messages
+        to a loop) is the way to show messages while a long compilation
+        response is still being read.  It is called with the same objects
+        that end up in the MessageList, in order, on the thread that reads
+        Poly/ML's output (or, for a cached result, the thread the handler
+        is called on).  It is not called for the failed first attempt at a
+        compilation that is retried in full (see incremental).
+
+        If the code is in the compile cache, the cached result is passed to
+        the handler (on another thread) without sending anything to Poly/ML.
+
+        Returns the request ID (an integer), -1 if another compilation is
+        in progress, or None if the result came from the compile cache.
         """
+        key, result = self._cached_result(file, prelude, source, saved_state)
+        if result != None:
+            def run_cached():
+                self._replay_messages(result[1], on_message)
+                handler(*result)
+            threading.Thread(target=run_cached).start()
+            return None
+
         if self.compile_in_progress:
             return -1
 
         self.ensure_poly_running()
         self.compile_in_progress = True
 
-        def run_handler(p):
-            self.compile_in_progress = False
-            result_code,messages = self._read_compile_response(p, file)
-            handler(result_code, messages)
+        def send(partial):
+            args, offset = self._prepare_compile(file, prelude, source,
+                                                 saved_state, partial)
+            def run_handler(p):
+                result_code,messages = self._read_compile_response(
+                    p, file, offset, on_message)
+                if result_code == 'L' and (offset or
+                                           self._root_save_failed()):
+                    self._partial_compile_failed(file)
+                    if not self._compile_cancelled():
+                        send(False)
+                        return
+                    # cancelled before it could be sent again
+                    result_code, messages = 'C', MessageList()
+                self._compile_ended()
+                self.compile_in_progress = False
+                self._compile_finished(file, key, result_code, messages,
+                                       offset, (prelude, source, saved_state))
+                handler(result_code, messages)
+            def check_failed(f):
+                # eg: Poly/ML exited, so run_handler will never be called
+                if f.exception() != None:
+                    self._compile_ended()
+                    self.compile_in_progress = False
+                    handler(None, MessageList([PolyMessage('E',
+                        'Compilation failed: ' + str(f.exception()))]))
+            # held until the request id is noted, which run_handler waits
+            # for if the response is quick
+            self._compile_lock.acquire()
+            try:
+                f = self.process.send_request('R', args, run_handler)
+                if self._compile_rids == None:
+                    self._compile_rids = [f.rid, f.rid, False]
+                else:
+                    self._compile_rids[1] = f.rid
+            finally:
+                self._compile_lock.release()
+            f.add_done_callback(check_failed)
+            return f
+
+        return send(self.incremental).rid
+
+    def _compile_cancelled(self):
+        """Whether the compilation in progress has been cancelled"""
+        self._compile_lock.acquire()
+        try:
+            return self._compile_rids != None and self._compile_rids[2]
+        finally:
+            self._compile_lock.release()
+
+    def _compile_ended(self):
+        """Forgets the request ids of the compilation in progress"""
+        self._compile_lock.acquire()
+        try:
+            self._compile_rids = None
+        finally:
+            self._compile_lock.release()
+
+    def cancel_compile(self, rid, file=None):
+        """Cancels a compilation in progress
+
+        rid -- the request id, as returned by compile()
+        file -- (optional) the file being compiled; only needed by PolyPool
+
+        Poly/ML will stop the compilation, and its handler will be called
+        with the result code 'C'.  This works even if the compilation has
+        been sent to Poly/ML again, as a new request.
+        """
+        self._compile_lock.acquire()
+        try:
+            if self._compile_rids != None and self._compile_rids[0] == rid:
+                self._compile_rids[2] = True
+                rid = self._compile_rids[1]
+        finally:
+            self._compile_lock.release()
+        self.process.send_request('K', [rid])
+
+class PolyPool:
+    """A pool of Poly instances, each with its own Poly/ML process.
+
+    poly_bin -- the path to the Poly/ML binary
+    size -- the number of Poly/ML processes
+    workers -- the Poly instances in the pool
+
+    Each file is given to a worker when it is first compiled, and all later
+    compilations and queries for that file go to the same worker, so parse
+    tree ids are only ever sent to the process that created them.  Files
+    on different workers are compiled in parallel.
 
-        rid = self.process.send_request('R',
-                [file, 0, len(prelude), len(source), prelude, source],
-                run_handler)
+    PolyPool has the same methods as Poly, so it can be used in its place.
+    """
+
+    def __init__(self, poly_bin='poly', size=2, spare=False, compile_cache=None,
+                 incremental=False, index=False, persistent_index=False,
+                 max_messages=MAX_MESSAGES):
+        self.poly_bin = poly_bin
+        self.size = size
+        self.compile_cache = compile_cache
+        self.workers = [Poly(poly_bin, spare, compile_cache, incremental, index,
+                             persistent_index, max_messages)
+                        for i in range(size)]
+        # the workers share one symbol index
+        self.symbols = SymbolIndex()
+        for worker in self.workers:
+            worker.symbols = self.symbols
+        # and one set of metrics and output subscribers
+        self.metrics = Metrics()
+        self.output_subscribers = []
+        for worker in self.workers:
+            worker.metrics = self.metrics
+            worker.output_subscribers = self.output_subscribers
+        self._assignments = {}
+        self._lock = threading.Lock()
+
+    def worker_for(self, path):
+        """Get the worker that handles a file, assigning one if necessary.
+
+        New files go to an idle worker with the fewest files, if there is
+        one, and otherwise to the worker with the fewest files.
+
+        Returns a Poly object.
+        """
+        self._lock.acquire()
+        try:
+            if not path in self._assignments:
+                load = dict([(id(w), 0) for w in self.workers])
+                for w in self._assignments.values():
+                    load[id(w)] += 1
+                self._assignments[path] = min(self.workers,
+                    key=lambda w: (w.compile_in_progress, load[id(w)]))
+            return self._assignments[path]
+        finally:
+            self._lock.release()
+
+    def start(self):
+        """Starts all the Poly/ML processes now (see Poly.start)."""
+        for worker in self.workers:
+            worker.start()
+
+    def query_stats(self):
+        """Returns the query cache statistics (see Poly.query_stats),
+        added up over the workers."""
+        stats = {'size': 0, 'entries': 0, 'hits': 0, 'misses': 0}
+        for worker in self.workers:
+            for name, value in worker.query_stats().items():
+                stats[name] += value
+        return stats
+
+    def subscribe_output(self, fn=None, interval=None, limit=None):
+        """Passes on what the code being compiled by any worker prints (see
+        Poly.subscribe_output)."""
+        # the workers share the list of subscribers
+        return self.workers[0].subscribe_output(fn, interval, limit)
+
+    def unsubscribe_output(self, subscription):
+        """Stops passing on output to a subscription."""
+        self.workers[0].unsubscribe_output(subscription)
+
+    def stats(self):
+        """Returns the request metrics for all the workers (see Poly.stats)."""
+        stats = self.metrics.stats()
+        stats['queries'] = self.query_stats()
+        for worker in self.workers:
+            if worker.process == None:
+                continue
+            output = worker.process.output_stats()
+            if not 'output' in stats:
+                stats['output'] = output
+                continue
+            for stream in output:
+                for name, value in output[stream].items():
+                    stats['output'][stream][name] += value
+        return stats
+
+    def _worker_for_node(self, node):
+        return self._assignments.get(node.file_name)
+
+    def has_built(self, path):
+        """Return whether a file has been compiled."""
+        worker = self._assignments.get(path)
+        return worker != None and worker.has_built(path)
+
+    def node_for_position(self, path, position):
+        """Get the PolyNode at a given position (see Poly.node_for_position)."""
+        worker = self._assignments.get(path)
+        if worker == None:
+            return None
+        return worker.node_for_position(path, position)
 
-        return rid
+    def nodes_for_positions(self, path, positions, timeout=2):
+        """Get the PolyNodes at several positions (see Poly.nodes_for_positions)."""
+        worker = self._assignments.get(path)
+        if worker == None:
+            return None
+        return worker.nodes_for_positions(path, positions, timeout)
 
-    def cancel_compile(self, rid):
+    def type_for_node(self, node):
+        """Get the type of a PolyNode (see Poly.type_for_node)."""
+        worker = node and self._worker_for_node(node)
+        if worker == None:
+            return None
+        return worker.type_for_node(node)
+
+    def types_for_nodes(self, nodes, timeout=2):
+        """Get the types of several PolyNodes (see Poly.types_for_nodes).
+
+        The requests for nodes from files on different workers are sent
+        to each worker together.
+        """
+        return self._map_by_worker(nodes,
+            lambda worker, ns: worker.types_for_nodes(ns, timeout))
+
+    def declaration_for_node(self, node):
+        """Get the declaration of a PolyNode (see Poly.declaration_for_node)."""
+        worker = node and self._worker_for_node(node)
+        if worker == None:
+            return None
+        return worker.declaration_for_node(node)
+
+    def declarations_for_nodes(self, nodes, timeout=2):
+        """Get the declarations of several PolyNodes (see
+        Poly.declarations_for_nodes)."""
+        return self._map_by_worker(nodes,
+            lambda worker, ns: worker.declarations_for_nodes(ns, timeout))
+
+    def _map_by_worker(self, nodes, fn):
+        groups = {}
+        for i, node in enumerate(nodes):
+            worker = node and self._worker_for_node(node)
+            if worker != None:
+                groups.setdefault(id(worker), (worker, []))[1].append(i)
+        results = [None] * len(nodes)
+        for worker, indices in groups.values():
+            for i, r in zip(indices, fn(worker, [nodes[i] for i in indices])):
+                results[i] = r
+        return results
+
+    def find_declarations(self, name):
+        """Find where an identifier is declared (see Poly.find_declarations)."""
+        return self.symbols.lookup(name)
+
+    def load_stored_index(self, path, source):
+        """Loads the stored index of a file (see Poly.load_stored_index)."""
+        return self.worker_for(path).load_stored_index(path, source)
+
+    def compile_sync(self, file, prelude, source, timeout=10, saved_state=None,
+                     on_message=None):
+        """Compiles ML code and waits for the result (see Poly.compile_sync)."""
+        return self.worker_for(file).compile_sync(file, prelude, source,
+                                                  timeout, saved_state,
+                                                  on_message)
+
+    def compile_messages(self, file, prelude, source, timeout=10,
+                         saved_state=None, result=None):
+        """Compiles ML code, and yields the messages as they are read (see
+        Poly.compile_messages)."""
+        return self.worker_for(file).compile_messages(file, prelude, source,
+                                                      timeout, saved_state,
+                                                      result)
+
+    def compile(self, file, prelude, source, handler, saved_state=None,
+                on_message=None):
+        """Sends ML code for compilation (see Poly.compile).
+
+        Returns the request ID (an integer), which is only unique for the
+        worker handling file; pass both to cancel_compile().
+        """
+        return self.worker_for(file).compile(file, prelude, source, handler,
+                                             saved_state, on_message)
+
+    def cancel_compile(self, rid, file):
         """Cancels a compilation in progress
 
         rid -- the request id, as returned by compile()
+        file -- the file being compiled
+
+        Request ids are only unique for each worker, so unlike
+        Poly.cancel_compile, the file is needed to find the worker the
+        cancellation is for.
         """
-        self.process.send_request('K', [rid])
+        worker = self._assignments.get(file)
+        if worker != None:
+            worker.cancel_compile(rid)
 
 def translate_result_code(code):
     """Returns a human-readable description of a compilation result code"""
@@ -0,0 +1,228 @@
+import asyncio
+from asyncio.subprocess import PIPE, DEVNULL
+from . import Poly
+from .process import (Packet, PacketTokenizer, ProtocolError, Timeout,
+                      format_request, NO_RESPONSE, debug, DEBUG_INFO, DEBUG_WARN,
+                      DEBUG_FINE, READ_CHUNK_SIZE, PROTOCOL_ENCODING)
+
+"""Access to Poly/ML's IDE integration from asyncio programs
+
+AsyncPoly has the same queries as poly.Poly, but they are coroutines, and
+there are no threads involved: responses are read by a task on the event
+loop, and each request is an asyncio future.  Any number of callers can be
+waiting on the same Poly/ML process at once.
+
+This module needs Python 3.5 or later.
+"""
+
+class AsyncPolyProcess:
+    """Controls a Poly/ML process from an asyncio event loop.
+
+    poly_bin -- (optional) the path to the Poly/ML binary
+
+    The process is not started until start() is awaited.
+    """
+
+    def __init__(self, poly_bin='/usr/local/bin/poly'):
+        self.poly_bin = poly_bin
+        self.request_id = 0
+        self.proc = None
+        self._pending = {}
+        self._handshake = None
+        self._reader = None
+
+    async def start(self):
+        """Start Poly/ML, and wait for it to be ready for requests.
+
+        Raises a ProtocolError if Poly/ML could not be run.
+        """
+        debug("executing '%s'" % self.poly_bin, DEBUG_INFO)
+        try:
+            self.proc = await asyncio.create_subprocess_exec(
+                self.poly_bin, '--ideprotocol',
+                stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+        except OSError:
+            raise ProtocolError('Could not run Poly/ML')
+        loop = asyncio.get_event_loop()
+        self._handshake = loop.create_future()
+        self._reader = loop.create_task(self._read_responses())
+        await self._handshake
+
+    def is_alive(self):
+        """Whether Poly/ML is running."""
+        return self.proc != None and self.proc.returncode == None
+
+    def kill(self):
+        """Kills Poly/ML."""
+        if self.is_alive():
+            self.proc.terminate()
+
+    async def _read_responses(self):
+        tokenizer = PacketTokenizer(PROTOCOL_ENCODING)
+        try:
+            while True:
+                chunk = await self.proc.stdout.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                for packet in tokenizer.feed(chunk):
+                    self._dispatch(packet)
+        finally:
+            error = ProtocolError('Poly/ML closed its output')
+            if not self._handshake.done():
+                self._handshake.set_exception(error)
+            for f in self._pending.values():
+                if not f.done():
+                    f.set_exception(error)
+            self._pending = {}
+
+    def _dispatch(self, packet):
+        if not self._handshake.done():
+            packet.popcode('H')
+            debug('Running Poly/ML, protocol version: ' + packet.popstr(), DEBUG_INFO)
+            packet.popcode('h')
+            self._handshake.set_result(None)
+        elif packet.is_response():
+            rid = int(packet.peek(1))
+            debug('RID: {0}'.format(rid), DEBUG_FINE)
+            f = self._pending.pop(rid, None)
+            if f == None:
+                debug('RID has no handlers!', DEBUG_WARN)
+            elif not f.done():
+                f.set_result(packet)
+
+    def send_request(self, code, args):
+        """Send a request to Poly/ML.
+
+        code -- the request code (a single letter)
+        args -- a list of arguments (strings)
+
+        Returns an asyncio future for the response Packet; its rid attribute
+        is the id of the request.  Requests that Poly/ML does not respond to
+        (see NO_RESPONSE) are not waited for: their futures are done, with
+        an empty Packet, straight away.
+        """
+        if not self.is_alive():
+            raise ProtocolError('Poly/ML is not running')
+        f = asyncio.get_event_loop().create_future()
+        f.rid = self.request_id
+        self.request_id += 1
+        if code.upper() in NO_RESPONSE:
+            f.set_result(Packet())
+        else:
+            self._pending[f.rid] = f
+        self.proc.stdin.write(
+            format_request(f.rid, code, args).encode('utf-8'))
+        return f
+
+    async def request(self, code, args, timeout=2):
+        """Send a request to Poly/ML and wait for the response.
+
+        code -- the request code (a single letter)
+        args -- a list of arguments (strings)
+        timeout -- (optional) the maximum time to wait for a response, in
+                   seconds (default: 2); pass None to wait indefinitely
+
+        Returns a Packet object.
+        Raises a Timeout exception if no response was received after timeout
+        seconds.
+        """
+        f = self.send_request(code, args)
+        await self.proc.stdin.drain()
+        try:
+            return await asyncio.wait_for(f, timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(f.rid, None)
+            debug("Request timed out", DEBUG_INFO)
+            raise Timeout()
+
+class AsyncPoly(Poly):
+    """A version of Poly whose queries are coroutines.
+
+    poly_bin -- the path to the Poly/ML binary
+
+    Responses are parsed in exactly the same way as Poly does.  Unlike
+    Poly.compile, compile() does not refuse work while another compilation
+    is running: compilations are queued and run one at a time.
+    """
+
+    def __init__(self, poly_bin='poly'):
+        Poly.__init__(self, poly_bin)
+        self._compile_lock = asyncio.Lock()
+        self._start_lock = asyncio.Lock()
+
+    async def ensure_poly_running(self):
+        """Starts the Poly/ML process if it is not already running."""
+        async with self._start_lock:
+            if self.process == None or not self.process.is_alive():
+                # reset state, in case poly just died
+                self._parse_trees = {}
+                self._loaded_state = None
+                process = AsyncPolyProcess(self.poly_bin)
+                await process.start()
+                self.process = process
+
+    async def compile(self, file, prelude, source, timeout=None, saved_state=None):
+        """Compiles ML code, as Poly.compile_sync does.
+
+        file -- the file name for the compilation
+        prelude -- ML code to set up the compilation state
+        source -- the ML code to compile
+        timeout -- (optional) how long to wait, in seconds; None (the
+                   default) means wait indefinitely
+        saved_state -- (optional) the path of a Poly/ML saved state to
+                       load, if it is not loaded already
+
+        Returns a pair of result code and a list of PolyMessage objects.
+        """
+        async with self._compile_lock:
+            await self.ensure_poly_running()
+            self.compile_in_progress = True
+            try:
+                p = await self.process.request('R',
+                    self._compile_args(file, prelude, source, saved_state),
+                    timeout)
+            finally:
+                self.compile_in_progress = False
+            result_code, messages = self._read_compile_response(p, file)
+            self._compile_finished(file, None, result_code, messages)
+            return result_code, messages
+
+    async def node_for_position(self, path, position, timeout=2):
+        """Get the PolyNode at a given position (see Poly.node_for_position)."""
+        if path in self._parse_trees.keys():
+            p = await self.process.request('O',
+                [self._parse_trees[path], position, position], timeout)
+            return self._read_node_response(p, path)
+        else:
+            return None
+
+    async def type_for_node(self, node, timeout=2):
+        """Get the type of a PolyNode (see Poly.type_for_node)."""
+        if node and 'T' in node.commands:
+            p = await self.process.request('T',
+                [node.parse_tree, node.start, node.end], timeout)
+            return self._read_type_response(p)
+        else:
+            return None
+
+    async def declaration_for_node(self, node, timeout=2):
+        """Get the declaration of a PolyNode (see Poly.declaration_for_node)."""
+        if node and 'I' in node.commands:
+            p = await self.process.request('I',
+                [node.parse_tree, node.start, node.end, 'I'], timeout)
+            return self._read_declaration_response(p)
+        else:
+            return None
+
+    async def cancel_compile(self, rid):
+        """Cancels a compilation in progress
+
+        rid -- the request id of the compilation
+        """
+        self.process.send_request('K', [rid])
+        await self.process.proc.stdin.drain()
+
+    def kill(self):
+        """Kills the Poly/ML process, if it is running."""
+        if self.process != None:
+            self.process.kill()
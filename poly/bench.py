@@ -0,0 +1,215 @@
+import os
+import sys
+import time
+import json
+import platform
+import threading
+from . import process
+from . import fakepoly
+from .process import (PacketListener, PacketTokenizer, PolyProcess,
+                      ListenerKilled)
+
+"""Micro-benchmarks for the poly package
+
+These do not need a Poly/ML binary; they either feed canned protocol data
+through the parts of the package being measured, or talk to the stand-in
+server in poly.fakepoly.  Run them with
+
+    python -m poly.bench [results.json]
+
+to print the results, and optionally save them as JSON for comparing
+versions of the package.
+"""
+
+# the stand-in for the Poly/ML binary
+FAKE_POLY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fakepoly.py')
+
+def compile_response(rid, n_errors, text='Type error in function application.'):
+    """Returns the bytes Poly/ML would send for a failed compilation
+
+    rid -- the request id the response is for
+    n_errors -- how many error messages to include
+    text -- the text of each error message
+    """
+    errors = [('bench.ML', i * 10, i * 10 + 5, text) for i in range(n_errors)]
+    return fakepoly.compile_response(rid, rid + 100, 'F', n_errors * 10, errors)
+
+def _summary(times):
+    """Returns the mean, median and 95th percentile of some timings"""
+    times = sorted(times)
+    return {
+        'mean': sum(times) / len(times),
+        'median': times[len(times) // 2],
+        'p95': times[min(len(times) - 1, int(len(times) * 0.95))],
+    }
+
+class _Pipe:
+    """Stands in for the Popen object of a Poly/ML process"""
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+def _feed(fd, data):
+    """Writes data (bytes) to a pipe in a background thread, then closes it"""
+    def run():
+        for i in range(0, len(data), 65536):
+            fakepoly._write_all(fd, data[i:i+65536])
+        os.close(fd)
+    t = threading.Thread(target=run)
+    t.start()
+    return t
+
+def bench_reader(chunked, size=2*1024*1024):
+    """Measures how fast the PacketListener reads compile responses
+
+    chunked -- whether to use the chunked reader
+    size -- (approximate) number of bytes to read
+
+    Returns the throughput in bytes per second.
+    """
+    response = compile_response(0, 100)
+    data = response * max(1, size // len(response))
+
+    r, w = os.pipe()
+    # Popen gives an unbuffered pipe, so do the same here
+    listener = PacketListener(_Pipe(os.fdopen(r, 'rb', 0)), chunked)
+    feeder = _feed(w, data)
+
+    start = time.time()
+    try:
+        for packet in listener.read_packets():
+            pass
+    except ListenerKilled:
+        pass
+    elapsed = time.time() - start
+
+    feeder.join()
+    listener.input.close()
+    return len(data) / elapsed
+
+def bench_tokenizer(chunk_size=4096, size=8*1024*1024):
+    """Measures how fast PacketTokenizer splits compile responses into packets
+
+    chunk_size -- the size of the chunks to feed to the tokenizer
+    size -- (approximate) number of bytes to tokenize
+
+    Returns the throughput in bytes per second.
+    """
+    response = compile_response(0, 100)
+    data = response * max(1, size // len(response))
+    tokenizer = PacketTokenizer(process.PROTOCOL_ENCODING)
+
+    start = time.time()
+    for i in range(0, len(data), chunk_size):
+        tokenizer.feed(data[i:i+chunk_size])
+    return len(data) / (time.time() - start)
+
+def bench_round_trip(n=1000, poly_bin=FAKE_POLY):
+    """Measures the time for sync_request to get a response
+
+    n -- how many requests to time
+    poly_bin -- (optional) the Poly/ML binary; by default, poly.fakepoly
+
+    Returns a dict of the mean, median and 95th percentile times, in
+    seconds.
+    """
+    poly_process = PolyProcess(poly_bin)
+    try:
+        poly_process.wait_ready(10)
+        times = []
+        for i in range(n):
+            start = time.time()
+            poly_process.sync_request('O', ['1', i, i])
+            times.append(time.time() - start)
+    finally:
+        poly_process.kill()
+    return _summary(times)
+
+def bench_compile_parsing(n_errors, repeat=None):
+    """Measures how long Poly takes to read a compilation response
+
+    n_errors -- how many error messages the response has
+    repeat -- (optional) how many times to read it
+
+    Returns the time per response, in seconds.
+    """
+    from . import Poly
+    if repeat == None:
+        repeat = max(10, 10000 // max(1, n_errors))
+    packets = PacketTokenizer(process.PROTOCOL_ENCODING).feed(
+        compile_response(0, n_errors))
+    poly = Poly()
+    start = time.time()
+    for i in range(repeat):
+        poly._read_compile_response(packets[0].copy(), 'bench.ML')
+    return (time.time() - start) / repeat
+
+def bench_dispatch(n=100000):
+    """Measures the PacketListener's cost of handing a response to its
+    handler
+
+    n -- how many responses to dispatch
+
+    Returns the time per response, in seconds.
+    """
+    data = ''.join(['\x1bO{0}\x1b,1\x1b,0\x1b,3\x1b,T\x1bo'.format(rid)
+                    for rid in range(n)]).encode('ascii')
+    packets = PacketTokenizer(process.PROTOCOL_ENCODING).feed(data)
+    listener = PacketListener(_Pipe(None))
+    def handler(packet):
+        pass
+    for rid in range(n):
+        listener.add_handler(rid, handler)
+
+    start = time.time()
+    for packet in packets:
+        listener.dispatch_packet(packet)
+    return (time.time() - start) / n
+
+def run_benchmarks(json_path=None):
+    """Runs all the benchmarks, printing the results
+
+    json_path -- (optional) a file to save the results in, as JSON
+    """
+    results = {}
+    for chunked in [False, True]:
+        name = 'chunked' if chunked else 'per-byte'
+        rate = bench_reader(chunked)
+        results['reader_' + name.replace('-', '_')] = rate
+        print('reader ({0}): {1:.2f} MB/s'.format(name, rate / (1024 * 1024)))
+
+    rate = bench_tokenizer()
+    results['tokenizer'] = rate
+    print('tokenizer: {0:.2f} MB/s'.format(rate / (1024 * 1024)))
+
+    round_trip = bench_round_trip()
+    results['round_trip'] = round_trip
+    print('sync_request round trip: {0:.1f} us median, {1:.1f} us p95'.format(
+        round_trip['median'] * 1e6, round_trip['p95'] * 1e6))
+
+    results['compile_parsing'] = {}
+    for n_errors in [0, 1, 10, 100, 1000]:
+        t = bench_compile_parsing(n_errors)
+        results['compile_parsing'][str(n_errors)] = t
+        print('compile response with {0} errors: {1:.1f} us'.format(
+            n_errors, t * 1e6))
+
+    t = bench_dispatch()
+    results['dispatch'] = t
+    print('dispatch: {0:.2f} us per response'.format(t * 1e6))
+
+    if json_path != None:
+        f = open(json_path, 'w')
+        try:
+            json.dump({
+                'time': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    return results
+
+if __name__ == '__main__':
+    run_benchmarks(len(sys.argv) > 1 and sys.argv[1] or None)
@@ -0,0 +1,269 @@
+import os
+import json
+import atexit
+import threading
+import hashlib
+from .store import native_strings
+
+"""Caches used by Poly
+
+LRUCache is a bounded, thread-safe mapping that discards the least recently
+used entries.  CompileCache stores compilation results by a hash of
+everything that went into the compilation, and can keep them on disk
+between editor sessions.
+"""
+
+# how long after a result is added the cache is written to its file, in
+# seconds; results added meanwhile are written at the same time
+SAVE_DELAY = 5
+
+class LRUCache:
+    """A mapping that holds at most size entries.
+
+    size -- the maximum number of entries
+    hits -- the number of successful lookups with get()
+    misses -- the number of unsuccessful lookups with get()
+
+    When the cache is full, adding an entry discards the one that was least
+    recently added or looked up.  All methods are thread-safe.
+    """
+
+    def __init__(self, size=128):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        # each link is [prev, next, key, value]; self._root is a sentinel,
+        # with the most recently used entry at self._root[0]
+        self._map = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _link_newest(self, link):
+        last = self._root[0]
+        link[0] = last
+        link[1] = self._root
+        last[1] = link
+        self._root[0] = link
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def get(self, key, default=None):
+        """Look up an entry, marking it as recently used."""
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link == None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._link_newest(link)
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        """Add or replace an entry, discarding the oldest if necessary."""
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link != None:
+                self._unlink(link)
+                link[3] = value
+            else:
+                link = [None, None, key, value]
+                self._map[key] = link
+                if len(self._map) > self.size:
+                    oldest = self._root[1]
+                    self._unlink(oldest)
+                    del self._map[oldest[2]]
+            self._link_newest(link)
+        finally:
+            self._lock.release()
+
+    def pop(self, key, default=None):
+        """Remove an entry, returning its value."""
+        self._lock.acquire()
+        try:
+            link = self._map.pop(key, None)
+            if link == None:
+                return default
+            self._unlink(link)
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Remove all the entries."""
+        self._lock.acquire()
+        self._clear()
+        self._lock.release()
+
+    def items(self):
+        """Returns a list of (key, value) pairs, oldest first."""
+        self._lock.acquire()
+        try:
+            items = []
+            link = self._root[1]
+            while link is not self._root:
+                items.append((link[2], link[3]))
+                link = link[1]
+            return items
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Returns a dict with the size, entries, hits and misses."""
+        return {'size': self.size, 'entries': len(self._map),
+                'hits': self.hits, 'misses': self.misses}
+
+def _utf8(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+class CompileCache:
+    """Compilation results, keyed by what was compiled.
+
+    size -- (optional) the maximum number of results to keep (default: 64)
+    path -- (optional) a file to keep the results in between sessions
+
+    The results are plain data (lists, dicts, strings, numbers and None),
+    as made by Poly from the result code and messages of a compilation, so
+    that they can be kept as JSON.  If path is given, the cache is loaded
+    from it when it is created, and written back SAVE_DELAY seconds after a
+    result is added (from a thread of its own), and when Python exits.
+    """
+
+    def __init__(self, size=64, path=None):
+        self.path = path
+        self._results = LRUCache(size)
+        self._write_lock = threading.Lock()
+        # guards _dirty and _timer, and is never held while writing, so
+        # adding a result does not wait for the file to be written
+        self._lock = threading.Lock()
+        self._dirty = False # whether there are results not written yet
+        self._timer = None
+        if path != None:
+            self.load()
+            atexit.register(self.flush)
+
+    def key(self, file, prelude, source, saved_state=None):
+        """Returns the key for a compilation.
+
+        file -- the file name for the compilation
+        prelude -- the prelude ML code
+        source -- the ML code being compiled
+        saved_state -- (optional) something that identifies the saved state
+                       loaded for the compilation (eg: its path and mtime)
+        """
+        h = hashlib.sha1()
+        for part in [file, prelude, source, repr(saved_state)]:
+            part = _utf8(part)
+            h.update(_utf8(str(len(part))))
+            h.update(b':')
+            h.update(part)
+        return h.hexdigest()
+
+    def get(self, key):
+        """Returns the stored result for a key, or None."""
+        return self._results.get(key)
+
+    def put(self, key, result):
+        """Stores a result for a key."""
+        self._results.put(key, result)
+        if self.path != None:
+            self._changed()
+
+    def clear(self):
+        """Discards all the stored results."""
+        self._results.clear()
+        if self.path != None:
+            self._changed()
+
+    def stats(self):
+        """Returns a dict with the size, entries, hits and misses."""
+        return self._results.stats()
+
+    def _changed(self):
+        """Arranges for the results to be written to self.path soon."""
+        self._lock.acquire()
+        try:
+            self._dirty = True
+            if self._timer == None:
+                self._timer = threading.Timer(SAVE_DELAY, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        finally:
+            self._lock.release()
+
+    def _take_changes(self):
+        """Returns whether there are results not written yet, and forgets
+        that there are (as they are about to be written)."""
+        self._lock.acquire()
+        try:
+            if self._timer != None:
+                self._timer.cancel()
+                self._timer = None
+            dirty = self._dirty
+            self._dirty = False
+            return dirty
+        finally:
+            self._lock.release()
+
+    def load(self):
+        """Reads the results stored in self.path, if it exists."""
+        try:
+            f = open(self.path, 'rb')
+            try:
+                items = native_strings(json.loads(f.read().decode('utf-8')))
+            finally:
+                f.close()
+            for key, result in items:
+                self._results.put(key, result)
+        except Exception:
+            # a missing or unreadable cache is just an empty one (and an
+            # unreadable entry is dropped with the ones after it)
+            return
+
+    def flush(self):
+        """Writes the stored results to self.path, if any have been added
+        since they were last written."""
+        if self._take_changes():
+            self._save()
+
+    def save(self):
+        """Writes the stored results to self.path."""
+        self._take_changes()
+        self._save()
+
+    def _save(self):
+        self._write_lock.acquire()
+        try:
+            data = json.dumps([list(item) for item in self._results.items()])
+            temp = self.path + '.tmp'
+            f = open(temp, 'wb')
+            try:
+                f.write(data.encode('utf-8'))
+            finally:
+                f.close()
+            if os.path.exists(self.path) and os.name == 'nt':
+                os.remove(self.path) # rename will not replace it on Windows
+            os.rename(temp, self.path)
+        except (IOError, OSError, TypeError, ValueError):
+            pass
+        finally:
+            self._write_lock.release()
@@ -3,7 +3,6 @@ import subprocess
 import sys
 import threading
 import tempfile
-import string
 import time
 
 class ConsoleThread(threading.Thread):
@@ -53,7 +52,7 @@ class ConsoleThread(threading.Thread):
 
         terminal_will_detach = True
         if self.term == 'gnome-terminal':
-            cmd = [self.term, '--disable-factory', '-e'] + [string.join(poly_cmd, ' ')]
+            cmd = [self.term, '--disable-factory', '-e'] + [' '.join(poly_cmd)]
             terminal_will_detach = False
         elif self.term == 'konsole':
             cmd = [self.term, '--nofork', '-e'] + poly_cmd
@@ -63,7 +62,7 @@ class ConsoleThread(threading.Thread):
             poly_cmd[2] = "'\\\"%s\\\"'" % poly_cmd[2]
             cmd = ['osascript', '-e', 'tell application "Terminal"',
                 '-e', "activate",
-                '-e', "do script \"%s\"" % string.join(poly_cmd, ' '),
+                '-e', "do script \"%s\"" % ' '.join(poly_cmd),
                 '-e', "end tell"]
         elif self.term == 'xterm':
             cmd = [self.term, '-e'] + poly_cmd
@@ -71,7 +70,7 @@ class ConsoleThread(threading.Thread):
         else:
             cmd = [self.term, '-e'] + poly_cmd
 
-        print cmd
+        print(cmd)
         st = subprocess.call(cmd)
         if terminal_will_detach:
             time.sleep(10) # give poly time to load tempfile before it is removed
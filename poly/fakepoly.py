@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import time
+
+"""A stand-in for "poly --ideprotocol", for testing and benchmarking
+
+This speaks enough of Poly/ML's IDE protocol for the poly package to work
+against it: the H handshake, and R (compile), O (node at position),
+T (type), I (declaration) and K (cancel) requests.  It does not compile
+anything; the responses are made up.  Run it by passing the path of this
+file as the Poly/ML binary, eg:
+
+    poly.Poly('/path/to/poly/fakepoly.py')
+
+Its behaviour can be changed with these environment variables:
+
+FAKEPOLY_STARTUP -- seconds to wait before the handshake (default: 0)
+FAKEPOLY_LATENCY -- seconds to wait before each response (default: 0)
+FAKEPOLY_ERRORS -- the number of error messages in each compilation
+                   response (default: 0, but see below)
+FAKEPOLY_MESSAGE -- the text of each error message
+FAKEPOLY_TYPE -- the type given for every node (default: 'int')
+FAKEPOLY_CRASH -- if set, exit when asked to compile code containing
+                  "crash"
+
+Compiling code that contains "error" gives (at least) one error message,
+and code containing "print" makes it write some program output.  A prelude
+containing "badprefix" fails (result code 'L').  Saved states that the
+prelude asks to be saved with PolyML.SaveState.saveChild are created
+(empty).  Nodes are always three characters long, and are declared at the
+same position in fake.ML.
+"""
+
+ESC = '\x1b'
+
+def _env_float(name, default=0):
+    return float(os.environ.get(name, default))
+
+def _bytes(text):
+    """Encodes text as UTF-8, unless it is already a byte string"""
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+def _write_all(fd, data):
+    """Writes all of data to a file descriptor"""
+    while data:
+        data = data[os.write(fd, data):]
+
+def _packet(code, *fields):
+    """Formats a response: ESC code, then the fields separated by ESC ,"""
+    return ESC + code + (ESC + ',').join([str(f) for f in fields]) + ESC + code.lower()
+
+def compile_response(rid, parse_tree, result_code, length, errors=[], output=''):
+    """Returns the response to an R request, as bytes
+
+    rid -- the request id
+    parse_tree -- the parse tree id
+    result_code -- 'S', 'F', 'X', 'L' or 'C'
+    length -- the offset the compilation finished at
+    errors -- a list of (file name, start, end, text) for error messages
+    output -- (for result code 'L') the text of the failure
+    """
+    parts = [ESC + 'R' + (ESC + ',').join(
+        [str(rid), str(parse_tree), result_code, str(length)]) + ESC + ';']
+    if result_code == 'L':
+        parts.append(output)
+    else:
+        for file_name, start, end, text in errors:
+            parts.append(ESC + 'E' + (ESC + ',').join(
+                ['E', file_name, '0', str(start), str(end)]) + ESC + ';' +
+                text.replace(ESC, ESC + ESC) + ESC + 'e')
+    parts.append(ESC + 'r')
+    return _bytes(''.join(parts))
+
+class FakePoly:
+    """The state of the fake Poly/ML process
+
+    output -- a function to write bytes to Poly/ML's standard output
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.parse_tree = 0
+        self.latency = _env_float('FAKEPOLY_LATENCY')
+        self.errors = int(os.environ.get('FAKEPOLY_ERRORS', 0))
+        self.message = os.environ.get('FAKEPOLY_MESSAGE',
+                                      'Type error in function application.')
+        self.type = os.environ.get('FAKEPOLY_TYPE', 'int')
+        self.crash = bool(os.environ.get('FAKEPOLY_CRASH'))
+
+    def write(self, text):
+        self.output(_bytes(text))
+
+    def handshake(self):
+        self.write(_packet('H', '1'))
+
+    def handle(self, packet):
+        """Writes the response to a request Packet"""
+        tokens = list(packet.tokens)
+        code = tokens[0].code
+        fields = [t for t in tokens[1:] if not hasattr(t, 'code')]
+        rid, args = fields[0], fields[1:]
+        if self.latency:
+            time.sleep(self.latency)
+        if code == 'R':
+            self.compile(rid, args)
+        elif code == 'O':
+            start = int(args[1])
+            self.write(_packet('O', rid, args[0], start, start + 3, 'T', 'I'))
+        elif code == 'T':
+            self.write(_packet('T', rid, args[0], args[1], args[2], self.type))
+        elif code == 'I':
+            self.write(_packet('I', rid, args[0], args[1], args[2],
+                               'fake.ML', 0, args[1], args[2]))
+        # K (cancel) is ignored: compilations finish straight away
+
+    def compile(self, rid, args):
+        file_name, prelude, source = args[0], args[4], args[5]
+        self.parse_tree += 1
+        if self.crash and 'crash' in source:
+            sys.exit(1)
+        for m in re.finditer(r'saveChild \("([^"]*)"', prelude):
+            open(m.group(1), 'w').close()
+        if 'badprefix' in prelude:
+            self.write(compile_response(rid, self.parse_tree, 'L', 0,
+                                        output='Exception in prelude'))
+            return
+        if 'print' in source:
+            self.write('Output from the program\n')
+        n_errors = self.errors
+        if 'error' in source:
+            n_errors = max(1, n_errors)
+        errors = [(file_name, i * 10, i * 10 + 5, self.message)
+                  for i in range(n_errors)]
+        result = 'S'
+        if errors:
+            result = 'F'
+        self.write(compile_response(rid, self.parse_tree, result, len(source),
+                                    errors))
+
+def main():
+    # run as a script, so the poly package may not be importable yet
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from poly.process import PacketTokenizer, PROTOCOL_ENCODING
+
+    time.sleep(_env_float('FAKEPOLY_STARTUP'))
+    fake = FakePoly(lambda data: _write_all(1, data))
+    fake.handshake()
+    tokenizer = PacketTokenizer(PROTOCOL_ENCODING)
+    while True:
+        data = os.read(0, 65536)
+        if not data:
+            break
+        for packet in tokenizer.feed(data):
+            fake.handle(packet)
+
+if __name__ == '__main__':
+    main()
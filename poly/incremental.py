@@ -0,0 +1,198 @@
+import os
+import re
+import shutil
+import tempfile
+import hashlib
+from .cache import LRUCache
+
+"""Support for compiling only the changed part of a file
+
+The source is split into top-level declarations.  The environment after an
+unchanged run of declarations at the start of the file (a stable prefix) is
+saved by Poly/ML as a child saved state (a checkpoint), so that later
+compilations can load the checkpoint and only compile the rest of the file.
+"""
+
+# keywords that start a top-level declaration
+DECLARATION_KEYWORDS = set(['val', 'fun', 'type', 'datatype', 'abstype',
+                            'exception', 'local', 'open', 'infix', 'infixr',
+                            'nonfix', 'structure', 'signature', 'functor'])
+# keywords that are closed by "end"
+OPENING_KEYWORDS = set(['struct', 'sig', 'let', 'local', 'abstype'])
+
+_token_rexp = re.compile(r"\(\*|\*\)|\"|\n|[A-Za-z][A-Za-z0-9_']*")
+_string_end_rexp = re.compile(r'\\.|"|\n', re.S)
+
+def split_declarations(source):
+    """Splits ML code into top-level declarations.
+
+    A declaration starts at a line whose first word is one of
+    DECLARATION_KEYWORDS, outside any comment, string, or struct/sig/let/
+    local/abstype block.  Anything before the first such line is part of
+    the first declaration.
+
+    Returns a list of (offset, text) pairs, one for each declaration.
+    """
+    starts = [0]
+    depth = 0
+    comments = 0
+    line_start = 0
+    pos = 0
+    while True:
+        m = _token_rexp.search(source, pos)
+        if m == None:
+            break
+        token = m.group()
+        pos = m.end()
+        if token == '\n':
+            line_start = pos
+        elif token == '(*':
+            comments += 1
+        elif token == '*)':
+            if comments: comments -= 1
+        elif comments:
+            pass
+        elif token == '"':
+            # skip to the end of the string
+            while True:
+                e = _string_end_rexp.search(source, pos)
+                if e == None:
+                    pos = len(source)
+                    break
+                pos = e.end()
+                if e.group() == '"':
+                    break
+                if e.group() == '\n':
+                    line_start = pos
+        elif token == 'end':
+            if depth: depth -= 1
+        else:
+            if (depth == 0 and token in DECLARATION_KEYWORDS and
+                    line_start > starts[-1] and
+                    source[line_start:m.start()].strip() == ''):
+                starts.append(line_start)
+            if token in OPENING_KEYWORDS:
+                depth += 1
+    ends = starts[1:] + [len(source)]
+    return [(s, source[s:e]) for s, e in zip(starts, ends)]
+
+def _hash(h, text):
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    h.update(str(len(text)).encode('ascii'))
+    h.update(b':')
+    h.update(text)
+
+def prefix_keys(base, declarations):
+    """Returns keys for each prefix of a list of declarations.
+
+    base -- a string identifying everything else the compilation depends
+            on (the file, prelude and saved state)
+    declarations -- a list of (offset, text) pairs, from
+                    split_declarations()
+
+    The key for the first n declarations is at index n of the result.
+    """
+    h = hashlib.sha1()
+    _hash(h, base)
+    keys = [h.hexdigest()]
+    for offset, text in declarations:
+        _hash(h, text)
+        keys.append(h.hexdigest())
+    return keys
+
+def _ml_string(text):
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def load_state_code(path):
+    """Returns ML code to load a saved state."""
+    return 'PolyML.SaveState.loadState {0};\n'.format(_ml_string(path))
+
+def save_checkpoint_code(path):
+    """Returns ML code to save the current state as a child of the
+    currently loaded saved states."""
+    return ('PolyML.SaveState.saveChild ({0}, '
+            'List.length (PolyML.SaveState.showHierarchy ()) + 1);\n').format(
+                _ml_string(path))
+
+class Checkpoints:
+    """Saved states for the stable prefixes of compiled files.
+
+    size -- (optional) the maximum number of checkpoints to keep on disk
+    directory -- (optional) where to keep them; by default, a new temporary
+                 directory
+
+    Checkpoints are identified by a prefix key (see prefix_keys()).
+    """
+
+    def __init__(self, size=16, directory=None):
+        if directory == None:
+            directory = tempfile.mkdtemp(prefix='polyml-checkpoints-')
+        self.directory = directory
+        self._paths = LRUCache(size)
+
+    def path_for(self, key):
+        """Returns the file a checkpoint should be saved in."""
+        return os.path.join(self.directory, key + '.save')
+
+    def root_path(self):
+        """Returns the file for the root checkpoint.
+
+        The root checkpoint is the state of a fresh Poly/ML process, for
+        files that have no saved state of their own.  It is never evicted.
+        """
+        return os.path.join(self.directory, 'root.save')
+
+    def root(self):
+        """Returns the path of the root checkpoint, or None if it has not
+        been saved."""
+        path = self.root_path()
+        if os.path.exists(path):
+            return path
+        return None
+
+    def get(self, key):
+        """Returns the path of an existing checkpoint, or None."""
+        path = self._paths.get(key)
+        if path != None and os.path.exists(path):
+            return path
+        return None
+
+    def add(self, key):
+        """Registers a checkpoint that is about to be saved.
+
+        The least recently used checkpoint is deleted if there are too
+        many.
+
+        Returns the path it should be saved in.
+        """
+        path = self.path_for(key)
+        before = [k for k, p in self._paths.items()]
+        self._paths.put(key, path)
+        for k in before:
+            if not k in self._paths:
+                self._remove(self.path_for(k))
+        return path
+
+    def discard(self, key):
+        """Forgets (and deletes) a checkpoint."""
+        path = self._paths.pop(key)
+        if path != None:
+            self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        """Deletes all the checkpoints."""
+        for k, path in self._paths.items():
+            self._remove(path)
+        self._paths.clear()
+
+    def remove_directory(self):
+        """Deletes all the checkpoints and the directory they are in."""
+        self._paths.clear()
+        shutil.rmtree(self.directory, True)
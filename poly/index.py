@@ -0,0 +1,217 @@
+import os
+import re
+import copy
+import threading
+from bisect import bisect_right
+
+"""Indexes of the nodes in compiled files
+
+A PositionIndex holds the node at every token of a file, along with the
+types and declarations of those nodes, so that queries about the file can
+be answered without asking Poly/ML.  Poly builds them in the background
+after a successful compilation (see Poly's index option).
+
+A SymbolIndex collects the declarations found while indexing every file,
+so that identifiers can be looked up by name across a whole project.
+"""
+
+# runs of characters that Poly/ML never splits between parse tree nodes:
+# alphanumeric identifiers (and numbers), and symbolic identifiers
+_token_rexp = re.compile(r"[A-Za-z0-9_']+|[!%&$#+\-/:<=>?@\\~`^|*]+")
+
+def token_ranges(source, start=0):
+    """Returns the (start, end) ranges of the tokens in ML code.
+
+    source -- the ML code
+    start -- (optional) the offset to start at
+
+    Every position in a token is in the same (innermost) parse tree node as
+    the start of the token.
+    """
+    return [(m.start(), m.end()) for m in _token_rexp.finditer(source, start)]
+
+class PositionIndex:
+    """The nodes of a parse tree, by position, with their types and
+    declarations.
+
+    path -- the file the parse tree is for
+    parse_tree -- the parse tree id
+
+    Nodes must be added in order of position.  Lookups take O(log n) time
+    in the number of tokens.
+    """
+
+    def __init__(self, path, parse_tree):
+        self.path = path
+        self.parse_tree = parse_tree
+        self._starts = []
+        self._ends = []
+        self._nodes = []
+        self._types = {}
+        self._declarations = {}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def add_node(self, start, end, node):
+        """Records the node for the token from start to end."""
+        self._starts.append(start)
+        self._ends.append(end)
+        self._nodes.append(node)
+
+    def add_type(self, node, type):
+        """Records the type of a node (None if it has none)."""
+        self._types[(node.start, node.end)] = type
+
+    def add_declaration(self, node, location):
+        """Records the declaration of a node (None if it has none)."""
+        self._declarations[(node.start, node.end)] = location
+
+    def tokens(self):
+        """Returns a list of (start, end, node) for each token."""
+        return list(zip(self._starts, self._ends, self._nodes))
+
+    def types(self):
+        """Returns a dict of the types, by the (start, end) of their
+        nodes."""
+        return dict(self._types)
+
+    def declarations(self):
+        """Returns a dict of the declarations, by the (start, end) of their
+        nodes."""
+        return dict(self._declarations)
+
+    def nodes(self):
+        """Returns a list of the distinct nodes, in order of position."""
+        seen = set()
+        nodes = []
+        for node in self._nodes:
+            if not (node.start, node.end) in seen:
+                seen.add((node.start, node.end))
+                nodes.append(node)
+        return nodes
+
+    def node_at(self, position, default=None):
+        """Returns the node at a position, or default if the position is not
+        in a token."""
+        i = bisect_right(self._starts, position) - 1
+        if i >= 0 and position < self._ends[i]:
+            return self._nodes[i]
+        return default
+
+    def get(self, key, default=None):
+        """Looks up the answer to a query.
+
+        key -- ('O', parse_tree, position), or ('T', parse_tree, start, end)
+               or ('I', parse_tree, start, end)
+
+        Returns the node, type or declaration, or default if the index does
+        not have the answer.
+        """
+        if key[1] != self.parse_tree:
+            return default
+        if key[0] == 'O':
+            return self.node_at(key[2], default)
+        elif key[0] == 'T':
+            return self._types.get(key[2:], default)
+        elif key[0] == 'I':
+            return self._declarations.get(key[2:], default)
+        return default
+
+class SymbolIndex:
+    """Where identifiers are declared, across all the indexed files.
+
+    Each file contributes the declaration locations of the identifiers
+    used in it, under the identifier's text (eg: "Foo.bar") and, for
+    identifiers in structures, its last component ("bar").  All methods are
+    thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # path -> list of (name, location)
+        self._files = {}
+        # name -> list of (path, location)
+        self._names = {}
+
+    def update(self, path, symbols):
+        """Replaces the symbols recorded for a file.
+
+        path -- the file the symbols were found in
+        symbols -- a list of (name, PolyLocation) pairs, giving the
+                   declaration location of each identifier in the file
+        """
+        self._lock.acquire()
+        try:
+            self._remove(path)
+            entries = []
+            seen = set()
+            for name, location in symbols:
+                for n in set([name, name.split('.')[-1]]):
+                    key = (n, location.file_name, location.line,
+                           location.start, location.end)
+                    if not key in seen:
+                        seen.add(key)
+                        entries.append((n, location))
+            self._files[path] = entries
+            for name, location in entries:
+                self._names.setdefault(name, []).append((path, location))
+        finally:
+            self._lock.release()
+
+    def remove(self, path):
+        """Forgets the symbols recorded for a file."""
+        self._lock.acquire()
+        try:
+            self._remove(path)
+        finally:
+            self._lock.release()
+
+    def _remove(self, path):
+        for name, location in self._files.pop(path, []):
+            entries = [e for e in self._names.get(name, []) if e[0] != path]
+            if entries:
+                self._names[name] = entries
+            else:
+                self._names.pop(name, None)
+
+    def files(self):
+        """Returns a list of the files with recorded symbols."""
+        return list(self._files.keys())
+
+    def lookup(self, name):
+        """Returns a list of the distinct locations name is declared at.
+
+        name -- an identifier, possibly qualified by structure names
+        """
+        self._lock.acquire()
+        try:
+            entries = list(self._names.get(name, []))
+        finally:
+            self._lock.release()
+        seen = set()
+        locations = []
+        for path, location in entries:
+            location = self.resolve(location)
+            key = (location.file_name, location.line, location.start,
+                   location.end)
+            if not key in seen:
+                seen.add(key)
+                locations.append(location)
+        return locations
+
+    def resolve(self, location):
+        """Gives a location the full path of its file, if it only has the
+        file's name and an indexed file has that name.
+
+        Poly/ML only gives the file name for declarations in code that it
+        did not compile from a file the editor passed it.
+        """
+        if location == None or os.path.isabs(location.file_name or '/'):
+            return location
+        for path in self.files():
+            if os.path.basename(path) == location.file_name:
+                resolved = copy.copy(location)
+                resolved.file_name = path
+                return resolved
+        return location
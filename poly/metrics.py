@@ -0,0 +1,264 @@
+import time
+import threading
+from bisect import bisect_left
+from collections import deque
+
+"""Latency and throughput metrics for Poly/ML requests
+
+A Metrics object counts the requests sent to Poly/ML by code, with a
+Histogram of how long their responses took, along with the bytes written
+and read, timeouts and process restarts.  A Poly keeps one for all the
+processes it starts; see Poly.stats().
+"""
+
+# how many of the reasons for the latest restarts to keep
+RESTART_REASONS = 10
+
+# the upper bounds of the latency histogram buckets, in seconds; there is a
+# final bucket for anything slower
+LATENCY_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+                   1.0, 2.0, 5.0, 10.0, 30.0]
+
+class Histogram:
+    """Counts of values in fixed buckets, with their minimum, maximum and
+    total.
+
+    bounds -- (optional) the upper bounds of the buckets, in increasing
+              order (default: LATENCY_BUCKETS)
+
+    Not thread-safe on its own; Metrics locks around it.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min == None or value < self.min:
+            self.min = value
+        if self.max == None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Estimates a percentile (0 to 100) of the values.
+
+        The values are assumed to be spread evenly through the bucket the
+        percentile falls in (narrowed to the minimum and maximum).
+
+        Returns None if there are no values.
+        """
+        if self.count == 0:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                low = self.min
+                if i > 0:
+                    low = max(low, self.bounds[i - 1])
+                high = self.max
+                if i < len(self.bounds):
+                    high = min(high, self.bounds[i])
+                return low + (high - low) * (rank - seen) / n
+            seen += n
+        return self.max
+
+    def summary(self):
+        """Returns a dict of the count, mean, min, max, estimated p50, p95
+        and p99, and the bucket counts (as (upper bound, count) pairs, with
+        None for the last bound)."""
+        mean = None
+        if self.count:
+            mean = self.total / self.count
+        return {
+            'count': self.count,
+            'mean': mean,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'buckets': list(zip(self.bounds + [None], self.counts)),
+        }
+
+class Metrics:
+    """Counters for the traffic with Poly/ML processes.
+
+    All methods are thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clears all the counters."""
+        self._lock.acquire()
+        try:
+            self._since = time.time()
+            # by request code: [sent, timeouts, failures, latency Histogram]
+            self._requests = {}
+            self._in_flight = 0
+            self._bytes_written = 0
+            self._bytes_read = 0
+            self._timeouts = 0
+            self._restarts = 0
+            # (time, reason) for the latest restarts
+            self._restart_reasons = deque([], RESTART_REASONS)
+        finally:
+            self._lock.release()
+
+    def _entry(self, code):
+        entry = self._requests.get(code)
+        if entry == None:
+            entry = [0, 0, 0, Histogram()]
+            self._requests[code] = entry
+        return entry
+
+    def sent(self, codes):
+        """Records that requests with the given codes were sent."""
+        self._lock.acquire()
+        try:
+            for code in codes:
+                self._entry(code)[0] += 1
+                self._in_flight += 1
+        finally:
+            self._lock.release()
+
+    def finished(self, code, latency, failed=False):
+        """Records the response to a request (or its failure).
+
+        code -- the request code
+        latency -- the time from sending the request, in seconds
+        failed -- (optional) whether the request failed with no response
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entry(code)
+            if failed:
+                entry[2] += 1
+            else:
+                entry[3].add(latency)
+            self._in_flight -= 1
+        finally:
+            self._lock.release()
+
+    def timed_out(self, code):
+        """Records that a request (or a wait for its response) timed out.
+
+        A request that is given up on also finishes, as a failure; one
+        that is still waited for stays in flight until its response
+        arrives.
+        """
+        self._lock.acquire()
+        try:
+            self._entry(code)[1] += 1
+            self._timeouts += 1
+        finally:
+            self._lock.release()
+
+    def written(self, n):
+        """Records that n bytes were written to Poly/ML."""
+        self._lock.acquire()
+        self._bytes_written += n
+        self._lock.release()
+
+    def read(self, n):
+        """Records that n bytes were read from Poly/ML."""
+        self._lock.acquire()
+        self._bytes_read += n
+        self._lock.release()
+
+    def restarted(self, reason=None):
+        """Records that the Poly/ML process was replaced.
+
+        reason -- (optional) why, eg: how the old process exited
+        """
+        self._lock.acquire()
+        self._restarts += 1
+        if reason != None:
+            self._restart_reasons.append((time.time(), reason))
+        self._lock.release()
+
+    def stats(self):
+        """Returns the counters as a dict, with these entries:
+
+        requests -- by request code, a dict of how many were sent, timeouts
+                    and failures, and a latency summary (see
+                    Histogram.summary) of the responses, in seconds
+        in_flight -- how many requests have not been answered
+        bytes_written, bytes_read -- the traffic with Poly/ML
+        timeouts -- how many requests (or waits for responses) timed out
+        restarts -- how many times the Poly/ML process was replaced
+        restart_reasons -- a list of (time, reason) for the latest restarts,
+                           oldest first
+        elapsed -- the time the counters cover, in seconds
+        """
+        self._lock.acquire()
+        try:
+            requests = {}
+            for code, entry in self._requests.items():
+                requests[code] = {
+                    'sent': entry[0],
+                    'timeouts': entry[1],
+                    'failures': entry[2],
+                    'latency': entry[3].summary(),
+                }
+            return {
+                'requests': requests,
+                'in_flight': self._in_flight,
+                'bytes_written': self._bytes_written,
+                'bytes_read': self._bytes_read,
+                'timeouts': self._timeouts,
+                'restarts': self._restarts,
+                'restart_reasons': list(self._restart_reasons),
+                'elapsed': time.time() - self._since,
+            }
+        finally:
+            self._lock.release()
+
+def _ms(seconds):
+    if seconds == None:
+        return '-'
+    return '{0:.1f}ms'.format(seconds * 1000)
+
+def format_stats(stats):
+    """Returns a list of lines describing the result of Metrics.stats()
+    (or Poly.stats()), for showing to the user."""
+    lines = ['Poly/ML requests over {0:.0f}s: {1} in flight, {2} timeouts, '
+             '{3} restarts'.format(stats['elapsed'], stats['in_flight'],
+                                   stats['timeouts'], stats['restarts']),
+             '{0} bytes written, {1} bytes read'.format(
+                 stats['bytes_written'], stats['bytes_read'])]
+    codes = list(stats['requests'].keys())
+    codes.sort()
+    for code in codes:
+        r = stats['requests'][code]
+        latency = r['latency']
+        lines.append('{0}: {1} sent, {2} timeouts, {3} failed; mean {4}, '
+                     'p50 {5}, p95 {6}, p99 {7}, max {8}'.format(
+                         code, r['sent'], r['timeouts'], r['failures'],
+                         _ms(latency['mean']), _ms(latency['p50']),
+                         _ms(latency['p95']), _ms(latency['p99']),
+                         _ms(latency['max'])))
+    now = time.time()
+    for t, reason in stats.get('restart_reasons', []):
+        lines.append('restarted {0:.0f}s ago: {1}'.format(now - t, reason))
+    output = stats.get('output')
+    if output != None:
+        for stream in ['stdout', 'stderr']:
+            lines.append('other output on {0}: {1} bytes, {2} dropped'.format(
+                stream, output[stream]['total'], output[stream]['dropped']))
+    queries = stats.get('queries')
+    if queries != None:
+        lines.append('query cache: {0} of {1} entries, {2} hits, {3} '
+                     'misses'.format(queries['entries'], queries['size'],
+                                     queries['hits'], queries['misses']))
+    return lines
@@ -6,6 +6,12 @@ import sys
 import os
 import time
 import select
+import codecs
+import heapq
+import itertools
+import weakref
+from array import array
+from . import trace
 
 """Manages the Poly/ML process"""
 
@@ -20,6 +26,37 @@ DEBUG_LEVEL = 1
 # whether to use colours in debug output
 DEBUG_COLOR = False
 
+# how much to read from the Poly/ML pipe at once in chunked mode
+READ_CHUNK_SIZE = 65536
+
+# the most to write to the Poly/ML pipe at once (see RequestWriter)
+WRITE_CHUNK_SIZE = 65536
+
+# how many bytes of non-protocol output (and of stderr) to keep from each
+# Poly/ML process; see OutputBuffer
+OUTPUT_LIMIT = 65536
+
+# the shortest time between passing output to each OutputSubscription's
+# function, in seconds
+OUTPUT_INTERVAL = 0.1
+
+# a file to record the sessions with new Poly/ML processes in (see
+# poly.record), or None not to record them
+RECORD_PATH = None
+
+# the codes of requests that Poly/ML sends no response to
+NO_RESPONSE = ['K']
+
+# the byte that starts every escape code in Poly/ML's output
+ESC = b'\x1b'
+
+# the encoding of strings in Poly/ML packets; under Python 2, strings are
+# left as byte strings, which is what the editors embedding us expect
+if sys.version_info[0] < 3:
+    PROTOCOL_ENCODING = None
+else:
+    PROTOCOL_ENCODING = 'utf-8'
+
 # used for debug output
 VTRED =    '\x1b[31;1m'
 VTGREEN =  '\x1b[32;1m'
@@ -36,6 +73,7 @@ def debug(s, level = DEBUG_INFO):
 
 def set_debug_level(level):
     """Set the debug level."""
+    global DEBUG_LEVEL
     DEBUG_LEVEL = level
 
 class ProtocolError(Exception):
@@ -62,19 +100,113 @@ class EscCode:
     def __repr__(self):
         return 'ESC[' + self.code + ']'
 
-class Packet:
-    """A packet received from Poly/ML."""
+# the kind of a string token in a Packet; other tokens are escape codes,
+# with the code's byte as their kind
+_STRING = 0
+
+# the EscCode for each code byte, shared by all packets
+_esc_codes = [None] + [EscCode(chr(kind)) for kind in range(1, 256)]
 
-    def __init__(self, initial=[]):
-        self.tokens = deque(initial)
+class Packet(object):
+    """A packet received from Poly/ML.
+
+    initial -- (optional) a list of tokens (strings and EscCode objects) to
+               start with; more can be added with append()
+    encoding -- (optional) the encoding of the packet's strings, or None to
+                leave them as byte strings (default: None)
+
+    A packet keeps the bytes of its strings in one byte string, with arrays
+    of each token's kind and position, and only makes string objects for
+    the tokens that are popped.  Popping moves a cursor, and copy() makes a
+    new cursor over the same data, so copying a packet is cheap however
+    large it is.
+    """
+
+    __slots__ = ['_data', '_kinds', '_starts', '_ends', '_pos', '_pushed',
+                 'encoding']
+
+    def __init__(self, initial=[], encoding=None):
+        self._data = b''
+        self._kinds = array('B')
+        self._starts = array('l')
+        self._ends = array('l')
+        self._pos = 0
+        # tokens pushed back onto the front, most recent last
+        self._pushed = None
+        self.encoding = encoding
+        for token in initial:
+            self.append(token)
+
+    @classmethod
+    def _from_arrays(cls, data, kinds, starts, ends, encoding):
+        packet = cls.__new__(cls)
+        packet._data = data
+        packet._kinds = kinds
+        packet._starts = starts
+        packet._ends = ends
+        packet._pos = 0
+        packet._pushed = None
+        packet.encoding = encoding
+        return packet
 
     def copy(self):
-        """Returns a copy of this packet."""
-        return Packet(self.tokens)
+        """Returns a copy of this packet, at the same position.
+
+        The copy shares this packet's data, so neither should be append()ed
+        to.
+        """
+        packet = Packet._from_arrays(self._data, self._kinds, self._starts,
+                                     self._ends, self.encoding)
+        packet._pos = self._pos
+        if self._pushed:
+            packet._pushed = list(self._pushed)
+        return packet
 
     def append(self, token):
-        """Append a token to the queue."""
-        self.tokens.append(token)
+        """Append a token to the packet."""
+        if token.__class__ == EscCode:
+            self._kinds.append(ord(token.code))
+            self._starts.append(0)
+            self._ends.append(0)
+        else:
+            if not isinstance(token, bytes):
+                token = token.encode('utf-8')
+                self.encoding = 'utf-8'
+            self._kinds.append(_STRING)
+            self._starts.append(len(self._data))
+            self._data += token
+            self._ends.append(len(self._data))
+
+    def __len__(self):
+        """The number of tokens left."""
+        return len(self._kinds) - self._pos + len(self._pushed or [])
+
+    def _string(self, i):
+        s = self._data[self._starts[i]:self._ends[i]]
+        if self.encoding:
+            return s.decode(self.encoding, 'replace')
+        return s
+
+    def _token(self, i):
+        kind = self._kinds[i]
+        if kind == _STRING:
+            return self._string(i)
+        return _esc_codes[kind]
+
+    def peek(self, n=0):
+        """Returns the nth token from the front, without popping it."""
+        if self._pushed:
+            if n < len(self._pushed):
+                return self._pushed[-1 - n]
+            n -= len(self._pushed)
+        if n < 0 or self._pos + n >= len(self._kinds):
+            raise IndexError('Packet has too few tokens')
+        return self._token(self._pos + n)
+
+    @property
+    def tokens(self):
+        """A list of the tokens left (made on each use)."""
+        return [self.peek(i) for i in range(len(self))]
 
     def is_response(self):
         """Whether this packet is a recognised response message.
@@ -82,28 +214,53 @@ class Packet:
         Should not be called after popping any tokens.
         """
         # M is currently unimplemented, as it doesn't provide a request-id
-        if self.tokens[0].__class__ == EscCode:
-            return (self.tokens[0].code == 'R' or
-                    self.tokens[0].code == 'I' or
-                    self.tokens[0].code == 'V' or
-                    self.tokens[0].code == 'O' or
-                    self.tokens[0].code == 'T')
+        token = self.peek()
+        if token.__class__ == EscCode:
+            return token.code in ('R', 'I', 'V', 'O', 'T')
         else:
             raise ProtocolError("Malformed packet.")
 
+    def _advance(self):
+        """Moves past the next token, which must be from the arrays"""
+        i = self._pos
+        if i >= len(self._kinds):
+            raise IndexError('pop from an empty Packet')
+        self._pos = i + 1
+        return i
+
     def pop(self):
         """Pop a token from the packet.
 
         Returns a string or an EscCode object
         """
-        return self.tokens.popleft()
+        if self._pushed:
+            return self._pushed.pop()
+        i = self._pos
+        if i >= len(self._kinds):
+            raise IndexError('pop from an empty Packet')
+        self._pos = i + 1
+        kind = self._kinds[i]
+        if kind != _STRING:
+            return _esc_codes[kind]
+        s = self._data[self._starts[i]:self._ends[i]]
+        if self.encoding:
+            return s.decode(self.encoding, 'replace')
+        return s
 
     def popint(self):
         """Pops an integer from the packet.
 
         Raises a ProtocolError if the token was not an int.
         """
-        val = self.tokens.popleft()
+        if self._pushed:
+            val = self._pushed.pop()
+        else:
+            i = self._advance()
+            if self._kinds[i] == _STRING:
+                # no need to decode it first
+                val = self._data[self._starts[i]:self._ends[i]]
+            else:
+                val = _esc_codes[self._kinds[i]]
         try:
             if val.__class__ == EscCode:
                 raise ValueError()
@@ -117,7 +274,7 @@ class Packet:
 
         Raises a ProtocolError if the token was an escape code.
         """
-        val = self.tokens.popleft()
+        val = self.pop()
         if (val.__class__ != EscCode):
             return val
         else:
@@ -133,7 +290,27 @@ class Packet:
         Raises a ProtocolError if the token was not an escape code, or
         was the wrong escape code.
         """
-        val = self.tokens.popleft()
+        # the usual case, kept short as it is very common (and using "is",
+        # as comparing EscCodes with == is slow)
+        if not self._pushed:
+            i = self._pos
+            try:
+                val = _esc_codes[self._kinds[i]]
+            except IndexError:
+                val = None
+            if val is not None and (code is None or val.code == code):
+                self._pos = i + 1
+                return val
+
+        if self._pushed:
+            val = self._pushed.pop()
+        else:
+            i = self._advance()
+            kind = self._kinds[i]
+            if kind == _STRING:
+                val = self._string(i)
+            else:
+                val = _esc_codes[kind]
         if code == None:
             if val.__class__ == EscCode:
                 return val
@@ -145,9 +322,16 @@ class Packet:
             else:
                 raise ProtocolError("Expected code '{0}', got: {1}".format(code, repr(val)))
 
+    def _next_is_empty(self):
+        if self._pushed:
+            return self._pushed[-1] == ''
+        i = self._pos
+        return (i < len(self._kinds) and self._kinds[i] == _STRING and
+                self._starts[i] == self._ends[i])
+
     def pop_until_nonempty(self):
         """Pop any empty string tokens at the top of the packet."""
-        while len(self.tokens) != 0 and self.tokens[0] == '':
+        while self._next_is_empty():
             self.pop()
 
     def popempty(self):
@@ -155,171 +339,1175 @@ class Packet:
 
         Raises a ProtocolError if the top token is not an empty string.
         """
-        val = self.tokens.popleft()
-        if (val != ''):
-            raise ProtocolError("Expected '', got {0}".format(repr(val)))
+        if self._next_is_empty():
+            self.pop()
+        else:
+            raise ProtocolError("Expected '', got {0}".format(repr(self.pop())))
 
     def popuntilcode(self, code):
         """Pop tokens until reaching the given escape code."""
-        while len(self.tokens) != 0:
-            val = self.pop()
+        while self._pushed:
+            val = self._pushed.pop()
             if (val.__class__ == EscCode and val.code == code):
+                return
+        kind = ord(code)
+        while self._pos < len(self._kinds):
+            self._pos += 1
+            if self._kinds[self._pos - 1] == kind:
                 break
 
+    def countcode(self, code):
+        """Count the remaining occurrences of an escape code, without
+        popping anything."""
+        n = 0
+        if self._pushed:
+            for val in self._pushed:
+                if val.__class__ == EscCode and val.code == code:
+                    n += 1
+        return n + self._kinds[self._pos:].count(ord(code))
+
     def pushcode(self, code):
         """Push an escape code onto the front of the packet.
 
         Can be useful for putting back a token.
         """
-        self.tokens.appendleft(EscCode(code))
+        self.pushstr(EscCode(code))
 
     def pushstr(self, str):
         """Push a string onto the front of the packet.
 
         Can be useful for putting back a token.
         """
-        self.tokens.appendleft(str)
+        if self._pushed == None:
+            self._pushed = []
+        self._pushed.append(str)
 
     def nextiscode(self):
         """Whether the next token is an escape code."""
-        return self.tokens[0].__class__ == EscCode
+        if self._pushed:
+            return self._pushed[-1].__class__ == EscCode
+        return self._pos < len(self._kinds) and self._kinds[self._pos] != _STRING
+
+    def __repr__(self):
+        return '<Packet: {0}>'.format(self.tokens)
+
+class PolyFuture:
+    """The response to a request that has been sent to Poly/ML.
+
+    rid -- the id of the request
+    code -- the request code
+
+    The response will be set by the listener thread when it arrives.
+    """
+
+    def __init__(self, rid, code, condition):
+        self.rid = rid
+        self.code = code
+        self._condition = condition
+        self._packet = None
+        self._error = None
+        self._done = False
+        self._callbacks = []
+        # a poly.metrics.Metrics to count timeouts in, if any
+        self.metrics = None
+
+    def __repr__(self):
+        return '<PolyFuture: rid={0} code={1} done={2}>'.format(
+            self.rid, self.code, self._done)
+
+    def done(self):
+        """Whether the response has arrived (or the request failed)."""
+        return self._done
+
+    def exception(self):
+        """The exception the request failed with, or None."""
+        return self._error
+
+    def _finish(self, packet, error):
+        self._condition.acquire()
+        try:
+            if self._done:
+                return
+            self._packet = packet
+            self._error = error
+            self._done = True
+            callbacks = self._callbacks
+            self._callbacks = []
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+        for fn in callbacks:
+            fn(self)
+
+    def set_result(self, packet):
+        """Set the response packet, waking up anyone waiting for it."""
+        self._finish(packet, None)
+
+    def set_exception(self, error):
+        """Mark the request as failed with the given exception."""
+        self._finish(None, error)
+
+    def add_done_callback(self, fn):
+        """Call fn with this future when it is done.
+
+        If the future is already done, fn is called immediately.
+        """
+        self._condition.acquire()
+        try:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._condition.release()
+        fn(self)
+
+    def wait(self, timeout=None):
+        """Wait for the future to be done.
+
+        timeout -- (optional) the maximum time to wait, in seconds; None
+                   means wait indefinitely
+
+        Returns whether the future is done.
+        """
+        self._condition.acquire()
+        try:
+            if timeout == None:
+                while not self._done:
+                    self._condition.wait()
+            else:
+                deadline = time.time() + timeout
+                while not self._done:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            return self._done
+        finally:
+            self._condition.release()
+
+    def result(self, timeout=None):
+        """Wait for the response and return it.
+
+        timeout -- (optional) the maximum time to wait, in seconds; None
+                   means wait indefinitely
+
+        Returns a Packet object (a fresh copy on each call).
+        Raises a Timeout exception if no response was received in time, or
+        the exception the request failed with.
+        """
+        t = trace.start()
+        done = self.wait(timeout)
+        trace.end(t, 'wait', self.code, {'rid': self.rid})
+        if not done:
+            debug("Request timed out", DEBUG_INFO)
+            if self.metrics != None:
+                self.metrics.timed_out(self.code)
+            raise Timeout()
+        if self._error != None:
+            raise self._error
+        return self._packet.copy()
+
+def wait_all(futures, timeout=None):
+    """Wait for the responses to several requests.
+
+    futures -- a list of PolyFuture objects
+    timeout -- (optional) the maximum time to wait for all the responses,
+               in seconds; None means wait indefinitely
+
+    Returns a list of Packet objects, in the same order as futures.
+    Raises a Timeout exception if not all the responses arrived in time.
+    """
+    if timeout != None:
+        deadline = time.time() + timeout
+    packets = []
+    for f in futures:
+        if timeout != None:
+            packets.append(f.result(max(0, deadline - time.time())))
+        else:
+            packets.append(f.result())
+    return packets
+
+class OutputBuffer:
+    """Keeps the end of a stream of output, counting what it drops.
+
+    limit -- (optional) the most bytes to keep (default: OUTPUT_LIMIT)
+
+    All methods are thread-safe.
+    """
+
+    def __init__(self, limit=None):
+        if limit == None:
+            limit = OUTPUT_LIMIT
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._chunks = deque()
+        self._size = 0
+        self._total = 0
+        self._dropped = 0
+        self._taken_dropped = 0
+
+    def append(self, data):
+        """Adds a byte string to the end of the buffer."""
+        if not data:
+            return
+        self._lock.acquire()
+        try:
+            self._chunks.append(data)
+            self._size += len(data)
+            self._total += len(data)
+            while self._size > self.limit:
+                excess = self._size - self.limit
+                first = self._chunks[0]
+                if len(first) <= excess:
+                    self._chunks.popleft()
+                    self._size -= len(first)
+                    self._dropped += len(first)
+                else:
+                    self._chunks[0] = first[excess:]
+                    self._size -= excess
+                    self._dropped += excess
+        finally:
+            self._lock.release()
+
+    def getvalue(self):
+        """Returns the bytes in the buffer."""
+        self._lock.acquire()
+        try:
+            return b''.join(self._chunks)
+        finally:
+            self._lock.release()
+
+    def text(self):
+        """Returns the contents of the buffer as a string (decoded with
+        PROTOCOL_ENCODING, if it is set)."""
+        data = self.getvalue()
+        if PROTOCOL_ENCODING:
+            return data.decode(PROTOCOL_ENCODING, 'replace')
+        return data
+
+    def clear(self):
+        """Empties the buffer (the counts are kept)."""
+        self._lock.acquire()
+        try:
+            self._chunks.clear()
+            self._size = 0
+        finally:
+            self._lock.release()
+
+    def take(self):
+        """Empties the buffer.
+
+        Returns the bytes that were in it, and how many bytes were dropped
+        since the last call to take().
+        """
+        self._lock.acquire()
+        try:
+            data = b''.join(self._chunks)
+            self._chunks.clear()
+            self._size = 0
+            dropped = self._dropped - self._taken_dropped
+            self._taken_dropped = self._dropped
+            return data, dropped
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Returns a dict of the bytes kept, received in total and dropped."""
+        self._lock.acquire()
+        try:
+            return {'size': self._size, 'total': self._total,
+                    'dropped': self._dropped}
+        finally:
+            self._lock.release()
+
+class OutputSubscription:
+    """Passes on the non-protocol output of Poly/ML (eg: what the program
+    being compiled prints) as it arrives.
+
+    fn -- (optional) a function to call with each piece of output (a
+          string) and the number of bytes dropped just before it; it is
+          called on a thread of the subscription's own.  Without fn, the
+          output is kept until take() is called.
+    interval -- (optional) the shortest time between calls to fn, in
+                seconds (default: OUTPUT_INTERVAL)
+    limit -- (optional) the most output to keep waiting for fn or take(),
+             in bytes (default: OUTPUT_LIMIT); older output is dropped
+
+    The listener thread never waits for a subscriber: output that arrives
+    while fn is running is kept (up to limit) and passed on together in the
+    next call.
+    """
+
+    def __init__(self, fn=None, interval=None, limit=None):
+        if interval == None:
+            interval = OUTPUT_INTERVAL
+        self.fn = fn
+        self.interval = interval
+        self.closed = False
+        self._pending = OutputBuffer(limit)
+        self._ready = threading.Event()
+        if PROTOCOL_ENCODING:
+            self._decoder = codecs.getincrementaldecoder(PROTOCOL_ENCODING)(
+                'replace')
+        else:
+            self._decoder = None
+        if fn != None:
+            thread = Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def feed(self, data):
+        """Adds some output (a byte string); called by the listener."""
+        if not self.closed:
+            self._pending.append(data)
+            self._ready.set()
+
+    def take(self):
+        """Returns the output waiting to be passed on (as a string), and
+        how many bytes were dropped before it."""
+        data, dropped = self._pending.take()
+        if self._decoder != None:
+            data = self._decoder.decode(data)
+        return data, dropped
+
+    def close(self):
+        """Stops passing on output."""
+        self.closed = True
+        self._ready.set()
+
+    def _run(self):
+        while True:
+            self._ready.wait()
+            if self.closed:
+                break
+            self._ready.clear()
+            text, dropped = self.take()
+            if text or dropped:
+                try:
+                    self.fn(text, dropped)
+                except Exception as e:
+                    debug('Output subscriber failed: {0}'.format(e), DEBUG_WARN)
+            time.sleep(self.interval)
+
+class PacketTokenizer:
+    """Splits the output of Poly/ML into packets.
+
+    Output is passed to feed() in chunks of any size, and complete packets
+    are returned as soon as their closing escape code has been seen.  Any
+    output that is not part of a packet is passed to noise, if it is given,
+    and otherwise discarded.
+
+    encoding -- (optional) the encoding to decode strings in packets with,
+                or None to leave them as byte strings (default: 'utf-8')
+    noise -- (optional) a function to call with each byte string of
+             non-protocol output (eg: from the program being compiled)
+    """
+
+    def __init__(self, encoding='utf-8', noise=None):
+        self.encoding = encoding
+        self.noise = noise
+        self._pending = b''  # a trailing ESC whose code has not arrived yet
+        self._end_code = None  # the code ending the packet being read
+        # the packet being read: the bytes of its strings so far, and the
+        # kinds and positions of its tokens (see Packet)
+        self._pieces = []
+        self._size = 0
+        self._string_start = 0
+        self._kinds = None
+        self._starts = None
+        self._ends = None
+
+    def feed(self, data):
+        """Tokenize some output from Poly/ML.
+
+        data -- a byte string
+
+        Returns a list of the Packet objects completed by data.
+        """
+        packets = []
+        if self._pending:
+            data = self._pending + data
+            self._pending = b''
+        pos = 0
+        end = len(data)
+        while pos < end:
+            esc = data.find(ESC, pos)
+            if esc == -1:
+                self._add_text(data[pos:])
+                break
+            if esc > pos:
+                self._add_text(data[pos:esc])
+            if esc + 1 == end:
+                # the code will be in the next chunk
+                self._pending = data[esc:]
+                break
+            if data[esc+1:esc+2] == ESC:
+                # an escaped ESC in a string
+                self._add_text(data[esc:esc+1])
+                pos = esc + 2
+                continue
+            packet = self._add_code(data[esc+1:esc+2])
+            if packet != None:
+                packets.append(packet)
+            pos = esc + 2
+        return packets
+
+    def _add_text(self, text):
+        if self._kinds == None:
+            # non-protocol output
+            if self.noise != None:
+                self.noise(text)
+            return
+        self._pieces.append(text)
+        self._size += len(text)
+
+    def _add_code(self, code):
+        kind = ord(code)
+        if self._kinds == None:
+            self._kinds = array('B', [kind])
+            self._starts = array('l', [0])
+            self._ends = array('l', [0])
+            self._end_code = ord(code.lower())
+            return None
+        # the string before the code, and the code
+        self._kinds.append(_STRING)
+        self._starts.append(self._string_start)
+        self._ends.append(self._size)
+        self._kinds.append(kind)
+        self._starts.append(0)
+        self._ends.append(0)
+        self._string_start = self._size
+        if kind == self._end_code:
+            packet = Packet._from_arrays(b''.join(self._pieces), self._kinds,
+                                         self._starts, self._ends,
+                                         self.encoding)
+            self._pieces = []
+            self._size = 0
+            self._string_start = 0
+            self._kinds = None
+            return packet
+        return None
 
 class PacketListener(Thread):
-    """The thread that listens to responses from Poly/ML."""
+    """The thread that listens to responses from Poly/ML.
+
+    poly_pipe -- the Popen object for the Poly/ML process
+    chunked -- (optional) read the output of Poly/ML in large chunks,
+               rather than a byte at a time (default: True)
+    """
 
-    def __init__(self, poly_pipe):
+    def __init__(self, poly_pipe, chunked=True):
         Thread.__init__(self)
         self.input = poly_pipe.stdout
         #self.pipe = poly_pipe
         self.response_handlers = {}
+        self.handlers_lock = threading.Lock()
+        # requests given up on (see remove_handlers), whose responses may
+        # still arrive
+        self._abandoned = set()
         self.listen = True
+        self.chunked = chunked
+        self.ready = threading.Event()
+        self.ready_time = None
+        self._ready_callbacks = []
+        # set once Poly/ML has closed its output (or the listener failed),
+        # but not when the listener is killed
+        self.exited = threading.Event()
+        self.eof = False
+        self._exit_callbacks = []
+        self._buf = b''
+        self._pos = 0
+        # a poly.record.Recorder for the data read, if recording
+        self.recorder = None
+        # a poly.metrics.Metrics to count the bytes read in, if any
+        self.metrics = None
+        # the end of the output that is not part of the protocol
+        self.output = OutputBuffer()
+        # OutputSubscriptions to pass that output on to
+        self.output_subscribers = []
 
     def kill(self):
         self.listen = False
 
-    def read1(self):
-        c = None
+    def _end_of_output(self):
+        self.eof = True
+        self.kill()
+
+    def fill_buffer(self):
+        """Read the next chunk of output from Poly/ML into the buffer.
+
+        Blocks until some output is available.  Raises ListenerKilled if the
+        listener is killed while waiting, or Poly/ML closes its output.
+        """
+        fd = self.input.fileno()
         while self.listen:
-            stream = select.select([self.input],[],[],0.1)[0]
-            if len(stream) == 1:
-                c = self.input.read(1)
-                if DEBUG_LEVEL >= DEBUG_FINEST:
-                    if DEBUG_COLOR: sys.stdout.write(VTRED)
-                    sys.stdout.write('['+c+']' if c!='\x1b' else '[ESC]')
-                    if DEBUG_COLOR: sys.stdout.write(VTCLEAR)
+            if len(select.select([fd],[],[],0.1)[0]) == 1:
+                self._buf = os.read(fd, READ_CHUNK_SIZE)
+                self._pos = 0
+                if self.recorder != None: self.recorder.response(self._buf)
+                if self.metrics != None: self.metrics.read(len(self._buf))
+                if len(self._buf) == 0: self._end_of_output()
                 break
-        if c == '': self.kill() # empty string means we hit EOF
         if self.listen == False: raise ListenerKilled()
+
+    def read_chunk(self):
+        """Read as much output from Poly/ML as is available.
+
+        Returns whatever is left in the buffer, or the next chunk read from
+        the pipe if the buffer is empty.  Only valid in chunked mode.
+
+        Raises ListenerKilled in the same situations as read1().
+        """
+        if self._pos >= len(self._buf):
+            self.fill_buffer()
+        chunk = self._buf[self._pos:]
+        self._pos = len(self._buf)
+        return chunk
+
+    def read1(self):
+        c = None
+        if self.chunked:
+            if self._pos >= len(self._buf):
+                self.fill_buffer()
+            c = self._buf[self._pos:self._pos+1]
+            self._pos += 1
+        else:
+            while self.listen:
+                stream = select.select([self.input],[],[],0.1)[0]
+                if len(stream) == 1:
+                    c = self.input.read(1)
+                    break
+            if self.recorder != None and c: self.recorder.response(c)
+            if self.metrics != None and c: self.metrics.read(1)
+            if c == b'': self._end_of_output() # empty string means we hit EOF
+            if self.listen == False: raise ListenerKilled()
         return c
 
     def read_until_esc(self):
+        noise = []
         c = self.read1()
-        while (c != '\x1b'):
-            #sys.stdout.write(c)
+        while (c != ESC):
+            noise.append(c)
             c = self.read1()
+        self._noise(b''.join(noise))
+
+    def _noise(self, data):
+        """Handles output that is not part of the protocol."""
+        if not data:
+            return
+        self.output.append(data)
+        for subscriber in list(self.output_subscribers):
+            subscriber.feed(data)
 
     def read_packet(self, expect_esc=True):
-        packet = Packet()
+        packet = Packet(encoding=PROTOCOL_ENCODING)
         escape = False
         c = self.read1()
         if expect_esc:
-            if c != '\x1b': raise ProtocolError("Expected [ESC], got: '{0}'".format(c))
+            if c != ESC: raise ProtocolError("Expected [ESC], got: '{0}'".format(c))
             code = self.read1()
         else:
             code = c
 
-        packet.append(EscCode(code))
-        buf = ''
+        packet.append(_esc_codes[ord(code)])
+        buf = b''
 
         c = self.read1()
         while True:
-            if escape:  # previous character was an escape
+            if escape and c != ESC:  # previous character was an escape
                 packet.append(buf)
-                buf = ''
-                packet.append(EscCode(c))
+                buf = b''
+                packet.append(_esc_codes[ord(c)])
                 if c == code.lower(): break
                 escape = False
             else:
-                buf += c
+                buf += c # ESC ESC is an escaped ESC
+                escape = False
 
             c = self.read1()
-            if c == '\x1b':
+            if c == ESC:
                 escape = True
                 c = self.read1()
 
         return packet
 
+    def add_ready_callback(self, fn):
+        """Call fn (with no arguments) once Poly/ML has sent its handshake.
+
+        If the handshake has already happened, fn is called immediately.
+        """
+        self.handlers_lock.acquire()
+        ready = self.ready.is_set()
+        if not ready:
+            self._ready_callbacks.append(fn)
+        self.handlers_lock.release()
+        if ready:
+            fn()
+
+    def _set_ready(self):
+        self.handlers_lock.acquire()
+        self.ready_time = time.time()
+        self.ready.set()
+        callbacks = self._ready_callbacks
+        self._ready_callbacks = []
+        self.handlers_lock.release()
+        for fn in callbacks:
+            fn()
+
+    def add_exit_callback(self, fn):
+        """Call fn (with no arguments) once Poly/ML has closed its output,
+        or the listener has failed.
+
+        If that has already happened, fn is called immediately.
+        """
+        self.handlers_lock.acquire()
+        exited = self.exited.is_set()
+        if not exited:
+            self._exit_callbacks.append(fn)
+        self.handlers_lock.release()
+        if exited:
+            fn()
+
+    def _set_exited(self):
+        self.handlers_lock.acquire()
+        self.exited.set()
+        callbacks = self._exit_callbacks
+        self._exit_callbacks = []
+        self.handlers_lock.release()
+        for fn in callbacks:
+            fn()
+
     def add_handler(self, rid, h):
+        self.handlers_lock.acquire()
         if not (rid in self.response_handlers):
             self.response_handlers[rid] = []
         self.response_handlers[rid].append(h)
+        self.handlers_lock.release()
+
+    def remove_handlers(self, rid):
+        """Stop waiting for the response to a request.
+
+        The response is ignored if it arrives later.
+
+        Returns the handlers removed, or None if there were none (eg: the
+        response has already been dispatched).
+        """
+        self.handlers_lock.acquire()
+        handlers = self.response_handlers.pop(rid, None)
+        if handlers != None:
+            self._abandoned.add(rid)
+        self.handlers_lock.release()
+        return handlers
 
     def dispatch_packet(self, packet):
         if packet.is_response():
-            rid = int(packet.tokens[1])
+            rid = int(packet.peek(1))
             debug('RID: {0}'.format(rid), DEBUG_FINE)
-            if rid in self.response_handlers:
-                handlers = self.response_handlers.pop(rid)
+            self.handlers_lock.acquire()
+            handlers = self.response_handlers.pop(rid, None)
+            abandoned = handlers == None and rid in self._abandoned
+            if abandoned:
+                self._abandoned.discard(rid)
+            self.handlers_lock.release()
+            if handlers != None:
                 debug('Handlers: {0}'.format(handlers), DEBUG_FINE)
                 for h in handlers:
+                    t = trace.start()
                     h(packet.copy())
+                    trace.end(t, 'handler', packet.peek().code,
+                              {'rid': rid})
+            elif abandoned:
+                debug('Ignoring late response to {0}'.format(rid), DEBUG_FINE)
             else:
                 debug('RID has no handlers!', DEBUG_WARN)
                 debug(self.response_handlers)
 
-    def run(self):
-        packet = self.read_packet()
-        packet.popcode('H')
-        debug('Running Poly/ML, protocol version: ' + packet.popstr(), DEBUG_INFO)
-        packet.popcode('h')
+    def read_packets(self):
+        """Generates the packets received from Poly/ML.
 
-        while self.listen:
-            try:
+        Raises ListenerKilled when the listener is killed.
+        """
+        if self.chunked:
+            tokenizer = PacketTokenizer(PROTOCOL_ENCODING, self._noise)
+            while True:
+                chunk = self.read_chunk()
+                t = trace.start()
+                packets = tokenizer.feed(chunk)
+                trace.end(t, 'read', '', {'bytes': len(chunk),
+                                          'packets': len(packets)})
+                for packet in packets:
+                    yield packet
+        else:
+            yield self.read_packet()
+            while True:
                 debug('Reading off excess...', DEBUG_FINE)
                 self.read_until_esc() # read off any non-protocol output
                 debug('Reading packet...', DEBUG_FINE)
+                # includes waiting for the rest of the packet to arrive
+                t = trace.start()
                 packet = self.read_packet(expect_esc=False)
-                # TODO: locking
+                trace.end(t, 'read', packet.peek().code)
+                yield packet
+
+    def run(self):
+        try:
+            packets = self.read_packets()
+            packet = next(packets)
+            packet.popcode('H')
+            debug('Running Poly/ML, protocol version: ' + packet.popstr(), DEBUG_INFO)
+            packet.popcode('h')
+            self._set_ready()
+
+            for packet in packets:
                 debug('Dispatching...', DEBUG_FINE)
                 self.dispatch_packet(packet)
-            except ListenerKilled:
-                debug('Listener killed', DEBUG_INFO)
+        except ListenerKilled:
+            debug('Listener killed', DEBUG_INFO)
+        finally:
+            # nothing more will be read, unless we were told to stop
+            if self.eof or self.listen:
+                self._set_exited()
+
+def _arg_string(arg):
+    if isinstance(arg, (bytes, type(u''))):
+        return arg
+    return str(arg)
+
+def _encode(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return s
+
+def format_request(rid, code, args):
+    """Returns the string to send to Poly/ML for a request.
+
+    rid -- the id of the request
+    code -- the request code (a single letter)
+    args -- a list of arguments, which will be separated by escaped commas
+
+    Any ESC characters in the arguments are doubled, as the protocol
+    requires.  request_chunks() does the same without building the whole
+    request.
+    """
+    return '\x1b{0}{1}\x1b,{2}\x1b{3}'.format(
+        code.upper(), rid,
+        '\x1b,'.join([_arg_string(x).replace('\x1b', '\x1b\x1b') for x in args]),
+        code.lower())
+
+def request_chunks(rid, code, args, chunk_size=None):
+    """Generates the bytes to send to Poly/ML for a request, in pieces.
+
+    rid, code, args -- as for format_request()
+    chunk_size -- (optional) the number of characters of an argument to
+                  encode at once (default: WRITE_CHUNK_SIZE)
+
+    Long arguments (eg: the source of a large file) are encoded a piece at
+    a time, rather than copied whole.
+    """
+    if chunk_size == None:
+        chunk_size = WRITE_CHUNK_SIZE
+    yield _encode('\x1b{0}{1}\x1b,'.format(code.upper(), rid))
+    for i, arg in enumerate(args):
+        if i > 0:
+            yield b'\x1b,'
+        arg = _arg_string(arg)
+        for start in range(0, len(arg), chunk_size):
+            yield _encode(arg[start:start+chunk_size]).replace(b'\x1b',
+                                                               b'\x1b\x1b')
+    yield _encode('\x1b' + code.lower())
+
+class RequestWriter(Thread):
+    """The thread that writes requests to Poly/ML.
+
+    stream -- Poly/ML's standard input
+
+    Requests are written in the order they are queued, in pieces of at
+    most WRITE_CHUNK_SIZE bytes, so that queueing one never waits for
+    Poly/ML to read it, however large it is.
+    """
+
+    def __init__(self, stream):
+        Thread.__init__(self)
+        self.daemon = True
+        self.output = stream
+        # poly.record.Recorder and poly.metrics.Metrics for the data
+        # written, if any
+        self.recorder = None
+        self.metrics = None
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._error = None
+
+    def send(self, chunks, futures=[]):
+        """Queues data to write.
+
+        chunks -- an iterable of byte strings
+        futures -- (optional) the PolyFutures of the requests in the data,
+                   which are failed with a ProtocolError if it cannot be
+                   written
+        """
+        self._condition.acquire()
+        try:
+            error = self._error
+            if error == None:
+                self._queue.append((chunks, futures))
+                self._condition.notify()
+        finally:
+            self._condition.release()
+        if error != None:
+            for f in futures:
+                f.set_exception(error)
+
+    def stop(self):
+        """Stops the thread once it has written the queued data."""
+        self._condition.acquire()
+        self._stopped = True
+        self._condition.notify()
+        self._condition.release()
+
+    def run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while not self._queue and not self._stopped:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                chunks, futures = self._queue.popleft()
+            finally:
+                self._condition.release()
+            try:
+                self._write_all(chunks)
+            except (IOError, OSError, ValueError) as e:
+                error = ProtocolError('Could not write to Poly/ML: {0}'.format(e))
+                debug(str(error), DEBUG_WARN)
+                self._fail(error, futures)
+                return
+
+    def _write_all(self, chunks):
+        t = trace.start()
+        total = 0
+        pieces = []
+        size = 0
+        for chunk in chunks:
+            chunk = _encode(chunk)
+            pieces.append(chunk)
+            size += len(chunk)
+            if size >= WRITE_CHUNK_SIZE:
+                self._write(b''.join(pieces))
+                total += size
+                pieces = []
+                size = 0
+        if pieces:
+            self._write(b''.join(pieces))
+            total += size
+        trace.end(t, 'write', '', {'bytes': total})
+
+    def _write(self, data):
+        if self.recorder != None: self.recorder.request(data)
+        if self.metrics != None: self.metrics.written(len(data))
+        while data:
+            # an unbuffered pipe may take only part of the data (under
+            # Python 2, write() returns None once it has written it all)
+            n = self.output.write(data)
+            if n == None:
                 break
+            data = data[n:]
+        self.output.flush()
+
+    def _fail(self, error, futures):
+        """Fails the futures of everything queued, and anything queued
+        later."""
+        self._condition.acquire()
+        try:
+            self._error = error
+            for chunks, more in self._queue:
+                futures = futures + more
+            self._queue.clear()
+        finally:
+            self._condition.release()
+        for f in futures:
+            f.set_exception(error)
+
+class DeadlineTimer(Thread):
+    """The thread that calls functions when their deadlines pass.
+
+    The deadlines are kept in a heap, so the thread only wakes up for the
+    next one.  PolyProcess uses it to give up on requests that have not
+    been answered in time.
+    """
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        # (deadline, sequence number, function), so that functions are
+        # never compared
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+
+    def __len__(self):
+        """The number of functions waiting for their deadlines."""
+        return len(self._heap)
+
+    def add(self, deadline, fn):
+        """Call fn (with no arguments) at a time.
+
+        deadline -- the time, as from time.time()
+        """
+        self._condition.acquire()
+        try:
+            heapq.heappush(self._heap, (deadline, next(self._sequence), fn))
+            if self._heap[0][2] is fn:
+                # sooner than the one being waited for
+                self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def stop(self):
+        """Stops the thread, and forgets the functions waiting."""
+        self._condition.acquire()
+        self._stopped = True
+        self._heap = []
+        self._condition.notify()
+        self._condition.release()
+
+    def run(self):
+        self._condition.acquire()
+        try:
+            while not self._stopped:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                fn = heapq.heappop(self._heap)[2]
+                self._condition.release()
+                try:
+                    fn()
+                finally:
+                    self._condition.acquire()
+        finally:
+            self._condition.release()
+
+def _drain(stream, buffer):
+    """Reads a stream into an OutputBuffer until it closes"""
+    fd = stream.fileno()
+    while True:
+        try:
+            data = os.read(fd, READ_CHUNK_SIZE)
+        except OSError:
+            break
+        if not data:
+            break # EOF: Poly/ML has exited
+        buffer.append(data)
 
 class PolyProcess:
-    """Controls the Poly/ML process."""
+    """Controls the Poly/ML process.
+
+    poly_bin -- (optional) the path to the Poly/ML binary
+    chunked -- (optional) whether the listener should read the output of
+               Poly/ML in chunks (default: True); see PacketListener
+    record -- (optional) a file to record the session in (default:
+              RECORD_PATH); see poly.record
+    metrics -- (optional) a poly.metrics.Metrics to count the requests and
+               traffic in
+    killed -- whether kill() has been called
+    exit_reason -- once Poly/ML has exited (or closed its output), a
+                   description of why; otherwise None
+
+    When Poly/ML exits, every request still waiting for a response fails
+    straight away with a ProtocolError, as do any requests sent later.
+    """
 
-    def __init__(self, poly_bin='/usr/local/bin/poly'):
+    def __init__(self, poly_bin='/usr/local/bin/poly', chunked=True,
+                 record=None, metrics=None):
         self.request_id = 0
+        self.recorder = None
+        self.metrics = metrics
+        self.spawn_time = time.time()
+        self.killed = False
+        self.exit_reason = None
+        self._request_lock = threading.Lock()
+        # shared by all the PolyFutures for this process
+        self._responses = threading.Condition()
+        # the futures of requests waiting for responses, by id, and what to
+        # call when Poly/ML exits
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._exit_callbacks = []
         debug ("executing '%s'" % poly_bin, DEBUG_INFO)
 
         try:
-            self.pipe = Popen([poly_bin, "--ideprotocol"],
+            # unbuffered, as under Python 2, so that select() sees all the
+            # output that has not been read yet
+            self.pipe = Popen([poly_bin, "--ideprotocol"], bufsize=0,
                 stdin=PIPE, stdout=PIPE, stderr=PIPE)
         except OSError:
             raise ProtocolError('Could not run Poly/ML')
             return None
 
-        self.listener = PacketListener(self.pipe)
+        if record == None:
+            record = RECORD_PATH
+        if record != None:
+            from .record import Recorder
+            self.recorder = Recorder(record, poly_bin)
+
+        self.listener = PacketListener(self.pipe, chunked)
+        self.listener.recorder = self.recorder
+        self.listener.metrics = metrics
         self.listener.start()
 
+        self.writer = RequestWriter(self.pipe.stdin)
+        self.writer.recorder = self.recorder
+        self.writer.metrics = metrics
+        self.writer.start()
+
+        self.deadlines = DeadlineTimer()
+        self.deadlines.start()
+
+        # a weak reference, as the listener would otherwise keep this
+        # alive (and __del__ from being called)
+        ref = weakref.ref(self)
+        def exited():
+            process = ref()
+            if process != None:
+                process._exited()
+        self.listener.add_exit_callback(exited)
+
+        # nothing else reads stderr, and Poly/ML would block writing to it
+        # once the pipe filled up
+        self.stderr = OutputBuffer()
+        # (not a method, which would keep this alive while it runs)
+        drain = Thread(target=_drain, args=(self.pipe.stderr, self.stderr))
+        drain.daemon = True
+        drain.start()
+
     def __del__(self):
         if self.pipe != None:
             self.listener.kill()
+            self.writer.stop()
+            self.deadlines.stop()
             debug('Closing Poly/ML', DEBUG_INFO)
             if self.is_alive(): self.kill()
+        if self.recorder != None:
+            self.recorder.close()
 
     def write(self, s):
-        """Write a string to Poly/ML."""
-        self.pipe.stdin.write(s)
+        """Write a string to Poly/ML.
+
+        The string is queued for the writer thread, after any requests
+        already queued, so this does not wait for Poly/ML to read it.
+        """
+        self.writer.send([s])
+
+    def output(self):
+        """Returns the end of Poly/ML's output that was not part of the
+        protocol (eg: from the program being compiled), as a string."""
+        return self.listener.output.text()
+
+    def errors(self):
+        """Returns the end of what Poly/ML wrote to stderr, as a string."""
+        return self.stderr.text()
+
+    def output_stats(self):
+        """Returns the OutputBuffer.stats() of the non-protocol output, as
+        'stdout', and of stderr, as 'stderr'."""
+        return {'stdout': self.listener.output.stats(),
+                'stderr': self.stderr.stats()}
+
+    def is_ready(self):
+        """Whether Poly/ML has completed its handshake."""
+        return self.listener.ready.is_set()
+
+    def wait_ready(self, timeout=None):
+        """Wait for Poly/ML to complete its handshake.
+
+        timeout -- (optional) the maximum time to wait, in seconds
+
+        Returns whether Poly/ML is ready.
+        """
+        self.listener.ready.wait(timeout)
+        return self.is_ready()
+
+    def when_ready(self, fn):
+        """Call fn (with no arguments) once Poly/ML has completed its
+        handshake, or immediately if it already has.
+
+        fn will usually be called on the listener thread.
+        """
+        self.listener.add_ready_callback(fn)
+
+    def when_exited(self, fn):
+        """Call fn with this PolyProcess once Poly/ML has exited (or closed
+        its output), after its requests have failed; or immediately, if it
+        already has.
+
+        fn will usually be called on the listener thread.
+        """
+        self._pending_lock.acquire()
+        exited = self.exit_reason != None
+        if not exited:
+            self._exit_callbacks.append(fn)
+        self._pending_lock.release()
+        if exited:
+            fn(self)
+
+    def _exited(self):
+        """Fails everything waiting for Poly/ML, once it has gone"""
+        # it closes its output as it exits, so give it a moment to finish
+        status = self.pipe.poll()
+        for i in range(10):
+            if status != None:
+                break
+            time.sleep(0.01)
+            status = self.pipe.poll()
+        if self.killed:
+            reason = 'Poly/ML was stopped'
+        elif status == None:
+            reason = 'Poly/ML stopped responding'
+        elif status < 0:
+            reason = 'Poly/ML was killed by signal {0}'.format(-status)
+        else:
+            reason = 'Poly/ML exited with status {0}'.format(status)
+        errors = self.errors().strip()
+        if errors and not self.killed:
+            reason += ': ' + errors.splitlines()[-1]
+
+        if self.killed:
+            debug(reason, DEBUG_INFO)
+        else:
+            debug(reason, DEBUG_WARN)
+        error = ProtocolError(reason)
+        # fails what is queued, and everything sent from now on
+        self.writer._fail(error, [])
+        self.deadlines.stop()
+        self._pending_lock.acquire()
+        self.exit_reason = reason
+        pending = list(self._pending.values())
+        self._pending.clear()
+        callbacks = self._exit_callbacks
+        self._exit_callbacks = []
+        self._pending_lock.release()
+        for f in pending:
+            f.set_exception(error)
+        for fn in callbacks:
+            fn(self)
 
     def is_alive(self):
         """Whether Poly/ML is running."""
-        return (self.pipe.poll() == None)
+        return self.pipe.poll() == None and not self.listener.exited.is_set()
 
     def kill(self):
         """Kills Poly/ML."""
+        self.killed = True
         self.pipe.terminate()
+        if self.recorder != None:
+            self.recorder.flush()
 
     def sync_request(self, code, args, timeout=2):
         """Send a request to Poly/ML and wait for the response.
@@ -333,56 +1521,155 @@ class PolyProcess:
 
         Returns a Packet object.
         Raises a Timeout exception if no response was received after timeout
-        seconds.
+        seconds, and gives up on the request (see send_requests()).
         """
-        packet_ready = threading.Condition()
-        packet = []
-
-        def h(p):
-            debug("handler called", DEBUG_FINE)
-            debug(repr(p), DEBUG_FINE)
-
-            packet_ready.acquire()
-            packet.append(p)
-            packet_ready.notify()
-            packet_ready.release()
-
-        packet_ready.acquire()
-        rid = self.send_request(code, args, h)
-        packet_ready.wait(timeout)
-        packet_ready.release()
-
-        debug("returning packet", DEBUG_FINE)
-        if len(packet) == 1:
-            return packet[0]
-        else:
-            debug("Request timed out", DEBUG_INFO)
-            raise Timeout()
+        # the deadline fails the future if there is no response in time
+        return self.send_request(code, args, timeout=timeout).result()
+
+    def batch_request(self, requests, timeout=2):
+        """Send several requests to Poly/ML at once and wait for the responses.
 
-    def send_request(self, code, args, handler = None):
+        requests -- a list of (code, args) pairs, as for sync_request()
+        timeout -- (optional) the maximum time to wait for all the responses,
+                   in seconds (default: 2); pass None to wait indefinitely
+
+        Returns a list of Packet objects, in the same order as requests.
+        Raises a Timeout exception if not all the responses were received
+        after timeout seconds, and gives up on the requests that were not
+        answered.
+        """
+        return wait_all(self.send_requests(requests, timeout))
+
+    def send_requests(self, requests, timeout=None):
+        """Send several requests to Poly/ML together.
+
+        requests -- a list of (code, args) or (code, args, handler) tuples,
+                    with the same meanings as for send_request()
+        timeout -- (optional) how long to wait for the responses, in
+                   seconds; None (the default) means wait indefinitely
+
+        Poly/ML will work through the requests while the responses are read,
+        so this costs one round trip rather than one per request.
+
+        A request that has not been answered once the timeout has passed
+        is given up on: its handlers are removed (so they will never be
+        called), its future fails with Timeout, and if it was a compilation,
+        Poly/ML is asked to cancel it.
+
+        Requests that Poly/ML does not respond to (see NO_RESPONSE) have no
+        handlers; their futures are done, with an empty Packet, as soon as
+        they are queued.
+
+        Returns a list of PolyFuture objects, in the same order as requests.
+        """
+        futures = []
+        pieces = []
+        self._request_lock.acquire()
+        try:
+            for request in requests:
+                code, args = request[0], request[1]
+                f = PolyFuture(self.request_id, code.upper(), self._responses)
+                futures.append(f)
+                pieces.append(request_chunks(f.rid, code, args))
+                self.request_id += 1
+                if f.code in NO_RESPONSE:
+                    continue
+                self._track(f)
+                self.add_handler(f.rid, f.set_result)
+                if len(request) > 2 and request[2]:
+                    handler = request[2]
+                    if hasattr(handler, '__call__'):
+                        self.add_handler(f.rid, handler)
+                    else:
+                        for h in handler:
+                            self.add_handler(f.rid, h)
+                if timeout != None:
+                    self._add_deadline(f, timeout)
+            if self.metrics != None:
+                self._measure(futures)
+            if trace.enabled():
+                self._trace(futures)
+            # queued while holding the lock, so requests are written in
+            # order of id
+            self.writer.send(itertools.chain(*pieces), futures)
+        finally:
+            self._request_lock.release()
+        for f in futures:
+            if f.code in NO_RESPONSE:
+                f.set_result(Packet())
+        return futures
+
+    def _track(self, f):
+        """Keeps a future in self._pending until it is done"""
+        # not a method of self, which would then be kept alive by the
+        # future while the listener holds it
+        pending, lock = self._pending, self._pending_lock
+        def forget(f):
+            lock.acquire()
+            pending.pop(f.rid, None)
+            lock.release()
+        lock.acquire()
+        pending[f.rid] = f
+        lock.release()
+        f.add_done_callback(forget)
+
+    def _add_deadline(self, f, timeout):
+        # a weak reference, so that the timer does not keep this alive
+        ref = weakref.ref(self)
+        def expire():
+            process = ref()
+            if process != None:
+                process._expire(f)
+        self.deadlines.add(time.time() + timeout, expire)
+
+    def _expire(self, f):
+        """Gives up on a request that has not been answered in time"""
+        if f.done() or self.listener.remove_handlers(f.rid) == None:
+            return # answered (or being answered) in time
+        debug('Request {0} ({1}) expired'.format(f.rid, f.code), DEBUG_INFO)
+        trace.instant('expire', f.code, {'rid': f.rid})
+        if f.metrics != None:
+            f.metrics.timed_out(f.code)
+        f.set_exception(Timeout())
+        if f.code == 'R':
+            # otherwise Poly/ML would carry on compiling ahead of any new
+            # requests
+            self.send_request('K', [f.rid])
+
+    def _measure(self, futures):
+        metrics = self.metrics
+        start = time.time()
+        def finished(f):
+            metrics.finished(f.code, time.time() - start, f._error != None)
+        metrics.sent([f.code for f in futures])
+        for f in futures:
+            f.metrics = metrics
+            f.add_done_callback(finished)
+
+    def _trace(self, futures):
+        t = trace.start()
+        def finished(f):
+            trace.end(t, 'request', f.code, {'rid': f.rid})
+        for f in futures:
+            f.add_done_callback(finished)
+
+    def send_request(self, code, args, handler = None, timeout=None):
         """Send a request to Poly/ML.
 
         code -- the request code (a single letter)
         args -- a list of arguments (strings)
         handler -- (optional) a method (or list of methods) to
                    call when the response is received
+        timeout -- (optional) how long to wait for the response, in seconds,
+                   before giving up on the request (see send_requests())
 
         Any handler methods must accept one arguments: the received Packet.
+        They are called on the listener thread.
 
-        Returns the id of the request (an int).
+        Returns a PolyFuture for the response; its rid attribute is the id
+        of the request.
         """
-        request_string = '\x1b{0}{1}\x1b,{2}\x1b{3}'.format(
-            code.upper(), self.request_id,
-            '\x1b,'.join([str(x) for x in args]), code.lower())
-        if handler:
-            if hasattr(handler, '__call__'):
-                self.add_handler(self.request_id, handler)
-            else:
-                for h in handler:
-                    self.add_handler(self.request_id, h)
-        self.write(request_string)
-        self.request_id += 1
-        return (self.request_id - 1)
+        return self.send_requests([(code, args, handler)], timeout)[0]
 
     def add_handler(self, rid, h):
         """Add a handler for a given request/response id.
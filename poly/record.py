@@ -0,0 +1,276 @@
+import os
+import sys
+import time
+import struct
+import threading
+from . import process
+from .process import PacketListener, PacketTokenizer
+
+"""Recording and replaying IDE protocol sessions
+
+A Recorder keeps everything written to and read from a Poly/ML process,
+with timestamps, so that a session can be replayed later without Poly/ML.
+Recording is turned on by setting poly.process.RECORD_PATH (or passing
+PolyProcess a record path).  Each process adds a session to the file; the
+processes recording to a file share one handle on it, and each record is
+tagged with its session, so sessions that overlap (eg: with a spare
+process, or a PolyPool) can be told apart.
+
+replay() feeds the responses of a recorded session back through the real
+PacketListener, and reads the compilation responses the way Poly does, so
+that they can be profiled against real-world traffic.  From the command
+line:
+
+    python -m poly.record session.log [--session=N] [--realtime] [--per-byte]
+                                      [--profile]
+"""
+
+# a record is: direction, session number, seconds since the session
+# started, data length; then the data
+_header = struct.Struct('>cIdI')
+
+# record directions: the start of a session (the data is the binary run),
+# data written to Poly/ML, and data read from it
+SESSION = b'S'
+REQUEST = b'>'
+RESPONSE = b'<'
+
+# the files being recorded to, by path: [file, lock, number of Recorders
+# using it]
+_files = {}
+_files_lock = threading.Lock()
+_sessions = [0] # the number of the next session
+
+def _open(path):
+    """Returns the shared [file, lock, users] entry for a path, opening the
+    file if no Recorder has it open, and a new session number."""
+    _files_lock.acquire()
+    try:
+        entry = _files.get(path)
+        if entry == None:
+            entry = [open(path, 'ab'), threading.Lock(), 0]
+            _files[path] = entry
+        entry[2] += 1
+        session = _sessions[0]
+        _sessions[0] = (session + 1) % (1 << 32)
+        return entry, session
+    finally:
+        _files_lock.release()
+
+def _close(path, entry):
+    """Closes a file opened with _open(), once no Recorder is using it."""
+    _files_lock.acquire()
+    try:
+        entry[2] -= 1
+        if entry[2] == 0:
+            if _files.get(path) is entry:
+                del _files[path]
+            entry[1].acquire()
+            try:
+                entry[0].close()
+            finally:
+                entry[1].release()
+    finally:
+        _files_lock.release()
+
+class Recorder:
+    """Appends the data sent to and received from a Poly/ML process to a
+    file, as a session of its own.
+
+    path -- the file to record to
+    poly_bin -- (optional) the Poly/ML binary, noted at the start of the
+                session
+
+    All methods are thread-safe.
+    """
+
+    def __init__(self, path, poly_bin=''):
+        self.path = path
+        self._entry, self.session = _open(path)
+        self._closed = False
+        self._start = time.time()
+        self._write(SESSION, '{0}\t{1}'.format(self._start, poly_bin))
+
+    def _write(self, direction, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        f, lock, users = self._entry
+        lock.acquire()
+        try:
+            if not self._closed:
+                # one write, so that the record is never split
+                f.write(_header.pack(direction, self.session,
+                                     time.time() - self._start,
+                                     len(data)) + data)
+        finally:
+            lock.release()
+
+    def request(self, data):
+        """Records data written to Poly/ML."""
+        self._write(REQUEST, data)
+
+    def response(self, data):
+        """Records data read from Poly/ML."""
+        if data:
+            self._write(RESPONSE, data)
+
+    def flush(self):
+        f, lock, users = self._entry
+        lock.acquire()
+        try:
+            if not self._closed:
+                f.flush()
+        finally:
+            lock.release()
+
+    def close(self):
+        f, lock, users = self._entry
+        lock.acquire()
+        try:
+            closed = self._closed
+            self._closed = True
+            if not closed:
+                f.flush()
+        finally:
+            lock.release()
+        if not closed:
+            _close(self.path, self._entry)
+
+def read_sessions(path):
+    """Reads the sessions recorded in a file.
+
+    Returns a list of sessions, in the order they started, each a list of
+    (direction, time, data) records in the order they were recorded; time
+    is in seconds from the start of the session.  A record cut short (eg:
+    by a crash) ends the file.
+    """
+    sessions = []
+    # the sessions by number; a number is reused for a later session when
+    # a new program starts recording to the file
+    current = {}
+    f = open(path, 'rb')
+    try:
+        while True:
+            header = f.read(_header.size)
+            if len(header) < _header.size:
+                break
+            direction, session, t, length = _header.unpack(header)
+            if not direction in (SESSION, REQUEST, RESPONSE):
+                break # not a recording, or not one in this format
+            data = f.read(length)
+            if len(data) < length:
+                break
+            if direction == SESSION or not session in current:
+                current[session] = []
+                sessions.append(current[session])
+            current[session].append((direction, t, data))
+    finally:
+        f.close()
+    return sessions
+
+def _requests(session):
+    """Returns a dict of (code, args) for the requests in a session, by
+    request id."""
+    requests = {}
+    tokenizer = PacketTokenizer(process.PROTOCOL_ENCODING)
+    for direction, t, data in session:
+        if direction == REQUEST:
+            for packet in tokenizer.feed(data):
+                tokens = list(packet.tokens)
+                fields = [tok for tok in tokens[1:] if not hasattr(tok, 'code')]
+                if fields:
+                    requests[int(fields[0])] = (tokens[0].code, fields[1:])
+    return requests
+
+class _Pipe:
+    """Stands in for the Popen object of a Poly/ML process"""
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+def replay(path, session=-1, realtime=False, chunked=True):
+    """Feeds the responses of a recorded session through a PacketListener.
+
+    path -- the recording
+    session -- (optional) which session in the file to replay (default: the
+               last one)
+    realtime -- (optional) whether to reproduce the timing of the
+                responses, rather than replaying them as fast as possible
+    chunked -- (optional) whether the listener reads in chunks; see
+               PacketListener
+
+    Every response is dispatched as it would be to PolyProcess's handlers,
+    and compilation responses are parsed as Poly would.
+
+    Returns a dict of the number of bytes, responses and compilation
+    responses replayed, and how long it took in seconds.
+    """
+    from . import Poly
+    records = read_sessions(path)[session]
+    requests = _requests(records)
+    data = [(t, d) for direction, t, d in records if direction == RESPONSE]
+
+    stats = {'bytes': 0, 'responses': 0, 'compiles': 0}
+    for t, d in data:
+        stats['bytes'] += len(d)
+    poly = Poly()
+
+    r, w = os.pipe()
+    # Popen gives an unbuffered pipe, so do the same here
+    listener = PacketListener(_Pipe(os.fdopen(r, 'rb', 0)), chunked)
+    def handler(packet):
+        stats['responses'] += 1
+        code, args = requests.get(int(packet.peek(1)), (None, []))
+        if code == 'R':
+            stats['compiles'] += 1
+            poly._read_compile_response(packet, args and args[0] or '')
+    for rid in requests:
+        listener.add_handler(rid, handler)
+
+    start = time.time()
+    def feed():
+        for t, d in data:
+            if realtime:
+                delay = start + t - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            while d:
+                d = d[os.write(w, d):]
+        os.close(w)
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    try:
+        # reads until the feeder closes the pipe
+        listener.run()
+    finally:
+        feeder.join()
+        listener.input.close()
+    stats['time'] = time.time() - start
+    return stats
+
+def main(args):
+    if not args or args[0].startswith('-'):
+        sys.stderr.write('usage: python -m poly.record session.log '
+                         '[--session=N] [--realtime] [--per-byte] '
+                         '[--profile]\n')
+        return 2
+    path = args[0]
+    realtime = '--realtime' in args
+    chunked = not '--per-byte' in args
+    session = -1
+    for arg in args:
+        if arg.startswith('--session='):
+            session = int(arg[len('--session='):])
+    if '--profile' in args:
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        stats = profile.runcall(replay, path, session, realtime, chunked)
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(25)
+    else:
+        stats = replay(path, session, realtime, chunked)
+    print('{0} bytes, {1} responses ({2} compilations) in {3:.3f}s'.format(
+        stats['bytes'], stats['responses'], stats['compiles'], stats['time']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,174 @@
+import time
+import threading
+from .process import ProtocolError, debug
+
+"""Scheduling of compilations for editors that compile as the user types
+
+CompileScheduler sits in front of a Poly (or PolyPool) and makes sure that
+rapid requests to compile the same file converge on its newest text, rather
+than being refused while an older version is compiling.
+"""
+
+class CompileScheduler:
+    """Compiles files as they change, always compiling the newest code.
+
+    poly -- the Poly (or PolyPool) to compile with
+    debounce -- how long to wait, in seconds, after a compilation is
+                requested before starting it, in case a newer one replaces
+                it (default: 0)
+    superseded -- the number of pending compilations that were replaced
+                  by newer ones before they started
+    cancelled -- the number of compilations that were cancelled while
+                 Poly/ML was running them
+
+    There is at most one pending compilation for each file; requesting
+    another replaces it.  If a file is being compiled when a newer version
+    is requested, the compilation in progress is cancelled (with a K
+    request), and the newer version is compiled as soon as it stops.
+    Compilations of different files only wait for each other when the Poly
+    instance cannot run them at the same time.
+    """
+
+    def __init__(self, poly, debounce=0):
+        self.poly = poly
+        self.debounce = debounce
+        self.superseded = 0
+        self.cancelled = 0
+        # file -> (due time, (prelude, source, handler, saved_state))
+        self._pending = {}
+        # file -> [request id, whether it has been cancelled]
+        self._running = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, file, prelude, source, handler, saved_state=None,
+                 debounce=None):
+        """Requests a compilation
+
+        file, prelude, source, handler, saved_state -- as for Poly.compile
+        debounce -- (optional) overrides self.debounce for this request
+
+        The handler is called with the result code 'C' and an empty
+        MessageList if the compilation is replaced by a newer one before it finishes.  If
+        Poly/ML could not be run when the compilation was due to start, it
+        is called with the result code None and a message giving the error.
+
+        raises poly.process.ProtocolError if Poly/ML could not be started
+        """
+        if debounce == None:
+            debounce = self.debounce
+        self.poly.start()
+        self._condition.acquire()
+        try:
+            old = self._pending.pop(file, None)
+            self._pending[file] = (time.time() + debounce,
+                                   (prelude, source, handler, saved_state))
+            self._cancel_running(file)
+            if self._thread == None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        if old != None:
+            from . import MessageList
+            self.superseded += 1
+            old[1][2]('C', MessageList())
+
+    def cancel(self, file):
+        """Drops the pending compilation of a file, and cancels the one in
+        progress, if there is one."""
+        self._condition.acquire()
+        try:
+            old = self._pending.pop(file, None)
+            self._cancel_running(file)
+        finally:
+            self._condition.release()
+        if old != None:
+            from . import MessageList
+            old[1][2]('C', MessageList())
+
+    def is_busy(self, file):
+        """Whether a compilation of a file is pending or in progress."""
+        return file in self._pending or file in self._running
+
+    def _cancel_running(self, file):
+        """Sends K for the compilation of file in progress.  Must be called
+        with self._condition held."""
+        running = self._running.get(file)
+        if running != None and running[0] != None and not running[1]:
+            debug('Cancelling out of date compilation of {0}'.format(file))
+            running[1] = True
+            self.cancelled += 1
+            try:
+                self.poly.cancel_compile(running[0], file)
+            except ProtocolError:
+                pass # it will not finish anyway
+
+    def _start(self, file, failed):
+        """Starts the pending compilation of a file.  Must be called with
+        self._condition held.
+
+        Returns False if the Poly instance is busy, so it must be retried.
+        """
+        due, request = self._pending.pop(file)
+        prelude, source, handler, saved_state = request
+        entry = [None, False]
+        self._running[file] = entry
+
+        def finished(result_code, messages):
+            self._condition.acquire()
+            if self._running.get(file) is entry:
+                del self._running[file]
+            self._condition.notify()
+            self._condition.release()
+            handler(result_code, messages)
+
+        try:
+            rid = self.poly.compile(file, prelude, source, finished, saved_state)
+        except ProtocolError as e:
+            del self._running[file]
+            failed.append((handler, e))
+            return True
+        if rid == -1:
+            del self._running[file]
+            self._pending[file] = (due, request)
+            return False
+        entry[0] = rid
+        return True
+
+    def _run(self):
+        from . import PolyMessage, MessageList
+        self._condition.acquire()
+        try:
+            while True:
+                failed = []
+                busy = False
+                now = time.time()
+                for file, (due, request) in list(self._pending.items()):
+                    if due <= now and not file in self._running:
+                        if not self._start(file, failed):
+                            busy = True
+
+                if failed:
+                    self._condition.release()
+                    try:
+                        for handler, e in failed:
+                            handler(None, MessageList([PolyMessage('E',
+                                'Could not run Poly/ML: ' + str(e))]))
+                    finally:
+                        self._condition.acquire()
+                    continue
+
+                waits = [due - now for file, (due, request) in self._pending.items()
+                         if due > now and not file in self._running]
+                if busy:
+                    # Poly/ML is compiling something we did not start
+                    waits.append(0.1)
+                if waits:
+                    self._condition.wait(min(waits))
+                else:
+                    self._condition.wait()
+        finally:
+            self._condition.release()
@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import time
+import zlib
+import hashlib
+try:
+    import sqlite3
+except ImportError:
+    # eg: the Python embedded in some editors; see available()
+    sqlite3 = None
+
+"""Persistent storage of file indexes
+
+IndexStore keeps the type and declaration information gathered by
+indexing files (see poly.index) in an SQLite database, so that it can be
+used in later sessions without compiling the files again.
+"""
+
+# the name of the database in a .polysave directory
+STORE_NAME = 'polyml-index.db'
+
+# the version of the format of the entries; entries in any other format
+# are ignored
+STORE_FORMAT = 1
+
+def available():
+    """Whether index stores can be used (Python has the sqlite3 module)."""
+    return sqlite3 != None
+
+def content_hash(source):
+    """Returns the key for the contents of a file."""
+    if not isinstance(source, bytes):
+        source = source.encode('utf-8')
+    return hashlib.sha1(source).hexdigest()
+
+def store_path_for(path):
+    """Returns the index store for a file: the one in the .polysave
+    directory next to it."""
+    return os.path.join(os.path.dirname(path), '.polysave', STORE_NAME)
+
+def native_strings(value):
+    """Converts the unicode strings json gives under Python 2 back to the
+    UTF-8 byte strings the rest of the package uses there."""
+    if isinstance(value, list):
+        return [native_strings(v) for v in value]
+    if isinstance(value, dict):
+        return dict([(native_strings(k), native_strings(v))
+                     for k, v in value.items()])
+    if sys.version_info[0] < 3 and isinstance(value, type(u'')):
+        return value.encode('utf-8')
+    return value
+
+class IndexStore:
+    """An SQLite database of file indexes.
+
+    path -- the database file (and its directory) are created if they do
+            not exist
+
+    Each file has at most one entry, for the contents it had when it was
+    indexed.  The entries are compressed JSON, so the data can only be
+    lists, dicts, strings, numbers, booleans and None (tuples come back as
+    lists).  Stores live in project directories, which may come from
+    anywhere, so nothing read from one is trusted to be more than that.  A
+    connection is opened for each operation, so a store can be used from
+    any thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self, create=True):
+        """Opens the store; unless create is set, only if it exists.
+
+        Returns a sqlite3 connection, or None.
+        """
+        if not create:
+            if not os.path.exists(self.path):
+                return None
+            return sqlite3.connect(self.path, 10)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        db = sqlite3.connect(self.path, 10)
+        db.execute('CREATE TABLE IF NOT EXISTS indexes ('
+                   'path TEXT PRIMARY KEY, hash TEXT, saved REAL, data BLOB)')
+        return db
+
+    def get(self, path, hash):
+        """Returns the data stored for a file, or None if there is none for
+        these contents (or the entry or the store cannot be read)."""
+        try:
+            db = self._connect(False)
+            if db == None:
+                return None
+            try:
+                row = db.execute('SELECT data FROM indexes '
+                                 'WHERE path = ? AND hash = ?',
+                                 (path, hash)).fetchone()
+            finally:
+                db.close()
+            if row == None:
+                return None
+            entry = json.loads(zlib.decompress(bytes(row[0])).decode('utf-8'))
+            if (not isinstance(entry, dict) or
+                    entry.get('format') != STORE_FORMAT):
+                return None
+            return native_strings(entry.get('data'))
+        except Exception:
+            # a missing or damaged store is just an empty one
+            return None
+
+    def put(self, path, hash, data):
+        """Stores the data for a file, replacing any older entry."""
+        entry = json.dumps({'format': STORE_FORMAT, 'data': data})
+        blob = sqlite3.Binary(zlib.compress(entry.encode('utf-8')))
+        try:
+            db = self._connect()
+            try:
+                db.execute('INSERT OR REPLACE INTO indexes VALUES (?, ?, ?, ?)',
+                           (path, hash, time.time(), blob))
+                db.commit()
+            finally:
+                db.close()
+        except (sqlite3.Error, OSError):
+            pass
+
+    def remove(self, path):
+        """Deletes the entry for a file."""
+        try:
+            db = self._connect(False)
+            if db == None:
+                return
+            try:
+                db.execute('DELETE FROM indexes WHERE path = ?', (path,))
+                db.commit()
+            finally:
+                db.close()
+        except (sqlite3.Error, OSError):
+            pass
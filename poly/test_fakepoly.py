@@ -0,0 +1,555 @@
+import os
+import json
+import zlib
+import pickle
+import sqlite3
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from . import (Poly, PolyPool, MessageList, CompileCache, CompileScheduler,
+               fakepoly)
+from . import process, record, store
+from . import incremental
+from .process import (PacketTokenizer, PacketListener, PolyProcess,
+                      ListenerKilled, Timeout, PROTOCOL_ENCODING)
+
+"""Tests of the poly package against the stand-in server in poly.fakepoly
+
+These need no Poly/ML binary (run_tests() in poly/__init__.py is the test
+against the real one).  Run them with
+
+    python -m poly.test_fakepoly
+
+or with any test runner that finds unittest test cases.
+"""
+
+# the stand-in for the Poly/ML binary
+FAKE_POLY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fakepoly.py')
+
+ESC = '\x1b'
+
+def wait_for(condition, timeout=5):
+    """Waits until condition() is true, or the timeout passes
+
+    Returns the last value of condition().
+    """
+    end = time.time() + timeout
+    result = condition()
+    while not result and time.time() < end:
+        time.sleep(0.01)
+        result = condition()
+    return result
+
+def tokens(packets):
+    """Returns the tokens of some packets, in a form that can be compared"""
+    return [repr(packet.tokens) for packet in packets]
+
+class _Pipe:
+    """Stands in for the Popen object of a Poly/ML process"""
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+class FakePolyTestCase(unittest.TestCase):
+    """Keeps track of the Poly/ML processes a test starts, and of the
+    settings of poly.fakepoly, so that neither outlives the test."""
+
+    def setUp(self):
+        self._environ = dict(os.environ)
+        self._polys = []
+
+    def tearDown(self):
+        for poly in self._polys:
+            for worker in getattr(poly, 'workers', [poly]):
+                for p in [worker.process, worker._spare_process]:
+                    if p != None and p.pipe.poll() == None:
+                        p.kill()
+        os.environ.clear()
+        os.environ.update(self._environ)
+
+    def fake(self, **settings):
+        """Sets FAKEPOLY_ environment variables for the next processes"""
+        for name, value in settings.items():
+            os.environ['FAKEPOLY_' + name.upper()] = str(value)
+
+    def poly(self, **kwargs):
+        """Returns a Poly (or PolyPool, if size is given) using fakepoly"""
+        if 'size' in kwargs:
+            poly = PolyPool(FAKE_POLY, **kwargs)
+        else:
+            poly = Poly(FAKE_POLY, **kwargs)
+        self._polys.append(poly)
+        return poly
+
+class TokenizerTests(unittest.TestCase):
+    def setUp(self):
+        errors = [('a.ML', i * 10, i * 10 + 5, 'error ' + ESC + ' ' + str(i))
+                  for i in range(3)]
+        # the per-byte reader expects a packet first, like Poly/ML's
+        # handshake
+        self.data = (fakepoly.compile_response(1, 2, 'F', 30, errors) +
+                     b'noise between' +
+                     fakepoly._bytes(fakepoly._packet('O', 2, 1, 0, 3, 'T')))
+        self.expected = PacketTokenizer(PROTOCOL_ENCODING).feed(self.data)
+
+    def test_whole(self):
+        self.assertEqual(len(self.expected), 2)
+        self.assertEqual(self.expected[0].peek().code, 'R')
+        self.assertEqual(self.expected[1].peek().code, 'O')
+
+    def test_chunk_boundaries(self):
+        # every split point, including between an ESC and its code, and
+        # between the two ESCs of an escaped ESC
+        for i in range(len(self.data) + 1):
+            tokenizer = PacketTokenizer(PROTOCOL_ENCODING)
+            packets = (tokenizer.feed(self.data[:i]) +
+                       tokenizer.feed(self.data[i:]))
+            self.assertEqual(tokens(packets), tokens(self.expected))
+
+    def test_single_bytes(self):
+        tokenizer = PacketTokenizer(PROTOCOL_ENCODING)
+        packets = []
+        for i in range(len(self.data)):
+            packets += tokenizer.feed(self.data[i:i+1])
+        self.assertEqual(tokens(packets), tokens(self.expected))
+
+    def test_escaped_esc(self):
+        poly = Poly()
+        result_code, messages = poly._read_compile_response(
+            self.expected[0].copy(), 'a.ML')
+        self.assertEqual(result_code, 'F')
+        self.assertEqual([m.raw_text for m in messages],
+                         ['error ' + ESC + ' ' + str(i) for i in range(3)])
+
+    def test_noise(self):
+        noise = []
+        tokenizer = PacketTokenizer(PROTOCOL_ENCODING, noise.append)
+        tokenizer.feed(self.data)
+        self.assertEqual(b''.join(noise), b'noise between')
+
+    def test_multibyte(self):
+        # characters of more than one byte split between reads
+        text = u'Type error: \u03b1 \u2192 \u03b2 \U0001d4ae'
+        data = fakepoly.compile_response(1, 2, 'F', 30, [('a.ML', 0, 5, text)])
+        if PROTOCOL_ENCODING == None:
+            text = text.encode('utf-8')
+        tokenizer = PacketTokenizer(PROTOCOL_ENCODING)
+        packets = []
+        for i in range(len(data)):
+            packets += tokenizer.feed(data[i:i+1])
+        for packet in packets + self.read_all(True, data, 1):
+            result_code, messages = Poly()._read_compile_response(packet,
+                                                                  'a.ML')
+            self.assertEqual([m.raw_text for m in messages], [text])
+
+    def read_all(self, chunked, data=None, size=None):
+        """Reads the packets in data (by default, self.data) from a pipe,
+        written size bytes at a time (by default, all at once)."""
+        if data == None:
+            data = self.data
+        r, w = os.pipe()
+        listener = PacketListener(_Pipe(os.fdopen(r, 'rb', 0)), chunked)
+        def feed():
+            if size == None:
+                fakepoly._write_all(w, data)
+            else:
+                for i in range(0, len(data), size):
+                    fakepoly._write_all(w, data[i:i+size])
+                    time.sleep(0.001)
+            os.close(w)
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        packets = []
+        try:
+            try:
+                for packet in listener.read_packets():
+                    packets.append(packet)
+            except ListenerKilled:
+                pass
+        finally:
+            feeder.join()
+            listener.input.close()
+        return packets
+
+    def test_readers(self):
+        self.assertEqual(tokens(self.read_all(True)), tokens(self.expected))
+        self.assertEqual(tokens(self.read_all(False)), tokens(self.expected))
+
+class ProcessTests(FakePolyTestCase):
+    def process(self, chunked=True):
+        p = PolyProcess(FAKE_POLY, chunked)
+        self._polys.append(Poly())
+        self._polys[-1].process = p
+        self.assertTrue(p.wait_ready(10))
+        return p
+
+    def test_requests(self):
+        for chunked in [True, False]:
+            p = self.process(chunked)
+            node = p.sync_request('O', ['1', 3, 3], 5)
+            self.assertEqual(node.peek().code, 'O')
+            futures = p.send_requests([('O', ['1', i, i]) for i in range(10)],
+                                      5)
+            self.assertEqual([int(f.result().peek(5)) for f in futures],
+                             list(range(10)))
+
+    def test_deadline(self):
+        self.fake(latency=0.3)
+        p = self.process()
+        start = time.time()
+        self.assertRaises(Timeout, p.sync_request, 'O', ['1', 0, 0], 0.05)
+        self.assertTrue(time.time() - start < 0.25)
+        # the late response is ignored, and later requests still work
+        node = p.sync_request('O', ['1', 5, 5], 5)
+        self.assertEqual(int(node.peek(5)), 5)
+        self.assertTrue(p.is_alive())
+
+class PoolTests(FakePolyTestCase):
+    def test_workers(self):
+        pool = self.poly(size=2)
+        for path in ['/a.ML', '/b.ML']:
+            self.assertEqual(pool.compile_sync(path, '', 'val x = 1;')[0], 'S')
+        a, b = pool.worker_for('/a.ML'), pool.worker_for('/b.ML')
+        self.assertTrue(a is not b)
+        # queries go to the worker holding the file's parse tree
+        for path, worker, other in [('/a.ML', a, b), ('/b.ML', b, a)]:
+            self.assertTrue(path in worker._parse_trees)
+            self.assertFalse(path in other._parse_trees)
+            node = pool.node_for_position(path, 4)
+            self.assertEqual(node.parse_tree, worker._parse_trees[path])
+            self.assertEqual(pool.type_for_node(node), 'int')
+            self.assertEqual(pool.types_for_nodes([node]), ['int'])
+        self.assertEqual(pool.node_for_position('/c.ML', 4), None)
+
+    def test_parallel(self):
+        self.fake(latency=0.3)
+        pool = self.poly(size=2)
+        pool.start()
+        for worker in pool.workers:
+            self.assertTrue(wait_for(lambda: worker.process != None and
+                                             worker.process.wait_ready(10)))
+        results = []
+        start = time.time()
+        for path in ['/a.ML', '/b.ML']:
+            pool.compile(path, '', 'val x = 1;',
+                         lambda c, m: results.append(c))
+        self.assertTrue(wait_for(lambda: len(results) == 2))
+        self.assertEqual(results, ['S', 'S'])
+        self.assertTrue(time.time() - start < 0.55)
+
+    def test_cancel(self):
+        pool = self.poly(size=2)
+        for path in ['/a.ML', '/b.ML']:
+            pool.compile_sync(path, '', 'val x = 1;')
+        cancelled = []
+        for worker in pool.workers:
+            def cancel(rid, file=None, worker=worker):
+                cancelled.append((worker, rid))
+            worker.cancel_compile = cancel
+        # the same request id is in use on both workers
+        pool.cancel_compile(3, '/b.ML')
+        self.assertEqual(cancelled, [(pool.worker_for('/b.ML'), 3)])
+
+class CacheTests(FakePolyTestCase):
+    def test_lazy_parse_tree(self):
+        self.fake(latency=0.2)
+        poly = self.poly(compile_cache=CompileCache())
+        old, new = 'val x = 1;', 'val xyz = 1;'
+        for source in [new, old, new]:
+            self.assertEqual(poly.compile_sync('/a.ML', '', source)[0], 'S')
+        # the last was answered from the cache, so Poly/ML's parse tree is
+        # of old, and is not queried while it cannot be rebuilt
+        self.assertTrue('/a.ML' in poly._lazy_compiles)
+        results = []
+        poly.compile('/b.ML', '', 'val y = 2;', lambda c, m: results.append(c))
+        self.assertEqual(poly.node_for_position('/a.ML', 5), None)
+        self.assertTrue(wait_for(lambda: results))
+        # then it is rebuilt before it is queried
+        node = poly.node_for_position('/a.ML', 5)
+        self.assertFalse('/a.ML' in poly._lazy_compiles)
+        self.assertEqual(node.parse_tree, poly._parse_trees['/a.ML'])
+
+class IncrementalTests(FakePolyTestCase):
+    declarations = ['val a = {0};\n', 'val b = {0};\n', 'val c = {0};\n',
+                    'val d = {0};\n']
+
+    def source(self, *versions):
+        return ''.join([d.format(v)
+                        for d, v in zip(self.declarations, versions)])
+
+    def checkpoints(self, poly):
+        return sorted(os.listdir(poly._checkpoints.directory))
+
+    def test_earlier_checkpoint(self):
+        poly = self.poly(incremental=True)
+        for versions in [(1, 1, 1, 1), (1, 2, 1, 1), (1, 3, 1, 1)]:
+            source = self.source(*versions)
+            self.assertEqual(poly.compile_sync('/f.ML', '', source)[0], 'S')
+        # the last was compiled from the checkpoint after the first
+        # declaration
+        b = len(self.declarations[0].format(1))
+        self.assertEqual(poly._tree_offsets['/f.ML'], b)
+        # a checkpoint is made after the third
+        source = self.source(1, 3, 1, 2)
+        self.assertEqual(poly.compile_sync('/f.ML', '', source)[0], 'S')
+        saved = self.checkpoints(poly)
+        self.assertEqual(len(saved), 3)
+        # then an edit between the two goes back to the first, rather than
+        # making another
+        source = self.source(1, 3, 2, 2)
+        self.assertEqual(poly.compile_sync('/f.ML', '', source)[0], 'S')
+        self.assertEqual(poly._tree_offsets['/f.ML'], b)
+        self.assertEqual(self.checkpoints(poly), saved)
+
+    def test_root(self):
+        poly = self.poly(incremental=True)
+        self.assertEqual(poly.compile_sync('/f.ML', '', 'val a = 1;')[0], 'S')
+        self.assertNotEqual(poly._checkpoints.root(), None)
+        self.assertFalse(poly._clean_env)
+
+    def test_root_failed(self):
+        save_checkpoint_code = incremental.save_checkpoint_code
+        def fail_root(path):
+            if path == poly._checkpoints.root_path():
+                return 'badprefix\n'
+            return save_checkpoint_code(path)
+        incremental.save_checkpoint_code = fail_root
+        try:
+            poly = self.poly(incremental=True)
+            # the compilation is sent again without the save, and the
+            # failure is not passed on
+            seen = []
+            self.assertEqual(poly.compile_sync('/f.ML', '', 'val a = 1;',
+                                               on_message=seen.append)[0],
+                             'S')
+            self.assertEqual(seen, [])
+        finally:
+            incremental.save_checkpoint_code = save_checkpoint_code
+        self.assertEqual(poly._checkpoints.root(), None)
+        self.assertTrue(poly._checkpoints.root_path() in poly._bad_prefixes)
+        self.assertFalse(poly._clean_env)
+        self.assertEqual(poly.compile_sync('/f.ML', '', 'val a = 2;')[0], 'S')
+
+class CrashTests(FakePolyTestCase):
+    def test_failover(self):
+        self.fake(crash=1)
+        poly = self.poly()
+        self.assertEqual(poly.compile_sync('/a.ML', '', 'val x = 1;')[0], 'S')
+        crashed = poly.process
+        results = []
+        poly.compile('/a.ML', '', 'crash', lambda c, m: results.append((c, m)))
+        self.assertTrue(wait_for(lambda: results, 2))
+        result_code, messages = results[0]
+        self.assertEqual(result_code, None)
+        self.assertTrue(isinstance(messages, MessageList))
+        self.assertTrue('exited' in messages[0].text)
+        self.assertFalse(poly.compile_in_progress)
+        # a new process takes over
+        self.assertEqual(poly.compile_sync('/a.ML', '', 'val x = 2;')[0], 'S')
+        self.assertTrue(poly.process is not crashed)
+        self.assertTrue(poly.stats()['restarts'] >= 1)
+
+    def test_spare(self):
+        self.fake(crash=1)
+        poly = self.poly(spare=True)
+        poly.start()
+        self.assertTrue(wait_for(lambda: poly._spare_process != None))
+        spare = poly._spare_process
+        self.assertTrue(spare.wait_ready(10))
+        poly.compile('/a.ML', '', 'crash', lambda c, m: None)
+        self.assertTrue(wait_for(lambda: poly.process is spare, 3))
+        self.assertEqual(poly.compile_sync('/a.ML', '', 'val x = 1;')[0], 'S')
+
+class SchedulerTests(FakePolyTestCase):
+    def test_supersede(self):
+        scheduler = CompileScheduler(self.poly(), 0.2)
+        results = []
+        def handler(name):
+            return lambda c, m: results.append((name, c, m))
+        scheduler.schedule('/a.ML', '', 'val x = 1;', handler('old'))
+        scheduler.schedule('/a.ML', '', 'val x = 2;', handler('new'))
+        scheduler.schedule('/b.ML', '', 'val y = 1;', handler('cancelled'))
+        scheduler.cancel('/b.ML')
+        self.assertTrue(wait_for(lambda: len(results) == 3))
+        self.assertEqual([(name, c) for name, c, m in results],
+                         [('old', 'C'), ('cancelled', 'C'), ('new', 'S')])
+        for name, c, m in results:
+            self.assertTrue(isinstance(m, MessageList))
+            self.assertEqual(m.suppressed, 0)
+        self.assertEqual(scheduler.superseded, 1)
+
+class StoreTests(FakePolyTestCase):
+    source = 'val x = 1\nval y = x + 2\n'
+
+    def setUp(self):
+        FakePolyTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'f.ML')
+        self.db = os.path.join(self.dir, '.polysave', 'polyml-index.db')
+
+    def tearDown(self):
+        FakePolyTestCase.tearDown(self)
+        shutil.rmtree(self.dir)
+
+    def build(self):
+        poly = self.poly(index=True, persistent_index=True)
+        self.assertEqual(poly.compile_sync(self.path, '', self.source)[0], 'S')
+        self.assertTrue(wait_for(lambda: os.path.exists(self.db) and
+                                         poly.symbols.files()))
+        return poly
+
+    def stored(self):
+        return store.IndexStore(self.db).get(self.path,
+                                             store.content_hash(self.source))
+
+    def set_stored(self, blob):
+        db = sqlite3.connect(self.db)
+        db.execute('UPDATE indexes SET data = ?', (sqlite3.Binary(blob),))
+        db.commit()
+        db.close()
+
+    def test_round_trip(self):
+        self.build()
+        self.assertTrue(wait_for(lambda: self.stored() != None))
+        poly = self.poly(index=True, persistent_index=True)
+        self.assertFalse(poly.load_stored_index(self.path, self.source + ' '))
+        self.assertTrue(poly.load_stored_index(self.path, self.source))
+        self.assertTrue(poly.has_built(self.path))
+        self.assertEqual(poly.process, None)
+        node = poly.node_for_position(self.path, 18)
+        self.assertEqual((node.start, node.end), (18, 21))
+        self.assertEqual(poly.type_for_node(node), 'int')
+
+    def test_lookup_creates_nothing(self):
+        index_store = store.IndexStore(self.db)
+        self.assertEqual(index_store.get(self.path, 'hash'), None)
+        index_store.remove(self.path)
+        poly = self.poly(index=True, persistent_index=True)
+        self.assertFalse(poly.load_stored_index(self.path, self.source))
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_store(self):
+        self.build()
+        self.assertTrue(wait_for(lambda: self.stored() != None))
+        index_store = store.IndexStore(self.db)
+        hash = store.content_hash(self.source)
+        index_store.put(self.path, hash, self.stored())
+        self.assertNotEqual(index_store.get(self.path, hash), None)
+        self.assertEqual(index_store.get(self.path, hash + 'x'), None)
+        index_store.remove(self.path)
+        self.assertEqual(index_store.get(self.path, hash), None)
+
+    def test_bad_entries(self):
+        self.build()
+        self.assertTrue(wait_for(lambda: self.stored() != None))
+        # entries written by pickle, or in another format, are misses
+        self.set_stored(zlib.compress(pickle.dumps({'tokens': []}, 2)))
+        self.assertEqual(self.stored(), None)
+        self.set_stored(zlib.compress(
+            json.dumps({'format': 99, 'data': {}}).encode('ascii')))
+        self.assertEqual(self.stored(), None)
+        # and so are damaged ones
+        self.set_stored(zlib.compress(json.dumps(
+            {'format': store.STORE_FORMAT,
+             'data': {'tokens': [[1]]}}).encode('ascii')))
+        poly = self.poly(index=True, persistent_index=True)
+        self.assertFalse(poly.load_stored_index(self.path, self.source))
+        self.assertFalse(poly.has_built(self.path))
+
+class RecordTests(FakePolyTestCase):
+    def setUp(self):
+        FakePolyTestCase.setUp(self)
+        self._record_path = process.RECORD_PATH
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        process.RECORD_PATH = self.path
+
+    def tearDown(self):
+        FakePolyTestCase.tearDown(self)
+        process.RECORD_PATH = self._record_path
+        os.remove(self.path)
+
+    def test_pool(self):
+        # the workers of a pool record to the same file at the same time
+        pool = self.poly(size=2)
+        compiles = 20
+        for i in range(compiles):
+            self.assertEqual(pool.compile_sync('/f{0}.ML'.format(i % 7), '',
+                                               'val x = {0};'.format(i))[0],
+                             'S')
+        for worker in pool.workers:
+            worker.process.kill()
+        sessions = record.read_sessions(self.path)
+        self.assertEqual(len(sessions), 2)
+        replayed = [record.replay(self.path, i) for i in range(2)]
+        self.assertEqual(sum([stats['compiles'] for stats in replayed]),
+                         compiles)
+        for stats in replayed:
+            self.assertEqual(stats['responses'], stats['compiles'])
+
+class MessageLimitTests(FakePolyTestCase):
+    def test_limit(self):
+        self.fake(errors=7)
+        seen = []
+        poly = self.poly(max_messages=3)
+        result_code, messages = poly.compile_sync('/a.ML', '', 'val x = y;',
+                                                  on_message=seen.append)
+        self.assertEqual(result_code, 'F')
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(messages.suppressed, 4)
+        self.assertEqual(len(seen), 3)
+
+    def test_no_limit(self):
+        self.fake(errors=7)
+        poly = self.poly(max_messages=None)
+        result_code, messages = poly.compile_sync('/a.ML', '', 'val x = y;')
+        self.assertEqual(len(messages), 7)
+        self.assertEqual(messages.suppressed, 0)
+
+    def test_compile_messages(self):
+        self.fake(errors=7)
+        poly = self.poly(max_messages=3)
+        result = []
+        messages = list(poly.compile_messages('/a.ML', '', 'val x = y;',
+                                              result=result))
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(result[0], 'F')
+        self.assertEqual(list(result[1]), messages)
+        self.assertEqual(result[1].suppressed, 4)
+        # if the compilation fails, the messages saying why are yielded
+        self.fake(crash=1)
+        poly = self.poly()
+        result = []
+        messages = list(poly.compile_messages('/a.ML', '', 'crash',
+                                              result=result))
+        self.assertEqual(result[0], None)
+        self.assertEqual(messages, list(result[1]))
+        self.assertTrue('exited' in messages[0].text)
+
+    def test_compile_messages_timeout(self):
+        self.fake(errors=1, latency=0.5)
+        poly = self.poly()
+        poly.start()
+        self.assertTrue(wait_for(lambda: poly.process != None and
+                                         poly.process.wait_ready(10)))
+        iterator = poly.compile_messages('/a.ML', '', 'val x = y;', 0.1)
+        self.assertRaises(Timeout, next, iterator)
+
+    def test_exception(self):
+        # the exception does not count towards the limit
+        errors = [('a.ML', i, i + 1, 'bad ' + str(i)) for i in range(5)]
+        data = fakepoly.compile_response(1, 2, 'X', 10, errors)
+        head, rest = data.split(b'\x1b;', 1)
+        data = head + b'\x1b;\x1bXFail "oops"\x1bx' + rest
+        packet = PacketTokenizer(PROTOCOL_ENCODING).feed(data)[0]
+        poly = Poly(max_messages=3)
+        result_code, messages = poly._read_compile_response(packet, 'a.ML')
+        self.assertEqual(result_code, 'X')
+        self.assertEqual([m.message_code for m in messages],
+                         ['X', 'E', 'E', 'E'])
+        self.assertEqual(messages.suppressed, 2)
+
+if __name__ == '__main__':
+    unittest.main()
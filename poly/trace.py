@@ -0,0 +1,113 @@
+import os
+import time
+import json
+import threading
+from collections import deque
+
+"""Tracing of the phases of Poly/ML requests
+
+When tracing is enabled, the package records spans for the phases of each
+request (writing it, waiting for the response, reading and parsing
+responses, running handlers, and updating the editor) in a ring buffer
+holding the most recent events.  dump() saves the buffer in the Chrome
+trace format, which chrome://tracing and Perfetto can show.
+
+Tracing costs one global lookup per span when it is disabled.  Code being
+traced does:
+
+    t = trace.start()
+    ...
+    trace.end(t, 'write', 'R')
+"""
+
+# the number of events kept by default
+TRACE_SIZE = 10000
+
+# the ring buffer of events, or None if tracing is disabled; each event is
+# (name, category, start time, duration, thread id, args), with times in
+# seconds
+_events = None
+
+def enable(size=TRACE_SIZE):
+    """Starts tracing, keeping the last size events.
+
+    Any events already recorded are discarded.
+    """
+    global _events
+    _events = deque([], size)
+
+def disable():
+    """Stops tracing, and discards the events recorded."""
+    global _events
+    _events = None
+
+def enabled():
+    return _events != None
+
+def start():
+    """Returns the start time for a span, or None if tracing is disabled."""
+    if _events == None:
+        return None
+    return time.time()
+
+def end(started, name, category='', args=None):
+    """Records a span.
+
+    started -- the result of start() when the span began; nothing is
+               recorded if it is None
+    name -- the phase (eg: 'write')
+    category -- (optional) eg: the request code
+    args -- (optional) a dict of details to show with the span
+    """
+    events = _events
+    if started == None or events == None:
+        return
+    # appending to a deque is atomic, so no lock is needed
+    events.append((name, category, started, time.time() - started,
+                   threading.current_thread().ident, args))
+
+def instant(name, category='', args=None):
+    """Records an event with no duration."""
+    events = _events
+    if events == None:
+        return
+    events.append((name, category, time.time(), None,
+                   threading.current_thread().ident, args))
+
+def events():
+    """Returns a list of the events in the buffer, oldest first."""
+    events = _events
+    if events == None:
+        return []
+    return list(events)
+
+def dump(path):
+    """Saves the events in the buffer to a file in the Chrome trace format.
+
+    Returns the number of events saved.
+    """
+    pid = os.getpid()
+    trace_events = []
+    for name, category, started, duration, tid, args in events():
+        event = {
+            'name': name,
+            'cat': category,
+            'ts': started * 1e6,
+            'pid': pid,
+            'tid': tid,
+        }
+        if duration == None:
+            event['ph'] = 'i'
+            event['s'] = 't'
+        else:
+            event['ph'] = 'X'
+            event['dur'] = duration * 1e6
+        if args:
+            event['args'] = args
+        trace_events.append(event)
+    f = open(path, 'w')
+    try:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+    finally:
+        f.close()
+    return len(trace_events)
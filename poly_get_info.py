@@ -1,33 +1,36 @@
 import sublime
 import sublime_plugin
 import os
+import re
 import poly
 import polyio
 
 class DescribePolySymbolCommand(sublime_plugin.WindowCommand):
-    def __init__(self, window):
-        sublime_plugin.WindowCommand.__init__(self, window)
-        self.poly_bin = window.active_view().settings().get('poly_bin')
-        if self.poly_bin == None: self.poly_bin = '/usr/local/bin/poly'
-    
     def run(self):
-        poly_inst = poly.global_instance(self.poly_bin)
+        poly_inst = polyio.poly_instance(self.window.active_view())
 
         view = self.window.active_view()
         polyio.show_output_view()
         path = self.window.active_view().file_name()
+        polyio.load_stored_index(poly_inst, view)
         
         if poly_inst.has_built(path):
-            position = view.sel()[0].begin()
+            positions = [region.begin() for region in view.sel()]
             try:
-                node = poly_inst.node_for_position(path, position)
-                name = view.substr(sublime.Region(node.start, node.end))
-                ml_type = poly_inst.type_for_node(node)
+                # one pipeline for every selection, rather than a round trip each
+                nodes = poly_inst.nodes_for_positions(path, positions)
+                ml_types = poly_inst.types_for_nodes(nodes)
                 
-                if ml_type != None:
-                    polyio.println('val %s : %s' % (name, ml_type))
-                else:
-                    polyio.println("Can't decribe %s" % name)
+                for node, ml_type in zip(nodes, ml_types):
+                    if node == None:
+                        # not covered by an index from an earlier session
+                        polyio.println("Can't find a symbol here")
+                        continue
+                    name = view.substr(sublime.Region(node.start, node.end))
+                    if ml_type != None:
+                        polyio.println('val %s : %s' % (name, ml_type))
+                    else:
+                        polyio.println("Can't decribe %s" % name)
             except poly.process.Timeout:
                 pass
             
@@ -36,3 +39,102 @@ class DescribePolySymbolCommand(sublime_plugin.WindowCommand):
             polyio.println('Recompile this file to get info about its symbols.')
             
         
+
+class PolyStatsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        poly_inst = polyio.poly_instance(self.window.active_view())
+        polyio.show_output_view()
+        for line in poly.metrics.format_stats(poly_inst.stats()):
+            polyio.println(line)
+        polyio.println()
+        
+
+class PolySaveTraceCommand(sublime_plugin.WindowCommand):
+    """Saves the trace of recent Poly/ML requests (see poly_trace)."""
+    def run(self):
+        if not poly.trace.enabled():
+            sublime.status_message('Set "poly_trace": true to trace Poly/ML requests')
+            return
+        self.window.show_input_panel("Save trace to:",
+            os.path.expanduser('~/polyml-trace.json'), self.save, None, None)
+    
+    def save(self, path):
+        try:
+            n = poly.trace.dump(os.path.expanduser(path))
+            sublime.status_message("Saved {0} trace events to {1}".format(n, path))
+        except IOError as e:
+            sublime.status_message("Could not save the trace: " + str(e))
+
+
+
+_identifier_rexp = re.compile(r"[A-Za-z0-9_'.]+|[!%&$#+\-/:<=>?@\\~`^|*]+")
+
+def identifier_at(view, position):
+    """Get the (possibly qualified) identifier at a position in a view."""
+    line = view.line(position)
+    text = view.substr(line)
+    col = position - line.begin()
+    for m in _identifier_rexp.finditer(text):
+        if m.start() <= col < m.end():
+            return m.group().strip('.')
+    return None
+
+class GotoPolyDefinitionCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        view = self.window.active_view()
+        poly_inst = polyio.poly_instance(view)
+        path = view.file_name()
+        position = view.sel()[0].begin()
+        polyio.load_stored_index(poly_inst, view)
+        
+        location = None
+        if path != None and poly_inst.has_built(path):
+            try:
+                node = poly_inst.node_for_position(path, position)
+                location = poly_inst.declaration_for_node(node)
+            except poly.process.Timeout:
+                pass
+        
+        if location == None or (not isinstance(location, poly.PolyNode) and
+                                not os.path.isabs(location.file_name)):
+            # try the declarations found in other files
+            name = identifier_at(view, position)
+            locations = name and poly_inst.find_declarations(name)
+            if locations:
+                location = locations[0]
+        
+        if location == None:
+            sublime.status_message("Could not find the declaration")
+        else:
+            self.go_to(location)
+    
+    def go_to(self, location):
+        if location.line:
+            self.window.open_file("{0}:{1}:{2}".format(
+                location.file_name, location.line, location.start + 1),
+                sublime.ENCODED_POSITION)
+            return
+        
+        for view in self.window.views():
+            if view.file_name() == location.file_name:
+                region = sublime.Region(location.start, location.end)
+                self.window.focus_view(view)
+                view.sel().clear()
+                view.sel().add(region)
+                view.show(region)
+                return
+        
+        # not open, so work out the line and column from the file
+        try:
+            f = open(location.file_name)
+            try:
+                before = f.read()[:location.start]
+            finally:
+                f.close()
+        except IOError:
+            sublime.status_message("Could not open " + location.file_name)
+            return
+        line = before.count('\n') + 1
+        col = len(before) - (before.rfind('\n') + 1) + 1
+        self.window.open_file("{0}:{1}:{2}".format(
+            location.file_name, line, col), sublime.ENCODED_POSITION)
@@ -1,6 +1,8 @@
 import sublime
 import threading
 import time
+import os
+import poly
 
 
 class Spinner(threading.Thread):
@@ -70,6 +72,78 @@ def stop_all_spinners():
     spinner_lock.release()
 
 
+def poly_instance(view):
+    """Get the global Poly instance, creating it from view's settings."""
+    if poly.poly_global != None:
+        return poly.poly_global
+    
+    settings = view.settings()
+    poly_bin = settings.get('poly_bin')
+    if poly_bin == None: poly_bin = '/usr/local/bin/poly'
+    processes = settings.get('poly_processes')
+    if processes == None: processes = 1
+    prestart = bool(settings.get('poly_prestart'))
+    
+    compile_cache = None
+    cache_setting = settings.get('poly_compile_cache')
+    if cache_setting == True:
+        compile_cache = poly.CompileCache()
+    elif cache_setting:
+        compile_cache = poly.CompileCache(path=os.path.expanduser(cache_setting))
+    incremental = bool(settings.get('poly_incremental'))
+    index = bool(settings.get('poly_index'))
+    persistent_index = bool(settings.get('poly_persistent_index'))
+    record = settings.get('poly_record')
+    if record:
+        poly.process.RECORD_PATH = os.path.expanduser(record)
+    trace = settings.get('poly_trace')
+    if trace == True:
+        poly.trace.enable()
+    elif trace:
+        poly.trace.enable(int(trace))
+    max_messages = settings.get('poly_max_messages')
+    if max_messages == None: max_messages = poly.MAX_MESSAGES
+    max_messages = int(max_messages) or None  # 0 for no limit
+    
+    poly_inst = poly.global_instance(poly_bin, processes, prestart,
+                                     compile_cache, incremental,
+                                     index or persistent_index,
+                                     persistent_index, max_messages)
+    poly_inst.subscribe_output(show_program_output)
+    return poly_inst
+
+
+def show_program_output(text, dropped):
+    """Adds what the code being compiled prints to the output panel.
+    
+    Called on the output subscription's thread, at most every
+    poly.process.OUTPUT_INTERVAL seconds.
+    """
+    if dropped:
+        text = "[{0} bytes of output dropped]\n".format(dropped) + text
+    sublime.set_timeout(lambda: output(text), 0)
+
+
+def load_stored_index(poly_inst, view):
+    """Makes a file that has not been compiled queryable from its index
+    in an earlier session, if it has not changed since."""
+    path = view.file_name()
+    if path == None or poly_inst.has_built(path):
+        return
+    poly_inst.load_stored_index(path, view.substr(sublime.Region(0, len(view))))
+
+
+_scheduler = None
+
+def compile_scheduler(view):
+    """Get the CompileScheduler for the global Poly instance."""
+    global _scheduler
+    poly_inst = poly_instance(view)
+    if _scheduler == None or _scheduler.poly is not poly_inst:
+        _scheduler = poly.CompileScheduler(poly_inst)
+    return _scheduler
+
+
 _output_view = None
 
 def output_view():
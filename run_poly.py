@@ -1,53 +1,49 @@
 import sublime
 import sublime_plugin
 import os
-import time
 import poly
 import polyio
-from threading import Thread
           
 
 class RunPolyCommand(sublime_plugin.WindowCommand):
     def __init__(self, window):
         sublime_plugin.WindowCommand.__init__(self, window)
-        self.poly = None
-        self.current_job = None
+        self.scheduler = None
     
-    def run(self):
-        view = self.window.active_view()
-        
-        poly_bin = view.settings().get('poly_bin')
-        if poly_bin == None: poly_bin = '/usr/local/bin/poly'
+    def run(self, debounce=None, background=False):
+        """Compiles the active view.
         
-        if self.poly == None or self.poly.poly_bin != poly_bin:
-            self.poly = poly.global_instance(poly_bin)
+        debounce -- (optional) how long to wait for more changes first
+        background -- (optional) whether the compilation was not asked for
+                      by the user (see PolyCompileOnModify): the errors
+                      are updated when it finishes, but the output panel is
+                      left as it is until then, and not shown
+        """
+        view = self.window.active_view()
         
-        if self.current_job != None:
-            print("Compile job already in progress...")
-            return
+        self.scheduler = polyio.compile_scheduler(view)
         
-        view.erase_regions('poly-errors')
+        path = view.file_name()
+        if path == None: path = "--scratch--"
         
         output_view = polyio.output_view()
-        polyio.clear_output_view()
-        polyio.show_output_view()
-        polyio.println("Compiling code with Poly/ML...")
+        if not background:
+            view.erase_regions('poly-errors')
+            polyio.clear_output_view()
+            polyio.show_output_view()
+            polyio.println("Compiling code with Poly/ML...")
         
         preamble = ""
-        path = self.window.active_view().file_name()
-        if path != None:
+        saved_state = None
+        if path != "--scratch--":
             working_dir = os.path.dirname(path)
             file_name = os.path.basename(path)
             output_view.settings().set("result_base_dir", working_dir)
             
             preamble = "OS.FileSys.chDir \"" + working_dir + "\";\n"
-            polysave = working_dir + "/.polysave/" + file_name + ".save"
-            
-            if os.path.exists(polysave):
-                preamble += "PolyML.SaveState.loadState(\"" + polysave + "\");\n"
-                preamble += "PolyML.fullGC ();\n"
+            # only reloaded by Poly if it has changed
+            saved_state = poly.polysave_for(path)
         else:
-            path = "--scratch--"
             file_name = "--scratch--"
 
         output_view.settings().set(
@@ -57,17 +53,29 @@ class RunPolyCommand(sublime_plugin.WindowCommand):
         
         ml = view.substr(sublime.Region(0, len(view)))
         
-        spinner = None
+        spinner = polyio.start_spinner("Compiling '{0}'".format(file_name))
         
         def handler(code, messages):
-            if spinner != None:
-                polyio.stop_spinner(spinner)
+            polyio.stop_spinner(spinner)
             
-            self.current_job = None
+            if code == 'C':
+                # superseded by a newer compilation, which will report
+                return
             
             def h():
+                t = poly.trace.start()
+                if background:
+                    # replace the last results, without showing the panel
+                    view.erase_regions('poly-errors')
+                    polyio.clear_output_view()
+                    if code != None:
+                        sublime.status_message("Poly/ML: {0}".format(
+                            poly.translate_result_code(code)))
                 if code == 'S':
                     polyio.println("[Success]")
+                elif code == None:
+                    for msg in messages:
+                        polyio.println(msg.text)
                 else:
                     polyio.println("[{0}]\n".format(poly.translate_result_code(code)))
                     
@@ -87,18 +95,54 @@ class RunPolyCommand(sublime_plugin.WindowCommand):
                             end_col + 1,
                             msg.text))
                     
+                    suppressed = getattr(messages, 'suppressed', 0)
+                    if suppressed:
+                        polyio.println("[{0} more messages not shown]".format(suppressed))
+                    
                     view.add_regions('poly-errors', error_regions, 'constant', sublime.DRAW_OUTLINED)
+                poly.trace.end(t, 'ui', code, {'messages': len(messages)})
             
             sublime.set_timeout(h,0) # execute h() on the main thread
         
         try:
-            self.current_job = self.poly.compile(path, preamble, ml, handler)
+            # replaces (or cancels) any older compilation of this file
+            self.scheduler.schedule(path, preamble, ml, handler, saved_state,
+                                    debounce)
         except poly.process.ProtocolError as e:
+            polyio.stop_spinner(spinner)
             polyio.println("Protocol Error: " + str(e))
             polyio.println("Check that 'poly_bin' is defined correctly in your user settings.")
-        else:
-            spinner = polyio.start_spinner("Compiling '{0}'".format(file_name))
-
 
 
+class PolyCompileOnModify(sublime_plugin.EventListener):
+    """Compiles ML files as they are edited, if poly_compile_on_modify is set.
+    
+    The setting is the number of seconds to wait after the last change
+    before compiling (or true, for half a second).
+    """
+    def on_modified(self, view):
+        delay = view.settings().get('poly_compile_on_modify')
+        if not delay or not view.match_selector(0, 'source.ml'):
+            return
+        if delay == True: delay = 0.5
         
+        window = view.window()
+        if window != None and window.active_view() == view:
+            window.run_command('run_poly', {'debounce': delay,
+                                            'background': True})
+
+
+
+def start_poly_early():
+    """Start Poly/ML when the plugin loads, if poly_prestart is set."""
+    window = sublime.active_window()
+    view = window and window.active_view()
+    if view == None or not view.settings().get('poly_prestart'):
+        return
+    
+    try:
+        polyio.poly_instance(view).start()
+    except poly.process.ProtocolError as e:
+        print("Could not start Poly/ML: " + str(e))
+
+sublime.set_timeout(start_poly_early, 0)
@@ -20,9 +20,38 @@
 "   :Polyml [timeout]
 "   Compile the current file. There is no need to save first, although
 "   QuickFix lists don't work well with unnamed buffers.  The timeout is
-"   in seconds.
+"   in seconds; a compilation that takes longer is cancelled.  Anything the code prints while it compiles is echoed as it
+"   is printed (see :messages).
 "   Auto-opening the QuickFix window on errors can be disabled with
 "       let g:polyml_cwindow = 0
+"   Files can be compiled by several Poly/ML processes in parallel with
+"       let g:polyml_processes = 4
+"   Poly/ML can be started in the background when this plugin loads (and a
+"   spare process kept ready in case it dies) with
+"       let g:polyml_prestart = 1
+"   Results for code that has already been compiled can be reused (and kept
+"   in a file between sessions, if a path is given) with
+"       let g:polyml_compile_cache = 1
+"       let g:polyml_compile_cache = '~/.vim/polyml-compile-cache'
+"   Large files can be recompiled faster, by only compiling the top-level
+"   declarations from the first one that has changed, with
+"       let g:polyml_incremental = 1
+"   Types and declarations can be looked up without waiting for Poly/ML,
+"   by indexing each file in the background after it compiles, with
+"       let g:polyml_index = 1
+"   The indexes can be kept in .polysave/polyml-index.db next to each file,
+"   so that unchanged files can be queried in later sessions without
+"   compiling them first, with
+"       let g:polyml_persistent_index = 1
+"   The protocol traffic with Poly/ML can be recorded, to replay with
+"   python -m poly.record when reporting performance problems, with
+"       let g:polyml_record = '~/polyml-session.log'
+"   The phases of recent requests can be traced (see :PolymlSaveTrace), in
+"   a buffer of 10000 events (or the given number) with
+"       let g:polyml_trace = 1
+"   Only the first 100 messages from a compilation are shown (and the rest
+"   counted); for another limit (or 0 for none) use
+"       let g:polyml_max_messages = 100
 "   Default shortcuts: <LocalLeader>pc and <F5>
 "
 "
@@ -36,10 +65,24 @@
 "   Goes to the declaration of the expression under the cursor.  If you have
 "   edited the file since the last compile, you should re-compile it with
 "   :Polyml first.  Due to a shortcoming of Poly/ML, it will fail to find ML
-"   files that are not in the current directory.
+"   files that are not in the current directory, unless they have been
+"   indexed (see g:polyml_index).  With indexing, identifiers declared in
+"   other indexed files can be found even if the current file has not been
+"   compiled.
 "   Default shortcut: <LocalLeader>pd
 "
 "
+"   :PolymlStats
+"   Shows how many requests have been sent to Poly/ML, how long the
+"   responses took, and other statistics, to help track down slowness.
+"
+"
+"   :PolymlSaveTrace [file]
+"   Saves the trace of recent requests (see g:polyml_trace) in the Chrome
+"   trace format, for chrome://tracing or Perfetto.  The default file is
+"   ~/polyml-trace.json.
+"
+"
 "   :[range]PolymlAccessors
 "   Generates accessor implementations for a record datatype, as selected by
 "   [range].  The usual use is to visually highlight (with V) the datatype
@@ -77,6 +120,42 @@ if !exists('g:poly_bin')
     let g:poly_bin = 'poly'
 endif
 
+if !exists('g:polyml_processes')
+    let g:polyml_processes = 1
+endif
+
+if !exists('g:polyml_prestart')
+    let g:polyml_prestart = 0
+endif
+
+if !exists('g:polyml_compile_cache')
+    let g:polyml_compile_cache = 0
+endif
+
+if !exists('g:polyml_incremental')
+    let g:polyml_incremental = 0
+endif
+
+if !exists('g:polyml_index')
+    let g:polyml_index = 0
+endif
+
+if !exists('g:polyml_persistent_index')
+    let g:polyml_persistent_index = 0
+endif
+
+if !exists('g:polyml_record')
+    let g:polyml_record = ''
+endif
+
+if !exists('g:polyml_trace')
+    let g:polyml_trace = 0
+endif
+
+if !exists('g:polyml_max_messages')
+    let g:polyml_max_messages = 100
+endif
+
 if !exists('g:polyml_terminal')
     let g:polyml_terminal = 'xterm'
 endif
@@ -90,35 +169,99 @@ command PolymlGetType :python PolymlGetType()
 command -range PolymlAccessors :<line1>,<line2>python PolymlCreateAccessors()
 command -range PolymlAccessorSigs :<line1>,<line2>python PolymlCreateAccessorSigs()
 command PolymlFindDeclaration python PolymlFindDeclaration()
+command PolymlStats python PolymlStats()
+command -nargs=? -complete=file PolymlSaveTrace python PolymlSaveTrace(<q-args>)
 command PolymlConsoleHere python poly.console.ConsoleThread(vim.current.buffer.name,vim.eval('g:poly_bin'),vim.eval('g:polyml_terminal')).start()
 
 python <<EOP
 import vim
 import os
+import re
+import threading
 sys.path.append(os.path.dirname(vim.eval('expand("<sfile>")')))
 import poly
 
+# what the code being compiled prints, shown while it compiles
+poly_output = None
+
+def poly_get_instance():
+    global poly_output
+    if poly.poly_global != None:
+        return poly.poly_global
+    poly_bin = vim.eval('g:poly_bin')
+    processes = int(vim.eval('g:polyml_processes'))
+    prestart = int(vim.eval('g:polyml_prestart')) != 0
+    compile_cache = None
+    cache_setting = vim.eval('g:polyml_compile_cache')
+    if cache_setting == '1':
+        compile_cache = poly.CompileCache()
+    elif cache_setting not in ('', '0'):
+        compile_cache = poly.CompileCache(path=os.path.expanduser(cache_setting))
+    incremental = int(vim.eval('g:polyml_incremental')) != 0
+    index = int(vim.eval('g:polyml_index')) != 0
+    persistent_index = int(vim.eval('g:polyml_persistent_index')) != 0
+    record = vim.eval('g:polyml_record')
+    if record:
+        poly.process.RECORD_PATH = os.path.expanduser(record)
+    trace = int(vim.eval('g:polyml_trace'))
+    if trace == 1:
+        poly.trace.enable()
+    elif trace:
+        poly.trace.enable(trace)
+    max_messages = int(vim.eval('g:polyml_max_messages'))
+    if max_messages <= 0:
+        max_messages = None
+    poly_inst = poly.global_instance(poly_bin, processes, prestart,
+                                     compile_cache, incremental,
+                                     index or persistent_index,
+                                     persistent_index, max_messages)
+    poly_output = poly_inst.subscribe_output()
+    return poly_inst
+
+def poly_show_output():
+    """Echo what the code being compiled has printed since last time"""
+    text, dropped = poly_output.take()
+    if dropped:
+        vim.command("echom '[{0} bytes of output dropped]'".format(dropped))
+    for line in text.splitlines():
+        vim.command("echom '{0}'".format(line.replace("'","''")))
+    if text or dropped:
+        vim.command('redraw')
+
 # The main reason this is a function is to scope poly_inst properly.
 # Otherwise, the Poly object won't be garbage collected, and vim will
 # hang at exit waiting for the various Python threads to return.
 def poly_do_compile(path, ml, timeout):
-    poly_bin = vim.eval('g:poly_bin')
-    poly_inst = poly.global_instance(poly_bin)
+    poly_inst = poly_get_instance()
 
     preamble = ''
+    saved_state = None
     if (path):
         working_dir = os.path.dirname(path)
-        file_name = os.path.basename(path)
         preamble = "OS.FileSys.chDir \"" + working_dir + "\";\n"
-        polysave = working_dir + "/.polysave/" + file_name + ".save"
-
-        if os.path.exists(polysave):
-            preamble += "PolyML.SaveState.loadState(\"" + polysave + "\");\n"
-            preamble += "PolyML.fullGC ();\n"
+        # only reloaded by Poly if it has changed
+        saved_state = poly.polysave_for(path)
     else:
         path = '--scratch--'
 
-    return poly_inst.compile_sync(path, preamble, ml, timeout)
+    # compile on another thread, so that output can be shown as it arrives
+    # (Vim can only be used from this one)
+    poly_output.take()
+    result = {}
+    def run():
+        try:
+            result['value'] = poly_inst.compile_sync(path, preamble, ml,
+                                                     timeout, saved_state)
+        except Exception as e:
+            result['error'] = e
+    compiler = threading.Thread(target=run)
+    compiler.start()
+    while compiler.is_alive():
+        compiler.join(poly.process.OUTPUT_INTERVAL)
+        poly_show_output()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
 
 def rowcol(lines,offset):
     """Get the row and column of an offset in a list of lines
@@ -151,8 +294,10 @@ def poly_get_node(poly_inst=None):
     for i in range(row-1):
         line_start_pos += len(lines[i]) + 1
     if not poly_inst:
-        poly_bin = vim.eval('g:poly_bin')
-        poly_inst = poly.global_instance(poly_bin)
+        poly_inst = poly_get_instance()
+    if not poly_inst.has_built(path):
+        # an index from an earlier session will do, if the file is unchanged
+        poly_inst.load_stored_index(path, "\n".join(lines))
     if not poly_inst.has_built(path):
         vim.command('echoerr "You must compile the file first!"')
         return None
@@ -291,6 +436,10 @@ try:
     for msg in messages:
         vim.command("call add(l:output,'{0}')".format(
             poly_format_message(msg).replace("'","''")))
+    suppressed = getattr(messages, 'suppressed', 0)
+    if suppressed:
+        vim.command("call add(l:output,'[{0} more messages not shown]')".format(
+            suppressed))
 
     del result
     del messages
@@ -405,8 +554,7 @@ def PolymlCreateAccessors():
 
 def PolymlGetType():
     try:
-        poly_bin = vim.eval('g:poly_bin')
-        poly_inst = poly.global_instance(poly_bin)
+        poly_inst = poly_get_instance()
         pnode = poly_get_node(poly_inst)
         if pnode:
             ml_type = poly_inst.type_for_node(pnode.node)
@@ -427,14 +575,33 @@ def PolymlGetType():
     except Exception as e:
         vim.command("echoerr 'Caught exception: {0}'".format(repr(e).replace("'","''")))
 
+def poly_identifier_at_cursor():
+    """Get the (possibly qualified) identifier under the cursor"""
+    row,col = vim.current.window.cursor
+    line = vim.current.buffer[row-1]
+    for m in re.finditer(r"[A-Za-z0-9_'.]+|[!%&$#+\-/:<=>?@\\~`^|*]+", line):
+        if m.start() <= col < m.end():
+            return m.group().strip('.')
+    return None
+
 def PolymlFindDeclaration():
     try:
-        poly_bin = vim.eval('g:poly_bin')
-        poly_inst = poly.global_instance(poly_bin)
-        pnode = poly_get_node(poly_inst)
-        if not pnode:
-            return
-        loc = poly_inst.declaration_for_node(pnode.node)
+        poly_inst = poly_get_instance()
+        loc = None
+        path = vim.current.buffer.name
+        if path and (poly_inst.has_built(path) or
+                     poly_inst.load_stored_index(path, "\n".join(vim.current.buffer[:]))):
+            pnode = poly_get_node(poly_inst)
+            if not pnode:
+                return
+            loc = poly_inst.declaration_for_node(pnode.node)
+        if not loc or (not isinstance(loc, poly.PolyNode) and
+                       not os.path.isabs(loc.file_name)):
+            # try the declarations found in other files
+            name = poly_identifier_at_cursor()
+            locs = name and poly_inst.find_declarations(name)
+            if locs:
+                loc = locs[0]
         if not loc:
             vim.command('echoerr "Could not find location of declaration"')
             return
@@ -446,10 +613,35 @@ def PolymlFindDeclaration():
     except Exception as e:
         vim.command("echoerr 'Caught exception: {0}'".format(repr(e).replace("'","''")))
 
+def PolymlStats():
+    for line in poly.metrics.format_stats(poly_get_instance().stats()):
+        vim.command("echom '{0}'".format(line.replace("'","''")))
+
+def PolymlSaveTrace(path):
+    if not poly.trace.enabled():
+        vim.command('echoerr "Tracing is off; see g:polyml_trace"')
+        return
+    path = os.path.expanduser(path or '~/polyml-trace.json')
+    try:
+        n = poly.trace.dump(path)
+        vim.command("echom 'Saved {0} trace events to {1}'".format(n, path.replace("'","''")))
+    except IOError as e:
+        vim.command("echoerr 'Could not save the trace: {0}'".format(str(e).replace("'","''")))
+
 def poly_cleanup():
     poly.kill_global_instance()
+
+def poly_prestart():
+    try:
+        poly_get_instance().start()
+    except poly.process.ProtocolError as e:
+        vim.command("echoerr 'Could not start Poly/ML: {0}'".format(str(e).replace("'","''")))
 EOP
 
+if g:polyml_prestart
+    python poly_prestart()
+endif
+
 autocmd VimLeave * python poly_cleanup()
 
 map <silent> <F5> :Polyml<CR>